@@ -0,0 +1,286 @@
+"""
+Microbenchmarks for the druvw kernels and the path that builds the results page.
+
+Records the time, throughput (rows per second), and peak memory of each benchmark for several numbers of rows,
+and optionally compares them with a baseline saved by an earlier run:
+
+    python benchmarks/bench_kinematics.py --save baseline.json
+    python benchmarks/bench_kinematics.py --compare baseline.json
+
+The exit code is 1 if any benchmark is slower or uses more memory than the baseline by more than the tolerance.
+"""
+
+from __future__ import print_function
+import argparse
+import gc
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2, peak memory is not recorded
+    tracemalloc = None
+
+SIZES = [1, 1000, 100000, 1000000, 10000000]
+MIN_TIME = 0.2  # seconds to repeat each benchmark for
+BENCHMARKS = []
+
+
+# Decorator to register a benchmark
+def benchmark(name, max_size=None):
+    """
+    The decorated function takes the number of rows and returns the function to time,
+    so that building the inputs is not timed.
+    """
+
+    def register(setup):
+        BENCHMARKS.append((name, setup, max_size))
+        return setup
+    return register
+
+
+def _inputs(n):
+    rng = np.random.RandomState(42)
+    return dict(ra=rng.uniform(0, 360, n), dec=rng.uniform(-90, 90, n), dist=rng.uniform(10, 200, n),
+                pmra=rng.normal(0, 100, n), pmdec=rng.normal(0, 100, n), rv=rng.normal(0, 20, n))
+
+
+# druvw kernels with ndarray, list, and scalar inputs
+@benchmark('xyz_ndarray')
+def bench_xyz_ndarray(n):
+    from druvw import xyz
+    p = _inputs(n)
+    return lambda: xyz(p['ra'], p['dec'], p['dist'])
+
+
+@benchmark('uvw_ndarray')
+def bench_uvw_ndarray(n):
+    from druvw import uvw
+    p = _inputs(n)
+    return lambda: uvw(p['ra'], p['dec'], p['dist'], p['pmra'], p['pmdec'], p['rv'])
+
+
+@benchmark('xyz_list', max_size=1000000)
+def bench_xyz_list(n):
+    from druvw import xyz
+    p = dict((k, v.tolist()) for k, v in _inputs(n).items())
+    return lambda: xyz(p['ra'], p['dec'], p['dist'])
+
+
+@benchmark('uvw_list', max_size=1000000)
+def bench_uvw_list(n):
+    from druvw import uvw
+    p = dict((k, v.tolist()) for k, v in _inputs(n).items())
+    return lambda: uvw(p['ra'], p['dec'], p['dist'], p['pmra'], p['pmdec'], p['rv'])
+
+
+@benchmark('xyz_uvw_scalar', max_size=10000)
+def bench_scalar(n):
+    # n separate calls with scalar inputs, as done for the normal calculation
+    from druvw import xyz, uvw
+    p = dict((k, v.tolist()) for k, v in _inputs(n).items())
+
+    def run():
+        for i in range(n):
+            xyz(p['ra'][i], p['dec'][i], p['dist'][i])
+            uvw(p['ra'][i], p['dec'][i], p['dist'][i], p['pmra'][i], p['pmdec'][i], p['rv'][i])
+    return run
+
+
+@benchmark('xyzuvw_parallel', max_size=10000000)
+def bench_parallel(n):
+    # Process pool with one worker per core, as with PARALLEL_WORKERS=-1
+    import multiprocessing
+    from parallel import ParallelCompute
+    pool = ParallelCompute(multiprocessing.cpu_count(), min_rows=0)
+    p = _inputs(n)
+    return lambda: pool.xyzuvw(p['ra'], p['dec'], p['dist'], p['pmra'], p['pmdec'], p['rv'])
+
+
+@benchmark('rv_sweep_cached', max_size=10000000)
+def bench_rv_sweep(n):
+    # Sweep of n radial velocities for one star whose basis is cached
+    from sweep import sweep_grid
+    stars = {'ra': [165.46627797], 'dec': [-34.70473119], 'dist': [53.7], 'pmra': [-66.19], 'pmdec': [-13.90]}
+    rv = np.linspace(-100, 100, n)
+    return lambda: sweep_grid(stars, {'rv': rv}, max_size=np.inf)
+
+
+@benchmark('rv_fit', max_size=1000000)
+def bench_rv_fit(n):
+    # Best radial velocity of n stars for every group, in place of a sweep
+    from bestfit import best_fit
+    p = _inputs(n)
+    return lambda: best_fit(p, 'rv')
+
+
+@benchmark('kdtree_build', max_size=1000000)
+def bench_kdtree_build(n):
+    # Index built by the first neighbor query of a result set
+    from spatial import KDTree
+    points = np.random.RandomState(42).normal(0, 50, (n, 3))
+    return lambda: KDTree(points)
+
+
+@benchmark('kdtree_knn', max_size=10000000)
+def bench_kdtree_knn(n):
+    # One query of the 10 nearest neighbors in an index of n points, as /api/v1/results/<key>/knn
+    from spatial import KDTree
+    index = KDTree(np.random.RandomState(42).normal(0, 50, (n, 3)))
+    return lambda: index.knn([10., -5., 3.], k=10)
+
+
+@benchmark('kdtree_radius', max_size=10000000)
+def bench_kdtree_radius(n):
+    from spatial import KDTree
+    index = KDTree(np.random.RandomState(42).normal(0, 50, (n, 3)))
+    return lambda: index.radius([10., -5., 3.], 5.)
+
+
+# Steps of the results path
+@benchmark('proc_columns', max_size=100000)
+def bench_proc_columns(n):
+    # n headers to normalize, cycling through known aliases and unknown names
+    from catalog import proc_columns
+    headers = ['Name', 'RA_J2000', 'DEJ2000', 'pm_ra', 'pmDE', 'Radial Velocity', 'Distance', 'Vmag']
+    headers = [headers[i % len(headers)] for i in range(n)]
+    return lambda: [proc_columns(c) for c in headers]
+
+
+@benchmark('dataframe')
+def bench_dataframe(n):
+    import pandas as pd
+    from druvw import xyz, uvw
+    p = _inputs(n)
+    x, y, z = xyz(p['ra'], p['dec'], p['dist'])
+    u, v, w = uvw(p['ra'], p['dec'], p['dist'], p['pmra'], p['pmdec'], p['rv'])
+    names = np.array(['Star {0}'.format(i) for i in range(n)], dtype=object)
+    return lambda: pd.DataFrame({'Name': names, 'X': x, 'Y': y, 'Z': z, 'U': u, 'V': v, 'W': w})
+
+
+@benchmark('components', max_size=100000)
+def bench_components(n):
+    # Figures, table, and embedding, as in app_file (the figures are reused after the first call)
+    import pandas as pd
+    from druvw import xyz, uvw
+    from plots import results_components
+
+    p = _inputs(n)
+    x, y, z = xyz(p['ra'], p['dec'], p['dist'])
+    u, v, w = uvw(p['ra'], p['dec'], p['dist'], p['pmra'], p['pmdec'], p['rv'])
+    data = pd.DataFrame({'Name': ['Star {0}'.format(i) for i in range(n)], 'X': x, 'Y': y, 'Z': z,
+                         'U': u, 'V': v, 'W': w})
+    return lambda: results_components(data, 'upload')
+
+
+# Function to time one benchmark
+def measure(setup, n):
+    """
+    :return: Dictionary with the best time of a run in seconds, the throughput in rows per second,
+        and the peak memory allocated during a run in MB (None if not available)
+    """
+
+    func = setup(n)
+    func()  # warm up (imports, caches)
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_TIME or number >= 1000:
+            break
+        number *= 10
+    best = min([elapsed] + timer.repeat(repeat=2, number=number)) / number
+
+    peak = None
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1] / 1024. ** 2
+        tracemalloc.stop()
+
+    return {'time': best, 'rows_per_s': n / best, 'peak_mb': peak}
+
+
+# Function to run the selected benchmarks
+def run(names=None, sizes=SIZES):
+    results = dict()
+    for name, setup, max_size in BENCHMARKS:
+        if names and name not in names:
+            continue
+        results[name] = dict()
+        for n in sizes:
+            if max_size is not None and n > max_size:
+                continue
+            try:
+                result = measure(setup, n)
+            except ImportError as e:  # e.g. bokeh not installed
+                print('{0:<16} skipped: {1}'.format(name, e))
+                break
+            results[name][str(n)] = result
+            peak = '' if result['peak_mb'] is None else '{0:10.1f} MB'.format(result['peak_mb'])
+            print('{0:<16} {1:>10} rows {2:12.6f} s {3:14.0f} rows/s {4}'.format(
+                name, n, result['time'], result['rows_per_s'], peak))
+    return results
+
+
+# Function to compare results with a baseline
+def compare(results, baseline, tolerance):
+    """
+    :return: List of messages describing regressions
+    """
+
+    regressions = []
+    for name, sizes in results.items():
+        for n, result in sizes.items():
+            base = baseline.get(name, {}).get(n)
+            if base is None:
+                continue
+            if result['time'] > base['time'] * (1 + tolerance):
+                regressions.append('{0} ({1} rows): {2:.3g} s, baseline {3:.3g} s'.format(
+                    name, n, result['time'], base['time']))
+            if result['peak_mb'] is not None and base.get('peak_mb') is not None and \
+                    result['peak_mb'] > base['peak_mb'] * (1 + tolerance) + 0.1:
+                regressions.append('{0} ({1} rows): {2:.1f} MB, baseline {3:.1f} MB'.format(
+                    name, n, result['peak_mb'], base['peak_mb']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default all): ' +
+                                                 ', '.join(b[0] for b in BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of rows')
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction of slowdown or memory growth reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.names, args.sizes)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+        print('No regressions')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,454 @@
+"""
+Load test of the web app: concurrent clients replay a mix of form posts and catalog uploads against a local
+instance and the throughput, latency percentiles, error rate, and memory of each server process are reported.
+
+The app is started with Simbad replaced by a local table (SIMBAD_LOCAL_TABLE) whose queries wait SIMBAD_LATENCY
+seconds, so that name resolution costs about what it costs in production without depending on Simbad:
+
+    python benchmarks/load_test.py --clients 8 --duration 30
+    python benchmarks/load_test.py --server gunicorn --workers 4 --rows 10000 --mix normal=4,upload=1
+    python benchmarks/load_test.py --url http://localhost:5000 --pid 1234
+
+Results can be saved and compared with a baseline like bench_kinematics.py (--save, --compare); the exit code
+is 1 if the throughput dropped, the 95th percentile latency grew, or the error rate grew beyond the tolerance.
+"""
+
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+try:
+    from urllib.parse import urlencode
+    from urllib.request import build_opener, HTTPCookieProcessor, Request
+    from urllib.error import HTTPError, URLError
+    from http.cookiejar import CookieJar
+except ImportError:  # Python 2
+    from urllib import urlencode
+    from urllib2 import build_opener, HTTPCookieProcessor, Request, HTTPError, URLError
+    from cookielib import CookieJar
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+APP_DIR = os.path.join(ROOT, 'kinematics_app')
+DEFAULT_MIX = 'query=2,normal=4,multi_rv=1,multi_dist=1,upload=1,simbad=1,save=1'
+COLUMNS = ['ra', 'dec', 'pmra', 'pmdec', 'rv', 'dist']  # columns of the uploaded catalogs, after the name
+SIMBAD_NAMES = 1000  # number of names in the local Simbad table
+ERROR_MARKER = b'<title>Error</title>'  # error pages are sent with status 200
+SCENARIOS = dict()
+
+
+# Decorator to register a scenario: a function of (client, rng) that makes one request
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+class Client(object):
+    """
+    A user of the app, with its own session cookie
+    """
+
+    def __init__(self, url, catalog, repeat):
+        self.url = url.rstrip('/')
+        self.catalog = catalog
+        self.repeat = repeat
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        self.has_result = False
+        self.inputs = dict()  # previous inputs of each scenario, to resend some of them
+
+    def request(self, path, data=None, files=None):
+        """
+        :param data: Dictionary of form fields, sent as a POST
+        :param files: Dictionary of field: (filename, bytes), sent as multipart/form-data with the fields
+
+        :return: Response body
+        """
+
+        headers = dict()
+        body = None
+        if files:
+            boundary = uuid.uuid4().hex
+            parts = []
+            for key, value in (data or {}).items():
+                parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"\r\n\r\n{2}\r\n'.format(
+                    boundary, key, value).encode('utf-8'))
+            for key, (filename, content) in files.items():
+                parts.append('--{0}\r\nContent-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+                             'Content-Type: text/csv\r\n\r\n'.format(boundary, key, filename).encode('utf-8'))
+                parts.append(content + b'\r\n')
+            parts.append('--{0}--\r\n'.format(boundary).encode('utf-8'))
+            body = b''.join(parts)
+            headers['Content-Type'] = 'multipart/form-data; boundary=' + boundary
+        elif data is not None:
+            body = urlencode(data).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        response = self.opener.open(Request(self.url + path, data=body, headers=headers), timeout=600)
+        content = response.read()
+        if ERROR_MARKER in content:
+            raise ValueError('error page')
+        return content
+
+    def form(self, name, rng, make):
+        # New inputs for a scenario, or with probability repeat the previous ones (served from the result store)
+        if name in self.inputs and rng.random_sample() < self.repeat:
+            return self.inputs[name]
+        self.inputs[name] = make()
+        return self.inputs[name]
+
+
+def _star(rng):
+    return {'ra': rng.uniform(0, 360), 'dec': rng.uniform(-90, 90), 'pmra': rng.normal(0, 100),
+            'pmdec': rng.normal(0, 100), 'rv': rng.normal(0, 20), 'dist': rng.uniform(10, 200)}
+
+
+@scenario('query')
+def run_query(client, rng):
+    client.request('/query')
+
+
+@scenario('normal')
+def run_normal(client, rng):
+    form = client.form('normal', rng, lambda: dict(_star(rng), type_flag='normal'))
+    client.request('/results', form)
+    client.has_result = True
+
+
+@scenario('multi_rv')
+def run_multi_rv(client, rng):
+    def make():
+        form = dict(_star(rng), type_flag='multi_rv', rv_step=1)
+        form['rv_ini'] = rng.uniform(-50, 0)
+        form['rv_fin'] = form['rv_ini'] + 50
+        return form
+    client.request('/results', client.form('multi_rv', rng, make))
+    client.has_result = True
+
+
+@scenario('multi_dist')
+def run_multi_dist(client, rng):
+    def make():
+        form = dict(_star(rng), type_flag='multi_dist', dist_step=1)
+        form['dist_ini'] = rng.uniform(10, 50)
+        form['dist_fin'] = form['dist_ini'] + 100
+        return form
+    client.request('/results', client.form('multi_dist', rng, make))
+    client.has_result = True
+
+
+@scenario('upload')
+def run_upload(client, rng):
+    # A row with a unique name makes each new upload a different file
+    def make():
+        star = _star(rng)
+        row = ','.join(['Load {0}'.format(uuid.uuid4().hex)] + [str(star[k]) for k in COLUMNS])
+        return client.catalog + (row + '\n').encode('utf-8')
+    client.request('/file_upload', files={'file': ('catalog.csv', client.form('upload', rng, make))})
+    client.has_result = True
+
+
+@scenario('simbad')
+def run_simbad(client, rng):
+    client.request('/simbad', {'name': 'Load {0}'.format(rng.randint(SIMBAD_NAMES))})
+
+
+@scenario('save')
+def run_save(client, rng):
+    # Saving needs results in the session
+    if not client.has_result:
+        run_normal(client, rng)
+    client.request('/save', {'format': 'csv'})
+
+
+# Function to write the local Simbad table and a catalog of a number of rows
+def make_inputs(directory, rows):
+    """
+    :return: Path of the Simbad table and contents of the catalog as bytes
+    """
+
+    rng = np.random.RandomState(42)
+    simbad = os.path.join(directory, 'simbad.csv')
+    with open(simbad, 'w') as f:
+        f.write('name,ra,dec,pmra,pmdec,rv,plx\n')
+        for i in range(SIMBAD_NAMES):
+            star = _star(rng)
+            f.write('Load {0},{1},{2},{3},{4},{5},{6}\n'.format(i, star['ra'], star['dec'], star['pmra'],
+                                                                 star['pmdec'], star['rv'], 1000. / star['dist']))
+
+    lines = [','.join(['name'] + COLUMNS)]
+    for i in range(rows):
+        star = _star(rng)
+        lines.append(','.join(['Star {0}'.format(i)] + [str(star[k]) for k in COLUMNS]))
+    return simbad, ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+# Function to start the app in a subprocess
+def start_server(args, directory, simbad):
+    """
+    :return: Popen of the server and its URL
+    """
+
+    env = dict(os.environ)
+    env.update({'SIMBAD_LOCAL_TABLE': simbad, 'SIMBAD_LATENCY': str(args.latency),
+                'SIMBAD_CACHE_PATH': '',  # every name is looked up, with the latency
+                'SECRET_KEY': 'load-test', 'PORT': str(args.port), 'PYTHONUNBUFFERED': '1',
+                'PYTHONPATH': os.pathsep.join([APP_DIR] + [p for p in [os.environ.get('PYTHONPATH')] if p])})
+    if args.workers > 1:  # results must be shared for /save to find them on any worker
+        env.setdefault('RESULT_STORE', 'sqlite')
+        env.setdefault('RESULT_STORE_PATH', os.path.join(directory, 'results.sqlite'))
+        env.setdefault('JOBS_STATUS', 'sqlite')
+        env.setdefault('JOBS_STATUS_PATH', os.path.join(directory, 'jobs.sqlite'))
+
+    if args.server == 'gunicorn':
+        command = ['gunicorn', '--bind', '127.0.0.1:{0}'.format(args.port),
+                   '--workers', str(args.workers), '--threads', str(args.threads), '--timeout', '600',
+                   'app:app']
+    else:
+        command = [sys.executable, os.path.join(ROOT, 'runapp.py')]
+    log = open(os.path.join(directory, 'server.log'), 'w')  # the access log would hide the report
+    server = subprocess.Popen(command, cwd=directory, env=env, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+
+    url = 'http://127.0.0.1:{0}'.format(args.port)
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if server.poll() is not None:
+            with open(os.path.join(directory, 'server.log')) as f:
+                raise RuntimeError('The server exited with code {0}:\n{1}'.format(server.returncode, f.read()))
+        try:
+            build_opener().open(url + '/query', timeout=5).read()
+            return server, url
+        except (URLError, IOError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('The server did not start in time')
+
+
+# Function to get the resident memory in MB of a process and its descendants (Linux only)
+def process_memory(pid):
+    """
+    :return: Dictionary of pid: MB, empty if /proc is not available
+    """
+
+    parents = dict()
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if entry.isdigit():
+            try:
+                with open('/proc/{0}/stat'.format(entry)) as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, OSError, IndexError, ValueError):  # the process exited
+                continue
+
+    pids = [pid]
+    for p in pids:
+        pids.extend(child for child, parent in parents.items() if parent == p)
+
+    memory = dict()
+    for p in pids:
+        try:
+            with open('/proc/{0}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        memory[p] = int(line.split()[1]) / 1024.
+        except (IOError, OSError):
+            continue
+    return memory
+
+
+# Function to sample the memory of the server until stopped
+def watch_memory(pid, stop, peaks, interval=0.5):
+    while not stop.is_set():
+        for p, mb in process_memory(pid).items():
+            peaks[p] = max(peaks.get(p, 0), mb)
+        stop.wait(interval)
+
+
+# Function to parse a mix such as normal=4,upload=1
+def parse_mix(text):
+    mix = dict()
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise ValueError('Unknown scenario: {0}, use {1}'.format(name, ', '.join(sorted(SCENARIOS))))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+# Function to run the clients for a duration
+def run(url, mix, clients, duration, catalog, repeat=0.0, seed=42):
+    """
+    :return: Dictionary of scenario: list of (latency in s, error message or None), and the elapsed time
+    """
+
+    names = sorted(mix)
+    weights = np.array([mix[name] for name in names]) / sum(mix.values())
+    samples = dict((name, []) for name in names)
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def work(i):
+        rng = np.random.RandomState(seed + i)
+        client = Client(url, catalog, repeat)
+        while time.time() < deadline:
+            name = names[rng.choice(len(names), p=weights)]
+            start = time.time()
+            error = None
+            try:
+                SCENARIOS[name](client, rng)
+            except HTTPError as e:
+                error = 'HTTP {0}'.format(e.code)
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            with lock:
+                samples[name].append((time.time() - start, error))
+
+    start = time.time()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.time() - start
+
+
+# Function to summarize the samples of each scenario and of all of them
+def summarize(samples, elapsed):
+    results = dict()
+    everything = [s for name in samples for s in samples[name]]
+    for name, values in list(samples.items()) + [('total', everything)]:
+        if not values:
+            continue
+        latency = np.array([t for t, _ in values])
+        errors = [e for _, e in values if e is not None]
+        p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+        results[name] = {'requests': len(values), 'throughput': len(values) / elapsed,
+                         'error_rate': len(errors) / len(values), 'p50': p50, 'p95': p95, 'p99': p99}
+        if errors:
+            results[name]['first_error'] = errors[0]
+    return results
+
+
+# Function to compare results with a baseline
+def compare(results, baseline, tolerance):
+    """
+    :return: List of messages describing regressions
+    """
+
+    regressions = []
+    for name, result in results.get('scenarios', {}).items():
+        base = baseline.get('scenarios', {}).get(name)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append('{0}: {1:.2f} requests/s, baseline {2:.2f}'.format(
+                name, result['throughput'], base['throughput']))
+        if result['p95'] > base['p95'] * (1 + tolerance):
+            regressions.append('{0}: p95 {1:.3f} s, baseline {2:.3f} s'.format(name, result['p95'], base['p95']))
+        if result['error_rate'] > base['error_rate'] + 0.01:
+            regressions.append('{0}: {1:.1%} errors, baseline {2:.1%}'.format(
+                name, result['error_rate'], base['error_rate']))
+    peak, base_peak = results.get('max_worker_mb'), baseline.get('max_worker_mb')
+    if peak is not None and base_peak is not None and peak > base_peak * (1 + tolerance):
+        regressions.append('worker memory: {0:.0f} MB, baseline {1:.0f} MB'.format(peak, base_peak))
+    return regressions
+
+
+def report(results):
+    print('{0:<12} {1:>9} {2:>10} {3:>8} {4:>9} {5:>9} {6:>9}'.format(
+        'scenario', 'requests', 'req/s', 'errors', 'p50 s', 'p95 s', 'p99 s'))
+    for name in sorted(results['scenarios'], key=lambda n: (n == 'total', n)):
+        r = results['scenarios'][name]
+        print('{0:<12} {1:>9} {2:>10.2f} {3:>8.1%} {4:>9.3f} {5:>9.3f} {6:>9.3f}'.format(
+            name, r['requests'], r['throughput'], r['error_rate'], r['p50'], r['p95'], r['p99']))
+    for name in sorted(results['scenarios']):
+        if 'first_error' in results['scenarios'][name]:
+            print('{0}: first error: {1}'.format(name, results['scenarios'][name]['first_error']))
+    for pid, mb in sorted(results['worker_mb'].items()):
+        print('process {0}: peak {1:.0f} MB'.format(pid, mb))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help='test a running app instead of starting one')
+    parser.add_argument('--pid', type=int, help='process id of the running app, to record its memory')
+    parser.add_argument('--server', choices=['flask', 'gunicorn'], default='flask',
+                        help='how to start the app: runapp.py (Flask development server) or gunicorn')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='gunicorn threads per worker')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--clients', type=int, default=4, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=20, help='seconds to run for')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weights of the scenarios, default ' + DEFAULT_MIX)
+    parser.add_argument('--rows', type=int, default=1000, help='rows of the uploaded catalogs')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds taken by each Simbad query')
+    parser.add_argument('--repeat', type=float, default=0.0,
+                        help='probability that a client resends its previous inputs of a scenario')
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction of throughput loss, latency, or memory growth reported as a regression')
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix)
+    directory = tempfile.mkdtemp(prefix='kinematics_load_')
+    server = None
+    try:
+        simbad, catalog = make_inputs(directory, args.rows)
+        if args.url:
+            url, pid = args.url, args.pid
+        else:
+            server, url = start_server(args, directory, simbad)
+            pid = server.pid
+
+        peaks, stop = dict(), threading.Event()
+        if pid is not None:
+            watcher = threading.Thread(target=watch_memory, args=(pid, stop, peaks))
+            watcher.daemon = True
+            watcher.start()
+
+        print('{0} clients for {1:.0f} s against {2}'.format(args.clients, args.duration, url))
+        samples, elapsed = run(url, mix, args.clients, args.duration, catalog, repeat=args.repeat)
+        stop.set()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results = {'scenarios': summarize(samples, elapsed), 'worker_mb': dict((str(p), mb) for p, mb in peaks.items()),
+               'max_worker_mb': max(peaks.values()) if peaks else None,
+               'options': {'server': 'external' if args.url else args.server, 'workers': args.workers,
+                           'threads': args.threads, 'clients': args.clients, 'mix': args.mix, 'rows': args.rows,
+                           'latency': args.latency, 'repeat': args.repeat}}
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            return 1
+        print('No regressions')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,334 @@
+"""
+JSON/binary API to calculate XYZ/UVW without building any plots or pages
+"""
+
+from flask import Blueprint, Response, current_app, request, session
+from druvw import xyz_array, uvw_array
+from sweep import sweep_range, sweep_table, SWEEP_PARAMETERS, SWEEP_COLUMNS
+import io
+import json
+import numpy as np
+import metrics
+
+api = Blueprint('api', __name__)
+
+INPUT_COLUMNS = ['ra', 'dec', 'dist', 'pmra', 'pmdec', 'rv']
+OUTPUT_COLUMNS = ['X', 'Y', 'Z', 'U', 'V', 'W']
+BINARY_TYPES = ['application/x-npy', 'application/octet-stream']
+MAX_NEIGHBORS = 10000  # maximum number of rows returned by the neighbor queries
+
+
+# Calculate XYZ/UVW for a single set of inputs, a sweep, a batch of stars, or a list of those
+@api.route('/api/v1/xyzuvw', methods=['POST'])
+def api_xyzuvw():
+    """
+    Inputs are either:
+      - JSON with ra, dec, dist, pmra, pmdec, rv as numbers or lists (one value per star), and optionally
+        ranges, a dictionary of parameter: list of values or {"ini": ..., "fin": ..., "step": ...} to sweep
+      - JSON with requests, a list of objects as above, which are answered in order
+      - a .npy file (Content-Type application/x-npy) with a structured array with the input columns,
+        or an array of shape (6, N) with the columns in the order ra, dec, dist, pmra, pmdec, rv
+
+    The query parameter format selects the output: json (default) or npy, a structured array.
+    The query parameter dtype selects float64 (default) or float32 for the calculation.
+    """
+
+    fmt = request.args.get('format', 'json')
+    if fmt not in ['json', 'npy']:
+        return error_response('Unknown format: ' + fmt)
+    try:
+        dtype = np.dtype(request.args.get('dtype', 'float64'))
+        if dtype not in [np.float64, np.float32]:
+            raise TypeError
+    except TypeError:
+        return error_response('dtype must be float64 or float32')
+
+    try:
+        if request.mimetype in BINARY_TYPES:
+            result = calculate(read_npy(request.get_data()), dtype=dtype)
+        else:
+            payload = request.get_json(force=True, silent=True)
+            if not isinstance(payload, dict):
+                raise ValueError('The request must be a JSON object')
+            if 'requests' in payload:
+                if fmt != 'json':
+                    raise ValueError('Lists of requests are only supported with the json format')
+                return calculate_list(payload['requests'], dtype)
+            result = calculate(payload, dtype=dtype)
+    except (ValueError, TypeError, KeyError) as e:
+        return error_response(str(e))
+
+    if fmt == 'npy':
+        return npy_response(result)
+    return json_response(result)
+
+
+# Function to calculate XYZ/UVW for one set of inputs
+def calculate(params, dtype=np.float64):
+    """
+    :param params: Dictionary with the INPUT_COLUMNS (numbers or arrays) and optionally ranges
+    :param dtype: Floating point type for the calculation
+
+    :return: Dictionary of column: array, or of column: number if all inputs were numbers
+    """
+
+    if not isinstance(params, dict):
+        raise ValueError('Each request must be a JSON object')
+
+    ranges = dict()
+    for param, values in (params.get('ranges') or {}).items():
+        if param not in SWEEP_PARAMETERS:
+            raise ValueError('Cannot sweep ' + param + ', only ' + ', '.join(SWEEP_PARAMETERS))
+        if isinstance(values, dict):
+            values = sweep_range(float(values['ini']), float(values['fin']), float(values['step']),
+                                 max_size=current_app.config['MAX_GRID_SIZE'])
+        ranges[param] = np.asarray(values, dtype=float).ravel()
+
+    missing = [col for col in INPUT_COLUMNS if col not in params and col not in ranges]
+    if missing:
+        raise ValueError('Missing inputs: ' + ', '.join(missing))
+
+    if ranges:
+        stars = dict((col, np.atleast_1d(np.asarray(params[col], dtype=float))) for col in INPUT_COLUMNS
+                     if col not in ranges)
+        with metrics.timer('xyz_uvw'):
+            table = sweep_table(stars, ranges, max_size=current_app.config['MAX_GRID_SIZE'])
+        metrics.count('rows_total', len(table), stage='api')
+        return dict((col, table[col].values.astype(dtype)) for col in table.columns)
+
+    values = np.broadcast_arrays(*[np.asarray(params[col], dtype=dtype) for col in INPUT_COLUMNS])
+    scalar = values[0].ndim == 0
+    if values[0].size > current_app.config['MAX_GRID_SIZE']:
+        raise ValueError('Too many inputs, the maximum is ' + str(current_app.config['MAX_GRID_SIZE']))
+
+    metrics.count('rows_total', values[0].size, stage='api')
+    parallel = getattr(current_app, 'parallel', None)
+    with metrics.timer('xyz_uvw'):
+        if parallel is not None and values[0].ndim == 1:
+            result = dict(zip(OUTPUT_COLUMNS, parallel.xyzuvw(*values, dtype=dtype)))
+        else:
+            x = xyz_array(values[0], values[1], values[2], dtype=dtype)
+            u = uvw_array(*values, dtype=dtype)
+            result = dict(zip(OUTPUT_COLUMNS, list(x) + list(u)))
+    if scalar:
+        result = dict((col, v[0]) for col, v in result.items())
+
+    return result
+
+
+# Best-fitting radial velocity or distance of stars for each moving group
+@api.route('/api/v1/bestfit', methods=['POST'])
+def api_bestfit():
+    """
+    Inputs are JSON with ra, dec, pmra, pmdec as numbers or lists (one value per star), fit, the parameter to find
+    (rv or dist), and the other one of rv and dist. The optional space selects the coordinates compared with the
+    groups: xyzuvw (default) or uvw.
+
+    For every group, the output has <RV or Dist>_<group> with the best value, Sigma_<group> with the distance to the
+    group at that value in units of its dispersions, and X_<group>, ..., W_<group> with XYZ-UVW at that value,
+    and groups has the names of the groups.
+    """
+
+    from bestfit import best_fit, FIT_PARAMETERS
+    from groups import NYMG
+
+    payload = request.get_json(force=True, silent=True)
+    try:
+        if not isinstance(payload, dict):
+            raise ValueError('The request must be a JSON object')
+        fit = payload.get('fit')
+        if fit not in FIT_PARAMETERS:
+            raise ValueError('fit must be one of ' + ', '.join(FIT_PARAMETERS))
+        columns = [col for col in INPUT_COLUMNS if col != fit]
+        missing = [col for col in columns if col not in payload]
+        if missing:
+            raise ValueError('Missing inputs: ' + ', '.join(missing))
+
+        values = np.broadcast_arrays(*[np.asarray(payload[col], dtype=float) for col in columns])
+        scalar = values[0].ndim == 0
+        stars = dict((col, v.ravel()) for col, v in zip(columns, values))
+        if stars['ra'].size * len(NYMG) > current_app.config['MAX_GRID_SIZE']:
+            raise ValueError('Too many inputs, the maximum is ' +
+                             str(current_app.config['MAX_GRID_SIZE'] // max(len(NYMG), 1)))
+
+        metrics.count('rows_total', stars['ra'].size, stage='api')
+        with metrics.timer('xyz_uvw'):
+            value, residual, predicted = best_fit(stars, fit, NYMG, space=payload.get('space', 'xyzuvw'))
+    except (ValueError, TypeError) as e:
+        return error_response(str(e))
+
+    result = {'groups': list(NYMG['name'].values)}
+    for g, name in enumerate(NYMG['name'].values):
+        result[SWEEP_COLUMNS[fit] + '_' + name] = value[:, g]
+        result['Sigma_' + name] = residual[:, g]
+        for c, col in enumerate(OUTPUT_COLUMNS):
+            result[col + '_' + name] = predicted[c, :, g]
+    if scalar:
+        result = dict((col, v if col == 'groups' else v[0]) for col, v in result.items())
+    return json_response(result)
+
+
+# Stars of a result set near a point: the k nearest, those within a radius, or those inside a box
+@api.route('/api/v1/results/<key>/<query>')
+def api_neighbors(key, query):
+    """
+    The key is that of a result set (as in /jobs/<id>/result), or current for the last results of the session.
+    The query parameter space selects the coordinates: xyz (default), uvw, or xyzuvw, where velocities are
+    converted to pc/Myr. The point is given by its coordinates (X=...&Y=...&Z=...), by the name of a star of
+    the results (star=...), or by the name of a moving group (group=...), whose center is used.
+
+      - knn: the k (default 10) nearest stars
+      - radius: the stars within r of the point
+      - box: the stars within r of the point in each coordinate, or between <coordinate>_min and <coordinate>_max
+
+    Rows are returned as JSON with the columns of the results, the row numbers, and the distances to the point,
+    at most limit (default and maximum MAX_NEIGHBORS) of them, sorted by distance; count is the number found.
+    """
+
+    from spatial import get_index, coordinates, SPACES
+
+    if query not in ['knn', 'radius', 'box']:
+        return error_response('Unknown query: ' + query + ', use knn, radius, or box', status=404)
+    if key == 'current':
+        key = session.get('result')
+    cached = current_app.results.get(key) if key else None
+    if cached is None:
+        return error_response('No results found, they may have expired', status=404)
+    data = cached['data']
+
+    try:
+        space = request.args.get('space', 'xyz')
+        index = get_index(key, data, space, store=current_app.results)
+        limit = min(int(request.args.get('limit', MAX_NEIGHBORS)), MAX_NEIGHBORS)
+        point = query_point(data, space) if query != 'box' or 'r' in request.args else None
+
+        k = int(request.args.get('k', 10))
+        r = float(request.args['r']) if 'r' in request.args else None
+        if k < 1 or limit < 0:
+            raise ValueError('k must be at least 1 and limit not negative')
+        if r is not None and not r >= 0:  # also rejects NaN
+            raise ValueError('r must be a non-negative number')
+
+        with metrics.timer('neighbors'):
+            if query == 'knn':
+                rows, distance = index.knn(point, min(k, MAX_NEIGHBORS))
+            elif query == 'radius':
+                if r is None:
+                    raise KeyError('r')
+                rows, distance = index.radius(point, r)
+            else:
+                if point is not None:
+                    lower, upper = point - r, point + r
+                else:
+                    lower = [float(request.args.get(col + '_min', '-inf')) for col in SPACES[space]]
+                    upper = [float(request.args.get(col + '_max', 'inf')) for col in SPACES[space]]
+                    lower, upper = coordinates(dict(zip(SPACES[space], np.array([lower, upper]).T)), space)
+                rows = index.box(lower, upper)
+                distance = None
+    except KeyError as e:
+        return error_response('Missing parameter: ' + str(e.args[0]))
+    except (ValueError, TypeError) as e:
+        return error_response(str(e))
+
+    result = dict((str(col), np.asarray(data[col].values)[rows[:limit]]) for col in data.columns)
+    result['row'] = rows[:limit]
+    if distance is not None:
+        result['distance'] = distance[:limit]
+    result['count'] = len(rows)
+    return json_response(result)
+
+
+# Function to get the point of a neighbor query from the query parameters
+def query_point(data, space):
+    """
+    :return: Coordinates of the point in the space of the index, ValueError if it is not found
+    """
+
+    from spatial import coordinates, SPACES
+
+    if 'star' in request.args:
+        if 'Name' not in data:
+            raise ValueError('These results have no names')
+        rows = np.flatnonzero(data['Name'].astype(str).values == request.args['star'])
+        if len(rows) == 0:
+            raise ValueError('Star not found: ' + request.args['star'])
+        return coordinates(data.iloc[rows[:1]], space)[0]
+    if 'group' in request.args:
+        from groups import NYMG
+        if request.args['group'] not in NYMG.index:
+            raise ValueError('Group not found: ' + request.args['group'])
+        return coordinates(NYMG.loc[[request.args['group']]], space)[0]
+    if space not in SPACES:
+        raise ValueError('Unknown space: ' + space)
+    return coordinates(dict((col, [float(request.args[col])]) for col in SPACES[space]), space)[0]
+
+
+# Function to answer a list of requests, limited in number and in the total number of rows
+def calculate_list(requests, dtype):
+    max_requests, max_rows = current_app.config['MAX_API_REQUESTS'], current_app.config['MAX_GRID_SIZE']
+    if not isinstance(requests, list):
+        return error_response('requests must be a list')
+    if len(requests) > max_requests:
+        return error_response('Too many requests, the maximum is ' + str(max_requests))
+
+    results, rows = [], 0
+    for params in requests:
+        results.append(calculate_safe(params, dtype))
+        rows += np.size(results[-1].get('X', []))  # nothing for errors
+        if rows > max_rows:  # each request is limited on its own, so at most twice this is calculated
+            return error_response('Too many rows in the requests, the maximum in total is ' + str(max_rows))
+    return json_response({'results': results})
+
+
+def calculate_safe(params, dtype):
+    # Errors in one request of a list are returned in its place instead of failing the others
+    try:
+        return calculate(params, dtype=dtype)
+    except (ValueError, TypeError, KeyError) as e:
+        return {'error': str(e)}
+
+
+# Function to read the inputs from the contents of a .npy file
+def read_npy(content):
+    arr = np.load(io.BytesIO(content), allow_pickle=False)
+    if arr.dtype.names is not None:
+        return dict((col, arr[col]) for col in INPUT_COLUMNS if col in arr.dtype.names)
+    if arr.ndim != 2 or arr.shape[0] != len(INPUT_COLUMNS):
+        raise ValueError('Arrays must have shape (6, N) or be structured arrays with named columns')
+    return dict(zip(INPUT_COLUMNS, arr))
+
+
+def _jsonable(value):
+    # Arrays as lists, with NaN (not valid in JSON) as null
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind == 'f' and not np.isfinite(value).all():
+            return [v if np.isfinite(v) else None for v in value.tolist()]
+        return value.tolist()
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    return value
+
+
+def json_response(result, status=200):
+    if 'results' in result:
+        content = {'results': [dict((k, _jsonable(v)) for k, v in r.items()) for r in result['results']]}
+    else:
+        content = dict((k, _jsonable(v)) for k, v in result.items())
+    return Response(json.dumps(content), status=status, mimetype='application/json')
+
+
+def npy_response(result):
+    columns = [col for col in ['Name', 'Dist', 'RV', 'pmRA', 'pmDec'] + OUTPUT_COLUMNS if col in result]
+    values = [np.atleast_1d(result[col]) for col in columns]
+    arr = np.empty(len(values[0]), dtype=[(str(col), v.dtype) for col, v in zip(columns, values)])
+    for col, v in zip(columns, values):
+        arr[col] = v
+    buf = io.BytesIO()
+    np.save(buf, arr)
+    return Response(buf.getvalue(), mimetype='application/x-npy')
+
+
+def error_response(message, status=400):
+    return Response(json.dumps({'error': message}), status=status, mimetype='application/json')
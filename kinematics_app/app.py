@@ -1,32 +1,145 @@
-from flask import Flask, redirect, render_template, request, make_response
-from druvw import xyz, uvw
-import pandas as pd
-from bokeh.plotting import figure, gridplot
-from bokeh.embed import components
-from bokeh.models import ColumnDataSource, HoverTool, DataTable, TableColumn, NumberFormatter
-from astroquery.simbad import Simbad
-import math, os
+import time
+START_TIME = time.time()  # for the startup report
+
+from flask import Flask, redirect, render_template, request, session, Response, stream_with_context, url_for
+from druvw import xyzuvw
+from store import make_store, input_key, stream_key
+from resolver import make_resolver
+from sweep import sweep_range, sweep_table, SWEEP_PARAMETERS
+from bestfit import fit_table, FIT_PARAMETERS
+from api import api
+from parallel import make_parallel
+from readers import binary_format, count_rows, BINARY_FORMATS, TableError
+from uncertainty import propagate, add_uncertainties, ERROR_COLUMNS, MODES
+import convergence
+import metrics
+from jobs import make_jobs, JobCancelled, QueueFull, FINISHED, DONE, FAILED
+import math, os, io, itertools, importlib, functools, json, threading, tempfile, shutil, hashlib
 import numpy as np
+from markupsafe import escape
+
+# pandas, bokeh (see plots.py), and astroquery (see resolver.py) take most of the startup time,
+# so they are imported by the routes that need them (only the first call pays for the import)
 
 app = Flask(__name__)
 
-# Global Variables
-app.vars = dict()
-app.vars['ra'] = '165.46627797'
-app.vars['dec'] = '-34.70473119'
-app.vars['pmra'] = '-66.19'
-app.vars['pmdec'] = '-13.90'
-app.vars['rv'] = '13.40'
-app.vars['dist'] = '53.7'
-app.vars['name'] = ''
-app.vars['rv_ini'] = ''
-app.vars['rv_fin'] = ''
-app.vars['rv_step'] = ''
-app.vars['dist_ini'] = ''
-app.vars['dist_fin'] = ''
-app.vars['dist_step'] = ''
-app.vars['data'] = pd.DataFrame()
+# Default values for the query form, the values entered by each user are kept in their session
+DEFAULT_VARS = dict()
+DEFAULT_VARS['ra'] = '165.46627797'
+DEFAULT_VARS['dec'] = '-34.70473119'
+DEFAULT_VARS['pmra'] = '-66.19'
+DEFAULT_VARS['pmdec'] = '-13.90'
+DEFAULT_VARS['rv'] = '13.40'
+DEFAULT_VARS['dist'] = '53.7'
+DEFAULT_VARS['name'] = ''
+DEFAULT_VARS['rv_ini'] = ''
+DEFAULT_VARS['rv_fin'] = ''
+DEFAULT_VARS['rv_step'] = ''
+DEFAULT_VARS['dist_ini'] = ''
+DEFAULT_VARS['dist_fin'] = ''
+DEFAULT_VARS['dist_step'] = ''
+DEFAULT_VARS['pmra_ini'] = ''
+DEFAULT_VARS['pmra_fin'] = ''
+DEFAULT_VARS['pmra_step'] = ''
+DEFAULT_VARS['pmdec_ini'] = ''
+DEFAULT_VARS['pmdec_fin'] = ''
+DEFAULT_VARS['pmdec_step'] = ''
+for key in ERROR_COLUMNS:  # uncertainties, all optional
+    DEFAULT_VARS[key] = ''
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # maximum size for uploads (16MB)
+MAX_SKIPPED = 50  # maximum number of skipped rows listed in the results page
+app.config['DENSITY_THRESHOLD'] = 20000  # number of rows above which plots show densities instead of points
+app.config['TABLE_MAX_ROWS'] = 5000  # number of rows shown in the table when plotting densities
+app.config['MAX_GRID_SIZE'] = 1000000  # maximum number of points in a parameter sweep
+app.config['MAX_API_REQUESTS'] = 1000  # maximum number of requests in a list sent to the API
+app.config['INLINE_MAX_ROWS'] = 1000  # number of rows above which the data of the page is sent separately
+app.config['TRANSPORT_FLOAT32'] = True  # whether data sent separately is sent in single precision
+
+# Store for calculated results, see store.make_store for the options
+for key in ['RESULT_STORE', 'RESULT_STORE_PATH', 'RESULT_STORE_TTL', 'RESULT_STORE_MAX_ITEMS',
+            'RESULT_STORE_MAX_BYTES']:
+    if key in os.environ:
+        app.config[key] = os.environ[key]
+app.results = make_store(app.config)
+
+# Simbad name resolution, see resolver.make_resolver for the options
+for key in ['SIMBAD_CACHE_PATH', 'SIMBAD_CACHE_TTL', 'SIMBAD_NEGATIVE_TTL', 'SIMBAD_LOCAL_TABLE', 'SIMBAD_LATENCY']:
+    if key in os.environ:
+        app.config[key] = os.environ[key]
+app.resolver = make_resolver(app.config)
+
+# Process pool for large calculations, see parallel.make_parallel for the options
+for key in ['PARALLEL_WORKERS', 'PARALLEL_CHUNK_ROWS', 'PARALLEL_MIN_ROWS', 'PARALLEL_TMPDIR']:
+    if key in os.environ:
+        app.config[key] = os.environ[key]
+app.parallel = make_parallel(app.config)
+
+# Directory of catalogs that can be processed by their path on the server instead of uploaded, disabled if empty
+app.config['LOCAL_DATA_DIR'] = os.environ.get('LOCAL_DATA_DIR', '')
+
+# Background jobs, see jobs.make_jobs for the options
+for key in ['JOBS_STATUS', 'JOBS_STATUS_PATH', 'JOBS_WORKERS', 'JOBS_MAX_QUEUED', 'JOBS_TTL']:
+    if key in os.environ:
+        app.config[key] = os.environ[key]
+app.jobs = make_jobs(app.config)
+
+# Monte Carlo propagation of uncertainties: samples per star, and memory for the samples of a chunk of stars
+app.config['UNCERTAINTY_SAMPLES'] = 1000
+app.config['UNCERTAINTY_MAX_BYTES'] = 64 * 1024 * 1024
+for key in ['UNCERTAINTY_SAMPLES', 'UNCERTAINTY_MAX_BYTES']:
+    if key in os.environ:
+        app.config[key] = int(os.environ[key])
+
+# Traceback to the moving groups: how far back in Myr, and the time between calculated positions
+app.config['TRACEBACK_TIME'] = convergence.DEFAULT_TIME
+app.config['TRACEBACK_STEP'] = convergence.DEFAULT_STEP
+for key in ['TRACEBACK_TIME', 'TRACEBACK_STEP']:
+    if key in os.environ:
+        app.config[key] = float(os.environ[key])
+
+# Timing of the stages of each request, see metrics.py
+for key in ['METRICS', 'METRICS_LOG']:
+    if key in os.environ:
+        app.config[key] = os.environ[key] not in ['', '0', 'false', 'False']
+metrics.configure(enabled=app.config.get('METRICS', False), log=app.config.get('METRICS_LOG', False))
+metrics.init_app(app)
+
+# Sessions need the same secret key on all workers
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)
+
+# Programmatic access, see api.py
+app.register_blueprint(api)
+
+# Modules imported by warm_up, in order
+LAZY_MODULES = ['pandas', 'groups', 'sweep', 'catalog', 'export', 'plots']
+
+
+# Function to import the modules that are otherwise loaded by the first request that needs them
+def warm_up():
+    """
+    :return: List of (module, seconds taken to import it)
+    """
+
+    timings = []
+    for module in LAZY_MODULES:
+        start = time.time()
+        importlib.import_module(module)
+        timings.append((module, time.time() - start))
+    app.logger.info('Warm-up: ' + ', '.join('{0} {1:.2f} s'.format(m, t) for m, t in timings))
+    return timings
+
+
+# WARM_UP=background imports them in a thread once the app is created, any other value before it is served
+app.config['WARM_UP'] = os.environ.get('WARM_UP', '')
+if app.config['WARM_UP'] == 'background':
+    warm_up_thread = threading.Thread(target=warm_up, name='warm_up')
+    warm_up_thread.daemon = True
+    warm_up_thread.start()
+elif app.config['WARM_UP']:
+    warm_up()
+
+app.startup_time = time.time() - START_TIME
+app.logger.info('Started in {0:.2f} s'.format(app.startup_time))
 
 
 # Redirect to the main page
@@ -41,164 +154,197 @@ def app_home():
 # Main page for queries
 @app.route('/query', methods=['GET', 'POST'])
 def app_query():
-    return render_template('query.html', ra=app.vars['ra'], dec=app.vars['dec'], pmra=app.vars['pmra'],
-                           pmdec=app.vars['pmdec'], rv=app.vars['rv'], dist=app.vars['dist'], name=app.vars['name'],
-                           rv_ini=app.vars['rv_ini'], rv_fin=app.vars['rv_fin'], rv_step=app.vars['rv_step'],
-                           dist_ini=app.vars['dist_ini'], dist_fin=app.vars['dist_fin'], dist_step=app.vars['dist_step'])
+    form_vars = get_vars()
+    return render_template('query.html', ra=form_vars['ra'], dec=form_vars['dec'], pmra=form_vars['pmra'],
+                           pmdec=form_vars['pmdec'], rv=form_vars['rv'], dist=form_vars['dist'], name=form_vars['name'],
+                           rv_ini=form_vars['rv_ini'], rv_fin=form_vars['rv_fin'], rv_step=form_vars['rv_step'],
+                           dist_ini=form_vars['dist_ini'], dist_fin=form_vars['dist_fin'],
+                           dist_step=form_vars['dist_step'], pmra_ini=form_vars['pmra_ini'],
+                           pmra_fin=form_vars['pmra_fin'], pmra_step=form_vars['pmra_step'],
+                           pmdec_ini=form_vars['pmdec_ini'], pmdec_fin=form_vars['pmdec_fin'],
+                           pmdec_step=form_vars['pmdec_step'],
+                           errors=dict((key, form_vars[key]) for key in ERROR_COLUMNS))
 
 
 # Calculate for known values
 @app.route('/results', methods=['GET', 'POST'])
 def app_results():
     # Grab the data
+    form_vars = get_vars()
     for key in request.form.keys():
-        if key == 'type_flag':
+        if key in ['type_flag', 'background', 'uncertainty', 'traceback', 'fit']:
             continue
-        app.vars[key] = request.form[key]
+        form_vars[key] = request.form[key]
+    set_vars(form_vars)
+
+    # Propagate the uncertainties (normal calculations only)
+    mode = request.form.get('uncertainty') if request.form['type_flag'] == 'normal' else None
+    if mode not in MODES:
+        mode = None
+    traceback = request.form.get('traceback') if request.form.get('traceback') in convergence.MODELS else None
+
+    # Parameters given as ranges
+    type_flag = request.form['type_flag']
+    swept = []
+    if type_flag == 'multi_rv':
+        swept = ['rv']
+    if type_flag == 'multi_dist':
+        swept = ['dist']
+    if type_flag == 'multi':  # any parameter with a range
+        swept = [p for p in SWEEP_PARAMETERS if form_vars[p + '_ini'] != '']
+
+    # Parameter replaced by its best-fitting value for each group
+    fit = None
+    if type_flag == 'fit':
+        fit = request.form.get('fit')
+        if fit not in FIT_PARAMETERS:
+            return render_template('error.html', headermessage='Error',
+                                   errmess='<p>Select the radial velocity or the distance to fit. </p>')
 
     # Convert to numbers
     df = dict()
-    for key in app.vars:
-        if key in ['name', 'data']: continue  # don't convert
+    for key in form_vars:
+        if key == 'name': continue  # don't convert
+
+        # Uncertainties are optional
+        if key in ERROR_COLUMNS:
+            if mode is None or form_vars[key] == '': continue
+            temp = number_convert(form_vars[key])
+            if math.isnan(temp) or temp < 0:
+                return render_template('error.html', headermessage='Error',
+                                       errmess='<p>Error converting uncertainty: ' + html_text(form_vars[key]) + ' (' + key +
+                                               ')' + '</p>')
+            df[key] = temp
+            continue
 
-        if request.form['type_flag'] == 'normal':
-            if key in ['rv_ini', 'rv_fin', 'rv_step', 'dist_ini', 'dist_fin', 'dist_step']: continue
-        if request.form['type_flag'] == 'multi_rv':
-            if key in ['rv', 'dist_ini', 'dist_fin', 'dist_step']: continue
-        if request.form['type_flag'] == 'multi_dist':
-            if key in ['dist', 'rv_ini', 'rv_fin', 'rv_step']: continue
+        # Use either the value or the range (the _ini, _fin, _step keys) of each parameter
+        param = key.rsplit('_', 1)[0]
+        if key == fit: continue
+        if key == param and param in swept: continue
+        if key != param and param not in swept: continue
 
-        temp = number_convert(app.vars[key])
+        temp = number_convert(form_vars[key])
         if math.isnan(temp):
             return render_template('error.html', headermessage='Error',
-                                   errmess='<p>Error converting number: ' + app.vars[key] + ' (' + key + ')' + '</p>')
+                                   errmess='<p>Error converting number: ' + html_text(form_vars[key]) + ' (' + key + ')' +
+                                           '</p>')
         else:
             df[key] = temp
 
+    # Identical inputs give identical results, so reuse them if they are still stored
+    result_key = input_key('results', type_flag, mode, traceback, fit, sorted(df.items()))
+    session['result'] = result_key
+    cached = app.results.get(result_key)
+    if cached is not None:
+        return cached['page']
+
+    # Large sweeps can be calculated in the background
+    if request.form.get('background') and swept:
+        return submit_job(result_key, functools.partial(calculate_results, traceback=traceback), result_key,
+                          type_flag, swept, df)
+
+    try:
+        return calculate_results(result_key, type_flag, swept, df, uncertainty=mode, traceback=traceback, fit=fit)
+    except CalculationError as e:
+        return error_page(e)
+
+
+# Function to calculate the results page for known values, which is saved in the result store
+def calculate_results(result_key, type_flag, swept, df, job=None, uncertainty=None, traceback=None, fit=None):
+    """
+    :param result_key: Key to save the results under
+    :param type_flag: Kind of calculation (normal, multi_rv, multi_dist, multi, or fit)
+    :param swept: Parameters given as ranges
+    :param df: Dictionary of the values (and ranges as _ini, _fin, _step) of the parameters, and their uncertainties
+    :param job: jobs.Job when run in the background, to report progress
+    :param uncertainty: Mode to propagate the uncertainties (analytic or montecarlo), None to ignore them
+    :param traceback: Model to trace the results back to the moving groups (linear or epicycle), None to skip it
+    :param fit: Parameter (rv or dist) to replace by its best-fitting value for each group, with type_flag fit
+
+    :return: Page with the results
+    """
+
+    import pandas as pd
+    from groups import add_membership
+    from plots import results_components
+
     # Calculate xyz, uvw
-    if request.form['type_flag'] == 'normal':
-        x, y, z = xyz(df['ra'], df['dec'], df['dist'])
-        u, v, w = uvw(df['ra'], df['dec'], df['dist'], df['pmra'], df['pmdec'], df['rv'])
-    if request.form['type_flag'] == 'multi_rv':
-        rv_array = np.arange(df['rv_ini'], df['rv_fin'], df['rv_step'])
-        if rv_array[-1] != df['rv_fin']:
-            rv_array = np.append(rv_array, df['rv_fin'])
-        arr_len = len(rv_array)
-        x, y, z = xyz([df['ra']] * arr_len,
-                      [df['dec']] * arr_len,
-                      [df['dist']] * arr_len)
-        u, v, w = uvw([df['ra']] * arr_len,
-                      [df['dec']] * arr_len,
-                      [df['dist']] * arr_len,
-                      [df['pmra']] * arr_len,
-                      [df['pmdec']] * arr_len,
-                      rv_array)
-    if request.form['type_flag'] == 'multi_dist':
-        dist_array = np.arange(df['dist_ini'], df['dist_fin'], df['dist_step'])
-        if dist_array[-1] != df['dist_fin']:
-            dist_array = np.append(dist_array, df['dist_fin'])
-        arr_len = len(dist_array)
-        x, y, z = xyz([df['ra']] * arr_len,
-                      [df['dec']] * arr_len,
-                      dist_array)
-        u, v, w = uvw([df['ra']] * arr_len,
-                      [df['dec']] * arr_len,
-                      dist_array,
-                      [df['pmra']] * arr_len,
-                      [df['pmdec']] * arr_len,
-                      [df['rv']] * arr_len)
-
-    if request.form['type_flag'] == 'normal':
-        data = pd.DataFrame({'X': [x], 'Y': [y], 'Z': [z], 'U': [u], 'V': [v], 'W': [w]})
-    if request.form['type_flag'] == 'multi_rv':
-        data = pd.DataFrame({'RV':rv_array, 'X': x, 'Y': y, 'Z': z, 'U': u, 'V': v, 'W': w})
-    if request.form['type_flag'] == 'multi_dist':
-        data = pd.DataFrame({'Dist': dist_array, 'X': x, 'Y': y, 'Z': z, 'U': u, 'V': v, 'W': w})
-
-    app.vars['data'] = data  # save in case user wants file output
+    with metrics.timer('xyz_uvw'):
+        if type_flag == 'normal':
+            # Resubmissions of a star with other distances or velocities reuse the basis of its position
+            x, y, z, u, v, w = xyzuvw(df['ra'], df['dec'], df['dist'], df['pmra'], df['pmdec'], df['rv'])
+            data = pd.DataFrame({'X': [x], 'Y': [y], 'Z': [z], 'U': [u], 'V': [v], 'W': [w]})
+            if uncertainty is not None:
+                with metrics.timer('uncertainty'):
+                    values = dict((key, np.array([df[key]])) for key in ['ra', 'dec'] + SWEEP_PARAMETERS)
+                    errors = dict((key, np.array([df[key]])) for key in ERROR_COLUMNS if key in df)
+                    try:
+                        mean, cov = propagate(values, errors, mode=uncertainty, **uncertainty_options())
+                    except ValueError as e:
+                        raise CalculationError('Error', '<p>' + html_text(e) + '</p>')
+                    add_uncertainties(data, mean, cov)
+        elif type_flag == 'fit':
+            star = dict((key, [df[key]]) for key in ['ra', 'dec'] + SWEEP_PARAMETERS if key != fit)
+            data = fit_table(star, fit)
+        else:
+            try:
+                ranges = dict((p, sweep_range(df[p + '_ini'], df[p + '_fin'], df[p + '_step'],
+                                              max_size=app.config['MAX_GRID_SIZE'])) for p in swept)
+                star = dict((key, [df[key]]) for key in ['ra', 'dec'] + SWEEP_PARAMETERS if key not in ranges)
+                data = sweep_table(star, ranges, max_size=app.config['MAX_GRID_SIZE'])
+            except ValueError as e:
+                raise CalculationError('Error', '<p>' + html_text(e) + '</p>')
+    metrics.count('rows_total', len(data), stage=type_flag)
+
+    # Best matching moving group
+    if job is not None:
+        job.progress(0.3, 'Matching {0} rows to the moving groups'.format(len(data)))
+    with metrics.timer('groups'):
+        add_membership(data)
+    if traceback is not None:
+        with metrics.timer('traceback'):
+            convergence.add_traceback(data, model=traceback, **traceback_options())
 
     # Figures
-    source = ColumnDataSource(data=data)
-    tools = "resize, pan, wheel_zoom, box_zoom, lasso_select, box_select, reset, save"
-    plot_size = 350
-    point_size = 10
-    point_color = 'black'
-
+    if job is not None:
+        job.progress(0.6, 'Drawing the plots')
     hover_flags = [True, True]  # for XYZ and for UVW plots
-    if request.form['type_flag'] == 'multi_rv':  # disable for multi_rv plots, but only for XYZ
+    if swept and 'dist' not in swept:  # disable for plots where XYZ does not change, but only for XYZ
         hover_flags[0] = False
+    script, div_dict, table_rows, payload = results_components(data, type_flag, hover_flags,
+                                                               **figure_options(data))
 
-    # Create the main plots
-    # XYZ Plots
-    p1 = my_plot('X', 'Y', source, 'X (pc)', 'Y (pc)', x_range=None, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[0])
-    p2 = my_plot('Y', 'Z', source, 'Y (pc)', 'Z (pc)', x_range=p1.y_range, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[0])
-    p3 = my_plot('X', 'Z', source, 'X (pc)', 'Z (pc)', x_range=p1.x_range, y_range=p2.y_range,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[0])
-
-    # UVW Plots
-    p4 = my_plot('U', 'V', source, 'U (km/s)', 'V (km/s)', x_range=None, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[1])
-    p5 = my_plot('V', 'W', source, 'V (km/s)', 'W (km/s)', x_range=p4.y_range, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[1])
-    p6 = my_plot('U', 'W', source, 'U (km/s)', 'W (km/s)', x_range=p4.x_range, y_range=p5.y_range,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag=request.form['type_flag'], hover_flag=hover_flags[1])
-
-    # Nearby Young Moving Groups
-    nymg_plot(p1, p2, p3, p4, p5, p6)
-
-    # Select table height
-    if len(data) > 1:
-        tabheight = 400
-    else:
-        tabheight = 100
+    with metrics.timer('render'):
+        page = render_template('results.html', script=script, div=div_dict, nrows=len(data),
+                               table_rows=table_rows, data_url=data_url(result_key, payload))
+    app.results.set(result_key, {'data': data, 'page': page, 'payload': payload})  # save for file output
 
-    columns = []
-    for col in data.columns:
-        if col in ['Dist', 'RV', 'Name']:
-            columns.append(TableColumn(field=col, title=col))
-        else:
-            columns.append(TableColumn(field=col, title=col, formatter=NumberFormatter(format='0.000')))
-    data_table = DataTable(source=source, columns=columns, row_headers=False, width=800, height=tabheight)
-
-    p = gridplot([[p1, p2, p3], [p4, p5, p6]], toolbar_location="left")
-    script, div_dict = components({'plot': p, 'table': data_table})
-
-    return render_template('results.html', script=script, div=div_dict)
+    return page
 
 
 # Called when you click Resolve on Simbad button
 @app.route('/simbad', methods=['GET', 'POST'])
 def app_simbad():
-    app.vars['name'] = request.form['name']
+    form_vars = get_vars()
+    form_vars['name'] = request.form['name']
+    set_vars(form_vars)
 
-    # Get the relevant information from Simbad
-    customSimbad = Simbad()
-    customSimbad.remove_votable_fields('coordinates')
-    customSimbad.add_votable_fields('ra(d)', 'dec(d)', 'pmra', 'pmdec', 'rv_value', 'plx')
-    simbad_query = customSimbad.query_object(app.vars['name'])
-
-    try:
-        df = simbad_query.to_pandas()
-    except AttributeError: # no result
+    # Get the relevant information from Simbad (or the cache)
+    result = app.resolver.resolve(form_vars['name'])
+    if result is None:  # no result
         return render_template('error.html', headermessage='Error',
-                                   errmess='<p>Error querying Simbad for: ' + app.vars['name'] + '</p>')
+                               errmess='<p>Error querying Simbad for: ' + html_text(form_vars['name']) + '</p>')
 
     # Clear and set values
-    clear_values()
-    app.vars['ra'] = df['RA_d'][0]
-    app.vars['dec'] = df['DEC_d'][0]
-    app.vars['pmra'] = df['PMRA'][0]
-    app.vars['pmdec'] = df['PMDEC'][0]
-    app.vars['rv'] = df['RV_VALUE'][0]
-    app.vars['dist'] = 1000./df['PLX_VALUE'][0]
+    form_vars = clear_values()
+    form_vars['ra'] = float(result['ra'])
+    form_vars['dec'] = float(result['dec'])
+    form_vars['pmra'] = float(result['pmra'])
+    form_vars['pmdec'] = float(result['pmdec'])
+    form_vars['rv'] = float(result['rv'])
+    plx = float(result['plx'])
+    form_vars['dist'] = 1000./plx if plx > 0 else ''  # left empty for missing or non-positive parallaxes
+    set_vars(form_vars)
 
     return redirect('/query')
 
@@ -212,151 +358,376 @@ def app_clear():
 
 @app.route('/file_upload', methods=['POST'])
 def app_file():
-    ALLOWED_EXTENSIONS = set(['txt', 'dat', 'csv', 'text'])
-
-    # Check if the post request has the file part
-    if 'file' not in request.files:
-        return redirect('/query')
+    ALLOWED_EXTENSIONS = set(['txt', 'dat', 'csv', 'text'] + list(BINARY_FORMATS))
+
+    # A file on the server, so that large catalogs do not have to be uploaded
+    path = request.form.get('path', '').strip()
+    if path:
+        try:
+            source = local_path(path)
+        except ValueError as e:
+            return render_template('error.html', headermessage='Error Loading File',
+                                   errmess='<p>' + html_text(e) + '</p>')
+        filename = source
+    else:
+        # Check if the post request has the file part
+        if 'file' not in request.files:
+            return redirect('/query')
 
-    file = request.files['file']
+        file = request.files['file']
+        source = file.stream
+        filename = file.filename
 
-    # Check if user did not select file
-    if file.filename == '':
-        return redirect('/query')
+        # Check if user did not select file
+        if file.filename == '':
+            return redirect('/query')
 
-    # Check that it's an ascii file
-    if not file.filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS:
+    # Check that it's an ascii file or a binary table
+    if '.' not in filename or not filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS:
         return render_template('error.html', headermessage='Error Loading File',
-                               errmess='<p>Only files ending in txt, dat, csv, or text are supported. </p>')
+                               errmess='<p>Only files ending in txt, dat, csv, or text, and FITS, HDF5, npy, npz, '
+                                       'or Parquet tables are supported. </p>')
+    fmt = binary_format(filename)
+
+    # Range of values to calculate for each target
+    ranges = dict()
+    sweep = request.form.get('sweep')
+    if sweep:
+        try:
+            ranges[sweep] = sweep_range(float(request.form['sweep_ini']), float(request.form['sweep_fin']),
+                                        float(request.form['sweep_step']), max_size=app.config['MAX_GRID_SIZE'])
+        except (KeyError, ValueError) as e:
+            return render_template('error.html', headermessage='Error Processing File',
+                                   errmess='<p>Check the range of values: ' + html_text(e) + '</p>')
+
+    # Parameter replaced by its best-fitting value for each group, instead of swept
+    fit = request.form.get('fit') or None
+    if fit is not None and (fit not in FIT_PARAMETERS or ranges):
+        return render_template('error.html', headermessage='Error Processing File',
+                               errmess='<p>Either fit the radial velocity or the distance, or give a range. </p>')
+
+    # Reuse the results if the same file was already processed
+    download = request.form.get('download')
+    resolve = bool(request.form.get('resolve'))
+    mode = request.form.get('uncertainty') if request.form.get('uncertainty') in MODES else None
+    traceback = request.form.get('traceback') if request.form.get('traceback') in convergence.MODELS else None
+    if not download:
+        if path:  # files on the server are identified by their path and modification time instead of read
+            contents = (source, os.path.getmtime(source), os.path.getsize(source))
+        else:
+            contents = stream_key(source)
+        result_key = input_key('file_upload', resolve, mode, traceback,
+                               sorted((p, r.tolist()) for p, r in ranges.items()), fmt, fit, contents)
+        session['result'] = result_key
+        cached = app.results.get(result_key)
+        if cached is not None:
+            return cached['page']
+
+    # Send the results straight to a file without building the plots
+    if download:
+        if not path:  # the upload is closed when the view returns, before the rest of the rows are streamed
+            upload, source = source, tempfile.TemporaryFile()
+            shutil.copyfileobj(upload, source)
+            source.seek(0)
+        stream = open_source(source, fmt)
+        try:
+            first, chunks = read_upload(stream, resolve, ranges, mode, traceback, fmt, fit)
+        except CalculationError as e:
+            if hasattr(stream, 'close'):
+                stream.close()
+            return error_page(e)
+        return stream_catalog(first, chunks, stream)
+
+    # Large files can be processed in the background, from a copy since the upload is closed with the request
+    if request.form.get('background'):
+        if not path:
+            source = io.BytesIO(source.read())
+        return submit_job(result_key, calculate_upload, source, result_key, resolve, ranges, mode, traceback, fmt,
+                          fit)
 
-    # Read file
     try:
-        df = pd.read_csv(file.stream, sep=',', header=0)
+        return calculate_upload(source, result_key, resolve, ranges, mode, traceback, fmt, fit)
+    except CalculationError as e:
+        return error_page(e)
+
+
+# Function to find a file in the directory of catalogs on the server
+def local_path(path):
+    """
+    :param path: Path relative to LOCAL_DATA_DIR
+
+    :return: Absolute path of the file, ValueError if reading files on the server is disabled,
+        the file does not exist, or it is outside of LOCAL_DATA_DIR
+    """
+
+    if not app.config['LOCAL_DATA_DIR']:
+        raise ValueError('Reading files on the server is disabled.')
+    root = os.path.realpath(app.config['LOCAL_DATA_DIR'])
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonprefix([full, root + os.sep]) != root + os.sep or not os.path.isfile(full):
+        raise ValueError('File not found: ' + path)
+    return full
+
+
+# Function to open a catalog given as a path, binary tables are opened by their readers
+def open_source(source, fmt):
+    if fmt is None and not hasattr(source, 'read'):
+        return open(source, 'rb')
+    return source
+
+
+# Function to start reading an uploaded catalog, the first chunk also checks the header
+def read_upload(stream, resolve, ranges, uncertainty=None, traceback=None, fmt=None, fit=None):
+    """
+    :return: First (DataFrame, skipped rows) chunk, generator of the other chunks
+    """
+
+    from catalog import process_catalog
+
+    if uncertainty is not None:
+        uncertainty = functools.partial(propagate, mode=uncertainty, **uncertainty_options())
+    if traceback is not None:
+        traceback = functools.partial(convergence.add_traceback, model=traceback, **traceback_options())
+    chunks = process_catalog(stream, resolver=app.resolver if resolve else None, ranges=ranges,
+                             parallel=app.parallel, uncertainty=uncertainty, traceback=traceback, fmt=fmt,
+                             fit=fit)
+    try:
+        first = next(chunks)
+    except TableError as e:
+        raise CalculationError('Error Processing File', '<p>' + html_text(e) + '. </p>')
+    except KeyError as e:
+        if e.args[0] == 'name':
+            raise CalculationError('Error Processing File',
+                                   '<p>A name, designation, or identifier column is required. </p>')
+        raise CalculationError('Error Processing File', '<p>Check that you provided all columns. </p>')
     except:
-        return render_template('error.html', headermessage='Error Processing File',
-                               errmess='<p>Check your input. </p>')
-
-    # Process the columns
-    columns = df.columns.tolist()
-    columns = [proc_columns(c) for c in columns]
-    df.columns = columns
+        raise CalculationError('Error Processing File', '<p>Check your input. </p>')
+
+    return first, chunks
+
+
+# Function to calculate the results page for an uploaded catalog, which is saved in the result store
+def calculate_upload(source, result_key, resolve, ranges, uncertainty=None, traceback=None, fmt=None, fit=None,
+                     job=None):
+    """
+    :param source: File-like object with the catalog, or its path
+    :param result_key: Key to save the results under
+    :param resolve: Whether to fill in missing values by resolving the names with Simbad
+    :param ranges: Dictionary of parameter: values to sweep for every target
+    :param uncertainty: Mode to propagate the uncertainty columns (analytic or montecarlo), None to ignore them
+    :param traceback: Model to trace the targets back to the moving groups (linear or epicycle), None to skip it
+    :param fmt: Format of a binary table, one of readers.BINARY_FORMATS, None for text
+    :param fit: Parameter (rv or dist) to replace by its best-fitting value for each group, None to use its values
+    :param job: jobs.Job when run in the background, to report progress
+
+    :return: Page with the results
+    """
+
+    import pandas as pd
+    from plots import results_components
+
+    # Position of the end of the file, or number of rows of binary tables, to report progress
+    stream = open_source(source, fmt)
+    if fmt is None:
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+    elif job is not None:
+        try:
+            size = count_rows(stream, fmt) * int(np.prod([len(r) for r in ranges.values()]))
+        except TableError as e:
+            raise CalculationError('Error Processing File', '<p>' + html_text(e) + '. </p>')
+        if hasattr(stream, 'seek'):
+            stream.seek(0)
+
+    first, chunks = read_upload(stream, resolve, ranges, uncertainty, traceback, fmt, fit)
 
     # Calculate the parameters
+    data_list, skipped = [], []
+    nrows = 0
     try:
-        x, y, z = xyz(df['ra'], df['dec'], df['dist'])
-        u, v, w = uvw(df['ra'], df['dec'], df['dist'], df['pmra'], df['pmdec'], df['rv'])
-    except KeyError:
-        return render_template('error.html', headermessage='Error Processing File',
-                               errmess='<p>Check that you provided all columns. </p>')
-    except ValueError:
-        return render_template('error.html', headermessage='Error Processing File',
-                               errmess='<p>Check that you provided numeric values for all columns '
-                                       '(except for the name column). </p>')
-
-    try:
-        data = pd.DataFrame({'Name': df['name'].tolist(), 'X': x, 'Y': y, 'Z': z, 'U': u, 'V': v, 'W': w})
-    except KeyError:
-        return render_template('error.html', headermessage='Error Processing File',
-                               errmess='<p>A name, designation, or identifier column is required. </p>')
+        for data, bad in itertools.chain([first], chunks):
+            data_list.append(data)
+            skipped.extend(bad)
+            nrows += len(data)
+            if nrows > app.config['MAX_GRID_SIZE']:
+                raise CalculationError('Error Processing File',
+                                       '<p>The results have more than ' + str(app.config['MAX_GRID_SIZE']) +
+                                       ' rows, select the option to download them as a file instead. </p>')
+            if job is not None:
+                done = stream.tell() if fmt is None else nrows + len(skipped)
+                job.progress(0.6 * done / max(size, 1), 'Calculated {0} rows'.format(nrows))
+    except (CalculationError, JobCancelled):
+        raise
+    except:
+        raise CalculationError('Error Processing File', '<p>Check your input. </p>')
+    finally:
+        if stream is not source:  # opened from a path
+            stream.close()
+    data = pd.concat(data_list, ignore_index=True)
 
-    app.vars['data'] = data  # save in case user wants file output
+    if len(data) == 0:
+        raise CalculationError('Error Processing File',
+                               '<p>Check that you provided numeric values for all columns '
+                               '(except for the name column). </p>')
 
     # Figures
-    source = ColumnDataSource(data=data)
-    tools = "resize, pan, wheel_zoom, box_zoom, lasso_select, box_select, reset, save"
-    plot_size = 350
-    point_size = 10
-    point_color = 'black'
+    if job is not None:
+        job.progress(0.6, 'Drawing the plots')
+    script, div_dict, table_rows, payload = results_components(data, 'upload', **figure_options(data))
+
+    with metrics.timer('render'):
+        page = render_template('results.html', script=script, div=div_dict, skipped=skipped[:MAX_SKIPPED],
+                               nskipped=len(skipped), nrows=len(data), table_rows=table_rows,
+                               data_url=data_url(result_key, payload))
+    app.results.set(result_key, {'data': data, 'page': page, 'payload': payload})  # save for file output
+
+    return page
+
+
+# Function to get the options of the figures of a results page
+def figure_options(data):
+    return dict(density_threshold=app.config['DENSITY_THRESHOLD'], table_max_rows=app.config['TABLE_MAX_ROWS'],
+                inline=len(data) <= app.config['INLINE_MAX_ROWS'], float32=app.config['TRANSPORT_FLOAT32'])
+
+
+# Function to get the address of the data of a results page, None if it is in the page
+def data_url(result_key, payload):
+    if payload is None:
+        return None
+    return url_for('app_results_data', result_key=result_key, v=payload_version(payload))
+
+
+# Function to identify the contents of a payload: the same inputs give other Bokeh ids in another process
+def payload_version(payload):
+    return hashlib.sha1(payload).hexdigest()
+
+
+# Data of the figures and table of a results page, which does not change for the same key and version
+@app.route('/results/<result_key>/data')
+def app_results_data(result_key):
+    cached = app.results.get(result_key)
+    if cached is None or cached.get('payload') is None:
+        return Response('No results found, they may have expired\n', status=404, mimetype='text/plain')
+
+    # Recalculated results (e.g. by another worker) do not match the ids of the page that asks for them
+    version = payload_version(cached['payload'])
+    if request.args.get('v', version) != version:
+        return Response('These results were recalculated, reload the page\n', status=404, mimetype='text/plain')
+
+    response = Response(cached['payload'], mimetype='application/octet-stream')
+    response.cache_control.public = True
+    response.cache_control.max_age = int(app.results.ttl)  # the version in the URL changes with the contents
+    response.set_etag(version)
+    return response.make_conditional(request)
+
+
+# Function to stream the results of a processed catalog as a csv file
+def stream_catalog(first, chunks, stream=None):
+    """
+    :param first: First (DataFrame, skipped rows) chunk
+    :param chunks: Generator of the other chunks
+    :param stream: File the chunks are read from, closed once they are all sent
+    """
+
+    def generate():
+        skipped = []
+        header = True
+        try:
+            for data, bad in itertools.chain([first], chunks):
+                skipped.extend(bad)
+                yield data.to_csv(None, index=False, header=header)
+                header = False
+        except (ValueError, KeyError, TypeError, IOError, OSError) as e:  # pandas parser errors are ValueErrors
+            app.logger.exception('Error streaming the results of a catalog')
+            yield '# Error reading the rest of the file, results are incomplete: {0}\n'.format(e)
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+        for line, message in skipped:
+            yield '# Skipped line {0}: {1}\n'.format(line, message)
+
+    response = Response(stream_with_context(generate()), mimetype='text/csv')
+    response.headers["Content-Disposition"] = "attachment; filename=results.txt"
+    return response
 
-    hover_flags = [True, True]  # for XYZ and for UVW plots
 
-    # Create the main plots
-    # XYZ Plots
-    p1 = my_plot('X', 'Y', source, 'X (pc)', 'Y (pc)', x_range=None, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[0])
-    p2 = my_plot('Y', 'Z', source, 'Y (pc)', 'Z (pc)', x_range=p1.y_range, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[0])
-    p3 = my_plot('X', 'Z', source, 'X (pc)', 'Z (pc)', x_range=p1.x_range, y_range=p2.y_range,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[0])
-
-    # UVW Plots
-    p4 = my_plot('U', 'V', source, 'U (km/s)', 'V (km/s)', x_range=None, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[1])
-    p5 = my_plot('V', 'W', source, 'V (km/s)', 'W (km/s)', x_range=p4.y_range, y_range=None,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[1])
-    p6 = my_plot('U', 'W', source, 'U (km/s)', 'W (km/s)', x_range=p4.x_range, y_range=p5.y_range,
-                 point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
-                 type_flag='upload', hover_flag=hover_flags[1])
-
-    # Nearby Young Moving Groups
-    nymg_plot(p1, p2, p3, p4, p5, p6)
-
-    # Select table height
-    if len(data) > 1:
-        tabheight = 400
-    else:
-        tabheight = 100
+# TODO: Access bdnyc database functionality
 
-    columns = []
-    for col in data.columns:
-        if col in ['Dist', 'RV', 'Name']:
-            columns.append(TableColumn(field=col, title=col))
-        else:
-            columns.append(TableColumn(field=col, title=col, formatter=NumberFormatter(format='0.000')))
-    data_table = DataTable(source=source, columns=columns, row_headers=False, width=800, height=tabheight)
 
-    p = gridplot([[p1, p2, p3], [p4, p5, p6]], toolbar_location="left")
-    script, div_dict = components({'plot': p, 'table': data_table})
+# Function to get the form values of the current session
+def get_vars():
+    form_vars = dict(DEFAULT_VARS)
+    form_vars.update(session.get('vars', {}))
+    return form_vars
 
-    return render_template('results.html', script=script, div=div_dict)
 
-    # return df.to_html()
+# Function to save the form values of the current session
+def set_vars(form_vars):
+    session['vars'] = form_vars
 
 
-# Function to process columns
-def proc_columns(col):
-    col = col.lower().strip()
+# Function to clear values
+def clear_values():
+    form_vars = dict((key, '') for key in DEFAULT_VARS)
+    set_vars(form_vars)
+    return form_vars
 
-    # Check if a name column:
-    if col in ['name', 'designation', 'object', 'object_name', 'object name', 'target', 'target name', 'target_name',
-               'identifier', 'id', 'objid', 'obj_id', 'obj id', 'source', 'source id', 'source_id']:
-        return 'name'
 
-    # Check if ra/dec
-    if col in ['ra', 'ra2000', 'ra_2000', 'raj2000', 'ra_j2000']:
-        return 'ra'
-    if col in ['dec', 'dec2000', 'dec_2000', 'decj2000', 'dec_j2000',
-               'de', 'de2000', 'de_2000', 'dej2000', 'de_j2000']:
-        return 'dec'
+# Error in a calculation, shown to the user
+# Function to show text in an error page, whose message is HTML: user input and error messages are escaped
+def html_text(value):
+    return str(escape(str(value)))
 
-    # Check pmra/pmdec
-    if col in ['pmra', 'mura', 'mualpha', 'pmalpha', 'pm_ra', 'mu_ra']:
-        return 'pmra'
-    if col in ['pmdec', 'mudec', 'mudelta', 'pmdelta', 'pm_dec', 'mu_dec', 'pmde', 'mude', 'pm_de', 'mude']:
-        return 'pmdec'
 
-    # Check rv and distance
-    if col in ['rv', 'radial velocity', 'radial_velocity', 'velocity', 'v']:
-        return 'rv'
+class CalculationError(Exception):
+    def __init__(self, headermessage, errmess):
+        Exception.__init__(self, errmess)
+        self.headermessage = headermessage
+        self.errmess = errmess
 
-    if col in ['dist', 'd', 'distance']:
-        return 'dist'
 
-    return col
+# Function to show the error page for a CalculationError
+def error_page(e):
+    return render_template('error.html', headermessage=e.headermessage, errmess=e.errmess)
 
 
-# TODO: Access bdnyc database functionality
+# Function to run a calculation in the background and send the user to its progress page
+def submit_job(result_key, func, *args):
+    """
+    :param result_key: Key under which func saves the results
+    :param func: Function that calculates and saves a results page, called with args and the job
+    """
 
+    base_url = request.url_root
 
-# Function to clear values
-def clear_values():
-    for key in app.vars.keys():
-        app.vars[key] = ''
+    def run(job):
+        # Pages are rendered outside of the request, with the same URLs
+        with app.test_request_context(base_url=base_url):
+            try:
+                func(*args, job=job)
+            except (CalculationError, JobCancelled):
+                raise
+            except Exception:
+                app.logger.exception('Background calculation failed')
+                raise CalculationError('Error', '<p>The calculation failed. Check your input. </p>')
+        return result_key
+
+    try:
+        job_id = app.jobs.submit(run)
+    except QueueFull as e:
+        return render_template('error.html', headermessage='Error', errmess='<p>' + html_text(e) + '. </p>')
+    return redirect(url_for('app_job', job_id=job_id))
+
+
+# Function to get the options of the Monte Carlo propagation of uncertainties
+def uncertainty_options():
+    return dict(samples=int(app.config['UNCERTAINTY_SAMPLES']), max_bytes=int(app.config['UNCERTAINTY_MAX_BYTES']))
+
+
+# Function to get the options of the traceback to the moving groups
+def traceback_options():
+    return dict(time=float(app.config['TRACEBACK_TIME']), step=float(app.config['TRACEBACK_STEP']))
 
 
 # Function to convert to numbers and have proper error handling
@@ -368,109 +739,82 @@ def number_convert(x):
     return val
 
 
-# TODO: See if it's possible to configure NYMG ovals as something that can be toggled on/off in Bokeh
-# Function to plot the NYMG ovals
-def nymg_plot(p1,p2,p3,p4,p5,p6):
-    g_name = ['bPMG', 'TWA', 'THA', 'COL', 'CAR', 'ARG', 'ABDMG']
-    g_U = [-10.94, -9.95, -9.88, -12.24, -10.34, -21.78, -7.12]
-    g_Ue = np.array([2.06, 4.02, 1.51, 1.03, 1.28, 1.32, 1.39])
-    g_V = [-16.25, -17.91, -20.7, -21.32, -22.31, -12.08, -27.31]
-    g_Ve = np.array([1.3, 1.75, 1.87, 1.18, 0.58, 1.97, 1.31])
-    g_W = [-9.27, -4.65, -0.9, -5.58, -5.91, -4.52, -13.81]
-    g_We = np.array([1.54, 2.57, 1.31, 0.89, 0.11, 0.5, 2.16])
-    g_X = [9.27, 12.49, 11.39, -27.44, 15.55, 14.6, -2.37]
-    g_Xe = np.array([31.71, 7.08, 19.29, 13.79, 5.66, 18.6, 20.03])
-    g_Y = [-5.96, -42.28, -21.21, -31.32, -58.53, -24.67, 1.48]
-    g_Ye = np.array([15.19, 7.33, 9.17, 20.55, 16.69, 19.06, 18.83])
-    g_Z = [-13.59, 21.55, -35.4, -27.97, -22.95, -6.72, -15.62]
-    g_Ze = np.array([8.22, 4.2, 5.39, 15.09, 2.74, 11.43, 16.59])
-
-    # TODO: Decide on final colors for groups
-    # g_color = ['blue', 'green', 'red', 'yellow', 'magenta', 'cyan', 'grey']
-    # g_color = ['#7fc97f','#beaed4','#fdc086','#ffff99','#386cb0','#f0027f','#bf5b17'] #Accent
-    # g_color = ['#1b9e77','#d95f02','#7570b3','#e7298a','#66a61e','#e6ab02','#a6761d'] #Dark2
-    g_color = ['#0000CD', '#FF0000', '#008000', '#FF00FF', '#7FFFD4', '#9400D3', '#FF8C00']  # From Faherty paper
-
-    # Hover does not work for Oval :(
-    p1.oval(x=g_X, y=g_Y, width=g_Xe * 2, height=g_Ye * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-    # p1.text(x=g_X, y=g_Y, text=g_name, text_color='black', angle=0, text_alpha=0.5)
-    y_text_loc = [40 - y*6 for y in range(len(g_name))]
-    p1.text(x=-60, y=y_text_loc, text=g_name, text_color=g_color, angle=0, text_font_size='8pt')
-
-    p2.oval(x=g_Y, y=g_Z, width=g_Ye * 2, height=g_Ze * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-
-    p3.oval(x=g_X, y=g_Z, width=g_Xe * 2, height=g_Ze * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-
-    p4.oval(x=g_U, y=g_V, width=g_Ue * 2, height=g_Ve * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-    # p4.text(x=g_U, y=g_V, text=g_name, text_color='black', angle=0, text_alpha=0.5)
-    y_text_loc = [-20 - y*1.2 for y in range(len(g_name))]
-    p4.text(x=-25, y=y_text_loc, text=g_name, text_color=g_color, angle=0, text_font_size='8pt')
-
-    p5.oval(x=g_V, y=g_W, width=g_Ve * 2, height=g_We * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-
-    p6.oval(x=g_U, y=g_W, width=g_Ue * 2, height=g_We * 2, color=g_color,
-            angle=0, height_units='data', width_units='data', fill_alpha=0.5)
-
-    # Update grid alpha
-    for p in [p1, p2, p3, p4, p5, p6]:
-        p.xgrid.grid_line_alpha = 0.2
-        p.ygrid.grid_line_alpha = 0.2
-
-    return
-
-
-# Function to make the basic plots
-def my_plot(xvar, yvar, source, xlabel, ylabel, point_size=10,
-            point_color='black', plot_size=350, tools="resize, pan, wheel_zoom, box_zoom, reset",
-            x_range=None, y_range=None, type_flag='normal', hover_flag=True):
-
-    p = figure(width=plot_size, plot_height=plot_size, title=None, tools=tools, x_range=x_range, y_range=y_range)
-    p.scatter(xvar, yvar, source=source, size=point_size, color=point_color)
-    p.xaxis.axis_label = xlabel
-    p.yaxis.axis_label = ylabel
-
-    if type_flag == "normal":
-        tooltip = {"(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
-    if type_flag == 'multi_rv':
-        tooltip = {"RV": "@RV", "(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
-    if type_flag == 'multi_dist':
-        tooltip = {"Dist": "@Dist", "(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
-    if type_flag == 'upload':
-        # this format preserves order
-        tooltip = [("Name", "@Name"), ("(X,Y,Z)", "(@X, @Y, @Z)"), ("(U,V,W)", "(@U, @V, @W)")]
-
-    if hover_flag:
-        p.add_tools(HoverTool(tooltips=tooltip))
-
-    return p
-
-
 # Function to save calculated values
 @app.route('/save', methods=['GET', 'POST'])
 def app_save():
+    from export import export_table
+
     export_fmt = request.form['format']
-    data = app.vars['data']
-
-    if export_fmt == 'csv':
-        filename = 'results.txt'
-        data.to_csv(filename, index=False)
-    elif export_fmt == 'html':
-        filename = 'results.html'
-        data.to_html(filename, index=False)
-    elif export_fmt == 'ascii':
-        filename = 'results.txt'
-        data.to_csv(filename, sep=' ', index=False)
-
-    with open(filename, 'r') as f:
-        file_as_string = f.read()
-    os.remove(filename)  # Delete the file after it's read
-
-    response = make_response(file_as_string)
+
+    cached = app.results.get(session['result']) if 'result' in session else None
+    if cached is None:
+        return render_template('error.html', headermessage='Error Saving File',
+                               errmess='<p>No results found, they may have expired. Please calculate them again. </p>')
+    data = cached['data']
+
+    try:
+        stream, filename, mimetype = export_table(data, export_fmt, compress=bool(request.form.get('gzip')))
+    except ValueError as e:
+        return render_template('error.html', headermessage='Error Saving File',
+                               errmess='<p>' + html_text(e) + '</p>')
+
+    response = Response(stream, mimetype=mimetype)
     response.headers["Content-Disposition"] = "attachment; filename=%s" % filename
     return response
 
+
+# Progress of a background job, as a page that reloads itself or as JSON with ?format=json
+@app.route('/jobs/<job_id>')
+def app_job(job_id):
+    job = app.jobs.get(job_id)
+    if request.args.get('format') == 'json':
+        if job is None:
+            return Response(json.dumps({'error': 'Unknown job'}), status=404, mimetype='application/json')
+        return Response(json.dumps(job), mimetype='application/json')
+
+    if job is None:
+        return render_template('error.html', headermessage='Error',
+                               errmess='<p>Job not found, it may have expired. Please calculate the results again. </p>')
+    if job['state'] == DONE:
+        return redirect(url_for('app_job_result', job_id=job_id))
+    if job['state'] == FAILED:
+        return render_template('error.html', headermessage='Error', errmess=job['error'])
+    return render_template('job.html', job=job, finished=job['state'] in FINISHED)
+
+
+# Cancel a background job
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def app_job_cancel(job_id):
+    app.jobs.cancel(job_id)
+    if request.args.get('format') == 'json':
+        return Response(json.dumps(app.jobs.get(job_id)), mimetype='application/json')
+    return redirect(url_for('app_job', job_id=job_id))
+
+
+# Results of a background job: the results page, or a file with ?format= (any of the formats of /save)
+@app.route('/jobs/<job_id>/result')
+def app_job_result(job_id):
+    from export import export_table
+
+    job = app.jobs.get(job_id)
+    if job is None or job['state'] != DONE:
+        return redirect(url_for('app_job', job_id=job_id))
+
+    cached = app.results.get(job['result'])
+    if cached is None:
+        return render_template('error.html', headermessage='Error',
+                               errmess='<p>No results found, they may have expired. Please calculate them again. </p>')
+    session['result'] = job['result']  # for the Save button of the page
+
+    export_fmt = request.args.get('format')
+    if not export_fmt:
+        return cached['page']
+    try:
+        stream, filename, mimetype = export_table(cached['data'], export_fmt, compress=bool(request.args.get('gzip')))
+    except ValueError as e:
+        return render_template('error.html', headermessage='Error Saving File',
+                               errmess='<p>' + html_text(e) + '</p>')
+
+    response = Response(stream, mimetype=mimetype)
+    response.headers["Content-Disposition"] = "attachment; filename=%s" % filename
+    return response
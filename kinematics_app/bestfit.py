@@ -0,0 +1,148 @@
+"""
+Best-fitting radial velocity or distance of stars for each moving group.
+
+With the position and proper motions fixed, XYZ and UVW are affine functions of the radial velocity, and also of
+the distance (see druvw.xyzuvw_from_basis), x(t) = a + b t. The squared distance to a group in units of its
+dispersions, sum(w (a + b t - mean)**2) with w = 1 / dispersion**2, is then a parabola in t whose minimum is at
+
+    t = sum(w b (mean - a)) / sum(w b**2)
+
+so the best value for every star and every group is found with a few matrix products instead of a sweep.
+"""
+
+from druvw import cached_basis, k
+from sweep import SWEEP_COLUMNS
+import numpy as np
+
+FIT_PARAMETERS = ['rv', 'dist']
+COORDINATES = ['X', 'Y', 'Z', 'U', 'V', 'W']
+FIT_SPACES = {'xyzuvw': COORDINATES, 'uvw': ['U', 'V', 'W']}  # coordinates whose distance to the groups is used
+CHUNK_SIZE = 65536  # number of stars fitted at a time by fit_table
+
+
+# Function to write XYZ-UVW as a + b * value of the fitted parameter
+def affine_terms(stars, param):
+    """
+    :param stars: DataFrame or dictionary of 1-D arrays with ra, dec, pmra, pmdec, and dist or rv
+        (whichever is not fitted)
+    :param param: Parameter to fit, rv or dist
+
+    :return: Arrays a and b of shape (6, N)
+    """
+
+    if param not in FIT_PARAMETERS:
+        raise ValueError('Cannot fit {0}, only {1}'.format(param, ', '.join(FIT_PARAMETERS)))
+
+    p, r, ra, de = cached_basis(np.asarray(stars['ra'], dtype=float), np.asarray(stars['dec'], dtype=float))
+    pmra, pmdec = [np.asarray(stars[col], dtype=float) for col in ['pmra', 'pmdec']]
+    tangential = (ra * pmra + de * pmdec) * (k / 1000.)  # UVW per parsec of distance
+    if param == 'rv':
+        d = np.asarray(stars['dist'], dtype=float)
+        a = np.concatenate([p * d, tangential * d])
+        b = np.concatenate([np.zeros_like(p), r])
+    else:
+        a = np.concatenate([np.zeros_like(p), r * np.asarray(stars['rv'], dtype=float)])
+        b = np.concatenate([p, tangential])
+    return a, b
+
+
+# Function to find the best value of a parameter for every star and every group
+def best_fit(stars, param, groups=None, space='xyzuvw', chunk_size=CHUNK_SIZE):
+    """
+    Stars are processed in chunks of chunk_size, so that the temporary arrays of the fit stay the size of a chunk.
+
+    :param stars: DataFrame or dictionary of 1-D arrays with ra, dec, pmra, pmdec, and dist or rv
+    :param param: Parameter to fit, rv (km/s) or dist (pc)
+    :param groups: DataFrame of groups, as returned by groups.load_groups, None for the default groups
+    :param space: xyzuvw to fit the distance to the groups in XYZ and UVW, or uvw for UVW only
+    :param chunk_size: Number of stars to fit at a time
+
+    :return: Arrays of shape (N, number of groups) with the best value and the distance to the group at that
+        value in units of its dispersions (NaN for stars with missing values and distances that would be negative),
+        and array of shape (6, N, number of groups) with the XYZ-UVW at the best value
+    """
+
+    if groups is None:
+        from groups import NYMG as groups
+    if space not in FIT_SPACES:
+        raise ValueError('Unknown space: {0}, use one of {1}'.format(space, ', '.join(sorted(FIT_SPACES))))
+
+    used = np.array([col in FIT_SPACES[space] for col in COORDINATES])
+    mean = groups[COORDINATES].values.T  # (6, G)
+    inv_var = used[:, None] / groups[['e' + c for c in COORDINATES]].values.T ** 2
+    mean_inv_var = mean * inv_var
+    mean_d2 = (mean ** 2 * inv_var).sum(axis=0)
+
+    columns = [col for col in ['ra', 'dec', 'pmra', 'pmdec', 'dist', 'rv'] if col in stars and col != param]
+    inputs = dict(zip(columns, np.broadcast_arrays(*[np.atleast_1d(np.asarray(stars[col], dtype=float))
+                                                     for col in columns])))
+    n = len(inputs['ra'])
+    value = np.empty((n, mean.shape[1]))
+    residual = np.empty((n, mean.shape[1]))
+    predicted = np.empty((6, n, mean.shape[1]))
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        a, b = affine_terms(dict((col, v[i:j]) for col, v in inputs.items()), param)
+
+        # Each sum over the coordinates is a product of a (N, 6) and a (6, G) matrix
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = np.dot(b.T, mean_inv_var) - np.dot((a * b).T, inv_var)
+            den = np.dot((b ** 2).T, inv_var)
+            val = num / den
+            d2 = np.dot((a ** 2).T, inv_var) - 2 * np.dot(a.T, mean_inv_var) + mean_d2
+            res = np.sqrt(np.maximum(d2 - num * val, 0))
+
+        if param == 'dist':
+            negative = ~(val > 0)
+            val[negative] = np.nan
+            res[negative] = np.nan
+
+        value[i:j], residual[i:j] = val, res
+        predicted[:, i:j] = a[:, :, None] + b[:, :, None] * val[None]
+    return value, residual, predicted
+
+
+# Function to fit a parameter for a table of stars
+def fit_table(stars, param, groups=None, space='xyzuvw', chunk_size=CHUNK_SIZE):
+    """
+    Same as best_fit, but returns a table with one row per star. The fitted parameter and X, Y, Z, U, V, W are those
+    of the group that fits best, and the columns <parameter>_<group> and Sigma_<group> give the best value and the
+    distance at that value in units of the dispersions for every group.
+
+    :return: DataFrame with a Name column (if stars has one), the fitted parameter (RV or Dist), X, Y, Z, U, V, W,
+        and the columns of every group
+    """
+
+    import pandas as pd  # only imported when needed, see the note in app.py
+
+    if groups is None:
+        from groups import NYMG as groups
+    names = groups['name'].values
+    col = SWEEP_COLUMNS[param]
+    n = len(stars['ra'])
+
+    best_value = np.full(n, np.nan)
+    best_xyzuvw = np.full((6, n), np.nan)
+    value, residual = np.full((n, len(names)), np.nan), np.full((n, len(names)), np.nan)
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        chunk = dict((key, np.asarray(stars[key])[i:j]) for key in ['ra', 'dec', 'pmra', 'pmdec', 'dist', 'rv']
+                     if key in stars and key != param)
+        value[i:j], residual[i:j], predicted = best_fit(chunk, param, groups, space)
+
+        if len(names):
+            rows = np.arange(j - i)
+            best = np.argmin(np.where(np.isnan(residual[i:j]), np.inf, residual[i:j]), axis=1)
+            best_value[i:j] = value[i:j][rows, best]
+            best_xyzuvw[:, i:j] = predicted[:, rows, best]
+
+    data = pd.DataFrame()
+    if 'name' in stars:
+        data['Name'] = np.asarray(stars['name'])
+    data[col] = best_value
+    for c, coordinate in enumerate(COORDINATES):
+        data[coordinate] = best_xyzuvw[c]
+    for g, name in enumerate(names):
+        data[col + '_' + name] = value[:, g]
+        data['Sigma_' + name] = residual[:, g]
+    return data
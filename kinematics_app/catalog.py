@@ -0,0 +1,268 @@
+"""
+Functions to read and process uploaded catalogs in chunks
+"""
+
+from druvw import xyz, uvw
+from sweep import sweep_table
+from bestfit import fit_table
+from groups import add_membership
+from uncertainty import corr_column, add_uncertainties, has_errors, ERROR_COLUMNS
+import metrics
+import pandas as pd
+import numpy as np
+
+CHUNK_ROWS = 50000  # number of rows read from an uploaded file at a time
+NUMERIC_COLUMNS = ['ra', 'dec', 'dist', 'pmra', 'pmdec', 'rv']
+UNCERTAIN_COLUMNS = NUMERIC_COLUMNS + ['plx']  # parameters that can have uncertainties and correlations
+
+
+# Function to process columns
+def proc_columns(col):
+    col = col.lower().strip()
+
+    # Check if a name column:
+    if col in ['name', 'designation', 'object', 'object_name', 'object name', 'target', 'target name', 'target_name',
+               'identifier', 'id', 'objid', 'obj_id', 'obj id', 'source', 'source id', 'source_id']:
+        return 'name'
+
+    # Check if ra/dec
+    if col in ['ra', 'ra2000', 'ra_2000', 'raj2000', 'ra_j2000']:
+        return 'ra'
+    if col in ['dec', 'dec2000', 'dec_2000', 'decj2000', 'dec_j2000',
+               'de', 'de2000', 'de_2000', 'dej2000', 'de_j2000']:
+        return 'dec'
+
+    # Check pmra/pmdec
+    if col in ['pmra', 'mura', 'mualpha', 'pmalpha', 'pm_ra', 'mu_ra']:
+        return 'pmra'
+    if col in ['pmdec', 'mudec', 'mudelta', 'pmdelta', 'pm_dec', 'mu_dec', 'pmde', 'mude', 'pm_de', 'mude']:
+        return 'pmdec'
+
+    # Check rv and distance
+    if col in ['rv', 'radial velocity', 'radial_velocity', 'velocity', 'v']:
+        return 'rv'
+
+    if col in ['dist', 'd', 'distance']:
+        return 'dist'
+    if col in ['plx', 'parallax', 'par']:
+        return 'plx'
+
+    # Check uncertainties (e_ra, ra_error, ...) and correlations (ra_dec_corr, parallax_pmra_corr, ...)
+    for prefix in ['e_', 'err_', 'error_', 'sig_', 'sigma_']:
+        if col.startswith(prefix) and proc_columns(col[len(prefix):]) in UNCERTAIN_COLUMNS:
+            return 'e_' + proc_columns(col[len(prefix):])
+    for suffix in ['_error', '_err', '_e', '_sigma', '_uncertainty']:
+        if col.endswith(suffix) and proc_columns(col[:-len(suffix)]) in UNCERTAIN_COLUMNS:
+            return 'e_' + proc_columns(col[:-len(suffix)])
+    if col.endswith('_corr'):
+        parts = col[:-len('_corr')].split('_')
+        for i in range(1, len(parts)):
+            a, b = proc_columns('_'.join(parts[:i])), proc_columns('_'.join(parts[i:]))
+            if a in UNCERTAIN_COLUMNS and b in UNCERTAIN_COLUMNS and a != b:
+                return corr_column(a, b)
+
+    return col
+
+
+# Function to read a catalog in chunks with normalized column names
+def read_catalog(stream, chunksize=CHUNK_ROWS, optional=(), fmt=None):
+    """
+    Read a comma-separated catalog with a header row, or a binary table, in chunks of chunksize rows.
+    The header is normalized once with proc_columns and checked for the required columns.
+    Distances are calculated from parallaxes (in mas) if there is no distance column.
+
+    :param stream: File-like object with the catalog, or the path of a binary table
+    :param chunksize: Number of rows per chunk
+    :param optional: Numeric columns that may be missing, they are added as empty
+    :param fmt: Format of a binary table, one of readers.BINARY_FORMATS, None for text
+
+    :return: Generator of (lines, DataFrame) where lines are the file line numbers of the rows in the chunk
+        (the row numbers for binary tables). Blank lines are dropped but still counted.
+    """
+
+    if fmt is not None:
+        from readers import BinaryTable
+        with metrics.timer('parse'):
+            reader = BinaryTable(stream, fmt).chunks(chunksize)
+        line = 1
+    else:
+        with metrics.timer('parse'):
+            reader = pd.read_csv(stream, sep=',', header=0, chunksize=chunksize, skip_blank_lines=False)
+        line = 2  # first data row is on the line after the header
+
+    columns = None
+    while True:
+        with metrics.timer('parse'):
+            df = next(reader, None)
+        if df is None:
+            break
+        if columns is None:
+            with metrics.timer('columns'):
+                columns = [proc_columns(c) for c in df.columns.tolist()]
+            check_columns(columns, optional=optional)
+
+        df.columns = columns
+        lines = np.arange(line, line + len(df))
+        line += len(df)
+        if fmt is None:  # blank lines are read as empty rows, so that the line numbers stay right
+            blank = df.isnull().all(axis=1).values
+            if blank.all():
+                continue
+            if blank.any():
+                df, lines = df[~blank].reset_index(drop=True), lines[~blank]
+
+        if 'dist' not in columns and 'plx' in columns:
+            plx = pd.to_numeric(df['plx'], errors='coerce')
+            df['dist'] = 1000. / plx.where(plx > 0)
+        for col in NUMERIC_COLUMNS:
+            if col not in df.columns:
+                df[col] = np.nan
+        yield lines, df
+
+
+# Function to check that a catalog has all the columns needed
+def check_columns(columns, optional=()):
+    for col in NUMERIC_COLUMNS:
+        if col == 'dist' and 'plx' in columns:
+            continue
+        if col not in columns and col not in optional:
+            raise KeyError(col)
+    if 'name' not in columns:
+        raise KeyError('name')
+
+
+# Function to calculate XYZ/UVW for one chunk of a catalog
+def process_chunk(df, line=2, resolver=None, ranges=None, parallel=None, uncertainty=None, traceback=None,
+                  fit=None):
+    """
+    Calculate XYZ and UVW for a chunk of a catalog.
+    Rows with non-numeric values are skipped and reported instead of failing the whole chunk.
+    Non-numeric uncertainties and correlations are taken as missing.
+
+    :param df: DataFrame with normalized column names
+    :param line: File line number of the first row in df, or array of the line numbers of its rows
+    :param resolver: resolver.Resolver used to fill in missing values by name, None to leave them empty
+    :param ranges: Dictionary of parameter: values to sweep for every row, see sweep.sweep_table
+    :param parallel: parallel.ParallelCompute to calculate large chunks in worker processes, None to calculate here
+    :param uncertainty: Function (values, errors) -> (XYZUVW, covariances) to propagate the uncertainty columns,
+        see uncertainty.propagate, None to ignore them (they are always ignored in sweeps)
+    :param traceback: Function (data) -> data to add the closest approach to each group, see convergence.add_traceback
+    :param fit: Parameter (rv or dist) to replace by its best-fitting value for each group, see bestfit.fit_table
+
+    :return: DataFrame of results, list of (line, message) for the skipped rows
+    """
+
+    bad = np.zeros(len(df), dtype=bool)
+    messages = dict()
+    values = dict()
+    with metrics.timer('convert'):
+        for col in NUMERIC_COLUMNS:
+            values[col] = pd.to_numeric(df[col], errors='coerce')
+            col_bad = (values[col].isnull() & df[col].notnull()).values
+            for i in np.flatnonzero(col_bad):
+                messages.setdefault(i, []).append('{0}={1}'.format(col, df[col].iloc[i]))
+            bad |= col_bad
+
+    good = ~bad
+    if resolver is not None:
+        with metrics.timer('resolve'):
+            fill_missing(values, df['name'], good, resolver)
+
+    for col in NUMERIC_COLUMNS:
+        values[col] = values[col].values[good]
+    metrics.count('rows_total', int(good.sum()), stage='upload')
+
+    with metrics.timer('xyz_uvw'):
+        if ranges:
+            values['name'] = df['name'].values[good]
+            data = sweep_table(values, ranges, max_size=np.inf)
+        elif fit is not None:
+            values['name'] = df['name'].values[good]
+            data = fit_table(values, fit)
+        elif uncertainty is not None and has_errors(df.columns):
+            errors = dict((col, pd.to_numeric(df[col], errors='coerce').values[good]) for col in df.columns
+                          if col in ERROR_COLUMNS or col.endswith('_corr'))
+            with metrics.timer('uncertainty'):
+                mean, cov = uncertainty(values, errors)
+            data = add_uncertainties(pd.DataFrame({'Name': df['name'].values[good]}), mean, cov)
+        else:
+            if parallel is not None:
+                x, y, z, u, v, w = parallel.xyzuvw(*[values[col] for col in NUMERIC_COLUMNS])
+            else:
+                x, y, z = xyz(values['ra'], values['dec'], values['dist'])
+                u, v, w = uvw(values['ra'], values['dec'], values['dist'], values['pmra'], values['pmdec'],
+                              values['rv'])
+
+            data = pd.DataFrame({'Name': df['name'].values[good], 'X': x, 'Y': y, 'Z': z, 'U': u, 'V': v, 'W': w})
+
+    with metrics.timer('groups'):
+        add_membership(data)
+    if traceback is not None:
+        with metrics.timer('traceback'):
+            traceback(data)
+
+    lines = line + np.arange(len(df)) if np.isscalar(line) else np.asarray(line)
+    skipped = [(int(lines[i]), 'non-numeric value ({0})'.format(', '.join(messages[i]))) for i in sorted(messages)]
+
+    return data, skipped
+
+
+# Function to fill in missing values with the parameters of resolved names
+def fill_missing(values, names, rows, resolver):
+    """
+    Fill in the missing values of the selected rows, resolving all their names with a single batch query.
+
+    :param values: Dictionary of column: Series of numeric values, updated in place
+    :param names: Series of object names
+    :param rows: Boolean array of the rows to fill in
+    :param resolver: resolver.Resolver
+    """
+
+    missing = np.zeros(len(names), dtype=bool)
+    for col in NUMERIC_COLUMNS:
+        missing |= values[col].isnull().values
+    missing &= rows & names.notnull().values
+    if not missing.any():
+        return
+
+    resolved = resolver.resolve_many(names[missing].unique().tolist())
+    if not resolved:
+        return
+
+    table = pd.DataFrame.from_dict(resolved, orient='index').reindex(names.values)
+    for col in NUMERIC_COLUMNS:
+        if col == 'dist':
+            fill = 1000. / table['plx'].values
+        else:
+            fill = table[col].values
+        values[col] = values[col].fillna(pd.Series(fill, index=values[col].index))
+
+
+# Function to process a whole catalog chunk by chunk
+def process_catalog(stream, chunksize=CHUNK_ROWS, resolver=None, ranges=None, parallel=None, uncertainty=None,
+                    traceback=None, fmt=None, fit=None):
+    """
+    Generator of (DataFrame, skipped rows) for each chunk of a catalog.
+    Only one chunk is held in memory at a time.
+    If a resolver is given, missing values are filled in by resolving the object names.
+    If ranges are given, every row is calculated over the grid of swept values, and the number of rows
+    read at a time is reduced so that chunks of results stay around chunksize rows.
+    If a process pool is given, chunks are large enough for it to calculate them in parallel.
+    If a function to propagate uncertainties is given, the uncertainty columns are propagated to XYZ/UVW.
+    If a traceback function is given, it adds the closest approach of each row to each group.
+    If a parameter to fit is given, it may be missing, and its best value for each group is calculated instead.
+    Binary tables are read with readers.BinaryTable if their format is given.
+    """
+
+    optional = list(NUMERIC_COLUMNS) if resolver is not None else []
+    if parallel is not None:
+        chunksize = max(chunksize, parallel.min_rows)
+    if ranges:
+        optional += [p for p in ranges if p not in optional]
+        chunksize = max(1, chunksize // int(np.prod([len(r) for r in ranges.values()])))
+    if fit is not None and fit not in optional:
+        optional.append(fit)
+
+    for lines, df in read_catalog(stream, chunksize=chunksize, optional=optional, fmt=fmt):
+        yield process_chunk(df, lines, resolver=resolver, ranges=ranges, parallel=parallel, uncertainty=uncertainty,
+                            traceback=traceback, fit=fit)
@@ -0,0 +1,142 @@
+"""
+Traceback of stars and moving groups to past times, to find when each star was closest to the center of each group.
+
+Positions are calculated for N stars x T times at once with broadcasting, in chunks of stars so that memory stays
+under a fixed budget, either along straight lines (linear) or along epicycles around the local standard of rest
+in the frame rotating with the Galaxy (epicycle). Both stars and group centers are traced with the same model.
+"""
+
+import numpy as np
+
+# groups (and pandas with it) is imported when the closest approaches are calculated, so that the app starts without it
+COORDINATES = ['X', 'Y', 'Z', 'U', 'V', 'W']
+
+MODELS = ['linear', 'epicycle']
+DEFAULT_TIME = 50.  # Myr back in time
+DEFAULT_STEP = 0.5  # Myr between calculated positions, the minima are refined between steps
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # memory for the positions of a chunk of stars
+
+KMS = 1.0227121650537077  # pc/Myr per km/s
+OORT_A = 15.3 * KMS / 1000.  # Oort constants, 1/Myr (Bovy 2017)
+OORT_B = -11.9 * KMS / 1000.
+OMEGA = OORT_A - OORT_B  # angular velocity of the local standard of rest
+KAPPA = np.sqrt(-4 * OORT_B * OMEGA)  # epicyclic frequency
+NU = np.sqrt(4 * np.pi * 4.498502151469554e-3 * 0.1)  # vertical frequency for a midplane density of 0.1 Msun/pc^3
+SOLAR_MOTION = np.array([11.1, 12.24, 7.25])  # UVW of the Sun relative to the local standard of rest, km/s
+
+
+# Function to calculate the positions of objects at several times
+def positions(xyz, uvw, times, model='linear'):
+    """
+    :param xyz: Array of shape (N, 3) of current X, Y, Z in pc
+    :param uvw: Array of shape (N, 3) of current U, V, W in km/s
+    :param times: Array of T times in Myr (negative for the past)
+    :param model: linear or epicycle
+
+    :return: Array of shape (N, T, 3) of X, Y, Z in pc, relative to the current position of the Sun (linear),
+        or to the local standard of rest, which the Sun occupies now (epicycle)
+    """
+
+    xyz = np.asarray(xyz, dtype=float)[:, None, :]
+    uvw = np.asarray(uvw, dtype=float)[:, None, :] * KMS
+    t = np.asarray(times, dtype=float)[None, :]
+
+    if model == 'linear':
+        return xyz + uvw * t[:, :, None]
+    if model != 'epicycle':
+        raise ValueError('Unknown traceback model: {0}'.format(model))
+
+    # Hill's equations with x pointing away from the Galactic center and y in the direction of rotation:
+    # x'' = 2 OMEGA y' + 4 OMEGA OORT_A x, y'' = -2 OMEGA x', z'' = -NU^2 z
+    solar = SOLAR_MOTION * KMS
+    x0, y0, z0 = -xyz[:, :, 0], xyz[:, :, 1], xyz[:, :, 2]
+    vx = -(uvw[:, :, 0] + solar[0])
+    vy = uvw[:, :, 1] + solar[1] - OMEGA * x0  # remove the rotation of the frame
+    vz = uvw[:, :, 2] + solar[2]
+
+    sin_k, cos_k = np.sin(KAPPA * t), np.cos(KAPPA * t)
+    xc = (2 * OMEGA * vy + 4 * OMEGA ** 2 * x0) / KAPPA ** 2  # guiding center
+    out = np.empty(np.broadcast(x0, t).shape + (3,))
+    out[:, :, 0] = -(xc + (x0 - xc) * cos_k + vx / KAPPA * sin_k)
+    out[:, :, 1] = (y0 + (vy + 2 * OMEGA * x0) * t -
+                    2 * OMEGA * (xc * t + (x0 - xc) * sin_k / KAPPA + vx * (1 - cos_k) / KAPPA ** 2))
+    out[:, :, 2] = z0 * np.cos(NU * t) + vz / NU * np.sin(NU * t)
+    return out
+
+
+# Function to find the closest approach of every star to every group
+def closest_approach(data, groups=None, model='linear', time=DEFAULT_TIME, step=DEFAULT_STEP,
+                     max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Trace stars and group centers back in time and find the minimum separation of each star from each group.
+    The minima on the grid of times are refined with a parabola through the neighbouring steps, which is exact
+    for the linear model.
+
+    :param data: DataFrame with X, Y, Z, U, V, W columns (or an array of shape (N, 6))
+    :param groups: DataFrame of groups, as returned by groups.load_groups, None for groups.NYMG
+    :param model: linear or epicycle
+    :param time: How far back to trace, Myr
+    :param step: Time between calculated positions, Myr
+    :param max_bytes: Memory for the positions of a chunk of stars
+
+    :return: Arrays of shape (N, number of groups) with the minimum separations in pc
+        and the times of closest approach in Myr (negative), NaN for stars with missing values
+    """
+
+    if groups is None:
+        from groups import NYMG as groups
+    x = np.asarray(data[COORDINATES] if hasattr(data, 'columns') else data, dtype=float)
+    n = len(x)
+    nsteps = max(2, int(round(abs(time) / step)) + 1)
+    times, h = np.linspace(0, -abs(time), nsteps, retstep=True)
+
+    centers = positions(groups[COORDINATES[:3]].values, groups[COORDINATES[3:]].values, times, model=model)
+    separation = np.full((n, len(groups)), np.nan)
+    closest = np.full((n, len(groups)), np.nan)
+
+    chunk = max(1, int(max_bytes // (nsteps * 8 * 3 * 3)))  # positions, differences, and temporaries
+    for i in range(0, n, chunk):
+        j = min(i + chunk, n)
+        stars = positions(x[i:j, :3], x[i:j, 3:], times, model=model)
+        rows = np.arange(j - i)
+        for g in range(len(groups)):
+            diff = stars - centers[g]
+            d2 = np.einsum('ntk,ntk->nt', diff, diff)
+            d2 = np.where(np.isfinite(d2), d2, np.inf)
+            k = np.clip(np.argmin(d2, axis=1), 1, nsteps - 2)
+
+            # Vertex of the parabola through the minimum and its neighbours, if it is inside the grid
+            d2m, d20, d2p = d2[rows, k - 1], d2[rows, k], d2[rows, k + 1]
+            curv = d2m - 2 * d20 + d2p
+            with np.errstate(divide='ignore', invalid='ignore'):
+                shift = np.where(curv > 0, (d2m - d2p) / (2 * curv), np.nan)
+            inside = np.abs(shift) <= 1
+            best = np.where(inside, d20 - curv * shift ** 2 / 2, d2.min(axis=1))
+            t_best = np.where(inside, times[k] + shift * h, times[np.argmin(d2, axis=1)])
+
+            separation[i:j, g] = np.sqrt(np.maximum(best, 0))
+            closest[i:j, g] = t_best
+
+    missing = ~np.isfinite(x).all(axis=1)
+    separation[missing] = np.nan
+    closest[missing] = np.nan
+    return separation, closest
+
+
+# Function to add the closest approach to each group to a table of results
+def add_traceback(data, groups=None, model='linear', time=DEFAULT_TIME, step=DEFAULT_STEP,
+                  max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Add the columns Dmin_<group>, the minimum separation from the center of the group in pc,
+    and Tmin_<group>, the time of closest approach in Myr, for every group to a table with X, Y, Z, U, V, W columns.
+    """
+
+    if groups is None:
+        from groups import NYMG as groups
+    if len(groups) == 0:
+        return data
+    separation, closest = closest_approach(data, groups, model=model, time=time, step=step, max_bytes=max_bytes)
+    for g, name in enumerate(groups['name'].values):
+        data['Dmin_' + name] = separation[:, g]
+        data['Tmin_' + name] = closest[:, g]
+    return data
@@ -4,10 +4,35 @@ David R. Rodriguez
 Package containing UVW and XYZ functions
 """
 
-from math import cos, sin
-from astropy.coordinates import SkyCoord
+from collections import OrderedDict
+import threading
 import numpy as np
 
+k = 4.74047  # Equivalent of 1 A.U/yr in km/s
+
+# Rotation matrix from ICRS to Galactic cartesian coordinates (X towards the Galactic center).
+# Matches the transformation used by astropy's SkyCoord(...).galactic, including the ICRS/FK5 frame bias.
+GAL_MATRIX = np.array([[-0.0548756577125916, -0.8734370519556159, -0.4838350736167155],
+                       [0.4941094371927268, -0.4448297212232952, 0.7469821839866676],
+                       [-0.8676661375596576, -0.1980763372730005, 0.4559838136873016]])
+
+# Rotation matrix from http://idlastro.gsfc.nasa.gov/ftp/pro/astro/gal_uvw.pro
+# The first row is negated so that U is positive towards the Galactic center
+UVW_MATRIX = np.array([[-0.0548755604, -0.8734370902, -0.4838350155],
+                       [0.4941094279, -0.4448296300, 0.7469822445],
+                       [-0.8676661490, -0.1980763734, 0.4559837762]])
+
+# Radian conversion factors. uvw has always used a truncated value of pi, which is kept to preserve its results.
+RADCON_UVW = 3.1415926/180
+RADCON_XYZ = np.pi/180
+
+CHUNK_SIZE = 65536  # number of rows processed at a time by the array functions
+BASIS_CACHE_SIZE = 256  # number of sets of positions whose bases are kept by cached_basis
+BASIS_CACHE_MAX_STARS = 4096  # bases of larger sets of positions are not kept
+
+_basis_cache = OrderedDict()
+_basis_lock = threading.Lock()
+
 
 # ===================================================
 def uvw(ra, dec, d, pmra, pmde, rv):
@@ -25,55 +50,11 @@ def uvw(ra, dec, d, pmra, pmde, rv):
     :return: U, V, W in km/s
 
     """
-    k = 4.74047  # Equivalent of 1 A.U/yr in km/s
-    A00 = 0.0548755604
-    A01 = 0.8734370902
-    A02 = 0.4838350155
-    A10 = 0.4941094279
-    A11 = -0.4448296300
-    A12 = 0.7469822445
-    A20 = -0.8676661490
-    A21 = -0.1980763734
-    A22 = 0.4559837762
-
-    # Set as arrays in case ra, dec, etc were lists
-    ra = np.array(ra)
-    dec = np.array(dec)
-    d = np.array(d)
-    rv = np.array(rv)
-    pmra = np.array(pmra)
-    pmde = np.array(pmde)
-
-    radcon = 3.1415926/180  # radian conversion factor
-
-    try:
-        cosd = cos(dec * radcon)
-        sind = sin(dec * radcon)
-        cosa = cos(ra * radcon)
-        sina = sin(ra * radcon)
-    except TypeError:  # For arrays
-        cosd = np.array(map(cos, dec * radcon))
-        sind = np.array(map(sin, dec * radcon))
-        cosa = np.array(map(cos, ra * radcon))
-        sina = np.array(map(sin, ra * radcon))
-
-    vec1 = rv
-    plx = 1000./d
-    vec2 = k * pmra/plx
-    vec3 = k * pmde/plx
-
-    u = (A00*cosa*cosd + A01*sina*cosd + A02*sind) * vec1 + \
-        (-A00*sina + A01*cosa) * vec2 + \
-        (-A00*cosa*sind - A01*sina*sind + A02*cosd) * vec3
-    v = (A10*cosa*cosd + A11*sina*cosd + A12*sind) * vec1 + \
-        (-A10*sina + A11*cosa) * vec2 + \
-        (-A10*cosa*sind - A11*sina*sind + A12*cosd) * vec3
-    w = (A20*cosa*cosd + A21*sina*cosd + A22*sind) * vec1 + \
-        (-A20*sina + A21*cosa) * vec2 + \
-        (-A20*cosa*sind - A21*sina*sind + A22*cosd) * vec3
-    u = -u  # Flipping U to be positive towards Galactic center
-
-    return u, v, w
+
+    shape = np.broadcast(*[np.asarray(x) for x in [ra, dec, d, pmra, pmde, rv]]).shape
+    u, v, w = uvw_array(ra, dec, d, pmra, pmde, rv)
+
+    return _reshape(u, shape), _reshape(v, shape), _reshape(w, shape)
 
 
 # ===================================================
@@ -88,25 +69,299 @@ def xyz(ra, dec, d):
     :return: X, Y, Z in parsecs
     """
 
-    ra = np.array(ra)
-    dec = np.array(dec)
-    d = np.array(d)
+    shape = np.broadcast(*[np.asarray(x) for x in [ra, dec, d]]).shape
+    x, y, z = xyz_array(ra, dec, d)
+
+    return _reshape(x, shape), _reshape(y, shape), _reshape(z, shape)
+
+
+# ===================================================
+def uvw_array(ra, dec, d, pmra, pmde, rv, dtype=np.float64, out=None, chunk_size=CHUNK_SIZE):
+    """
+    Batched version of uvw operating on flat NumPy arrays.
+    Inputs are broadcast against each other and processed in chunks of chunk_size rows,
+    so memory use for temporaries stays constant regardless of the number of rows.
+
+    :param ra: Right Ascension in degrees
+    :param dec: Declination in degrees
+    :param d: Distance in parsecs
+    :param pmra: Proper motion in RA in milli-arcseconds/year
+    :param pmde: Proper motion in Dec in milli-arcseconds/year
+    :param rv: Radial velocity in km/s
+    :param dtype: Floating point type for the calculation (np.float64 or np.float32)
+    :param out: Optional array of shape (3, N) and type dtype to store the results in
+    :param chunk_size: Number of rows to process at a time
+
+    :return: Array of shape (3, N) with U, V, W in km/s
+    """
+
+    dtype = np.dtype(dtype)
+    ra, dec, d, pmra, pmde, rv = _prepare([ra, dec, d, pmra, pmde, rv], dtype)
+    n = len(ra)
+    out = _check_out(out, n, dtype)
+    matrix = UVW_MATRIX.astype(dtype)
+    radcon = dtype.type(RADCON_UVW)
 
-    c = SkyCoord(ra=ra, dec=dec, frame='icrs', unit='deg')
-    l, b = c.galactic.l.radian, c.galactic.b.radian
+    vec = np.empty((3, min(n, chunk_size)), dtype=dtype)
+    res = np.empty_like(vec)
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        m = j - i
 
-    try:
-       xgc = d * cos(b) * cos(l)
-       ygc = d * cos(b) * sin(l)
-       zgc = d * sin(b)
-    except TypeError:  # For arrays
-        xgc = d * map(cos, b) * map(cos, l)
-        ygc = d * map(cos, b) * map(sin, l)
-        zgc = d * map(sin, b)
+        cosa, sina, cosd, sind = _trig(ra[i:j], dec[i:j], radcon)
+
+        plx = 1000./d[i:j]
+        vec2 = k * pmra[i:j]/plx
+        vec3 = k * pmde[i:j]/plx
+
+        # Space velocity in ICRS cartesian coordinates
+        vxy = rv[i:j] * cosd - vec3 * sind
+        np.multiply(vxy, cosa, out=vec[0, :m])
+        vec[0, :m] -= vec2 * sina
+        np.multiply(vxy, sina, out=vec[1, :m])
+        vec[1, :m] += vec2 * cosa
+        np.multiply(rv[i:j], sind, out=vec[2, :m])
+        vec[2, :m] += vec3 * cosd
+
+        _rotate(matrix, vec, res, out, i, j)
+
+    return out
 
-    return xgc, ygc, zgc
 
 # ===================================================
+def xyz_array(ra, dec, d, dtype=np.float64, out=None, chunk_size=CHUNK_SIZE):
+    """
+    Batched version of xyz operating on flat NumPy arrays.
+    Inputs are broadcast against each other and processed in chunks of chunk_size rows,
+    so memory use for temporaries stays constant regardless of the number of rows.
 
-version = '1.1'
+    :param ra: Right Ascension in degrees
+    :param dec: Declination in degrees
+    :param d: Distance in parsecs
+    :param dtype: Floating point type for the calculation (np.float64 or np.float32)
+    :param out: Optional array of shape (3, N) and type dtype to store the results in
+    :param chunk_size: Number of rows to process at a time
+
+    :return: Array of shape (3, N) with X, Y, Z in parsecs
+    """
+
+    dtype = np.dtype(dtype)
+    ra, dec, d = _prepare([ra, dec, d], dtype)
+    n = len(ra)
+    out = _check_out(out, n, dtype)
+    matrix = GAL_MATRIX.astype(dtype)
+    radcon = dtype.type(RADCON_XYZ)
+
+    vec = np.empty((3, min(n, chunk_size)), dtype=dtype)
+    res = np.empty_like(vec)
+    for i in range(0, n, chunk_size):
+        j = min(i + chunk_size, n)
+        m = j - i
+
+        cosa, sina, cosd, sind = _trig(ra[i:j], dec[i:j], radcon)
+
+        # Position in ICRS cartesian coordinates
+        np.multiply(d[i:j], cosd, out=vec[2, :m])
+        np.multiply(vec[2, :m], cosa, out=vec[0, :m])
+        np.multiply(vec[2, :m], sina, out=vec[1, :m])
+        np.multiply(d[i:j], sind, out=vec[2, :m])
 
+        _rotate(matrix, vec, res, out, i, j)
+
+    return out
+
+
+# ===================================================
+def xyz_basis(ra, dec, dtype=np.float64):
+    """
+    Unit vectors towards each star in Galactic cartesian coordinates.
+    XYZ is the product of these vectors with the distance.
+
+    :param ra: Right Ascension in degrees
+    :param dec: Declination in degrees
+    :param dtype: Floating point type for the calculation
+
+    :return: Array of shape (3, N)
+    """
+
+    dtype = np.dtype(dtype)
+    ra, dec = _prepare([ra, dec], dtype)
+    cosa, sina, cosd, sind = _trig(ra, dec, dtype.type(RADCON_XYZ))
+
+    return np.dot(GAL_MATRIX.astype(dtype), np.array([cosd * cosa, cosd * sina, sind]))
+
+
+# ===================================================
+def uvw_basis(ra, dec, dtype=np.float64):
+    """
+    Basis vectors of the UVW frame for each star: the radial direction and the directions of increasing RA and Dec.
+    UVW is linear in these, as U, V, W = R * rv + A * k * pmra * d / 1000 + D * k * pmde * d / 1000
+    with k = 4.74047, pmra and pmde in milli-arcseconds/year, and d in parsecs.
+
+    :param ra: Right Ascension in degrees
+    :param dec: Declination in degrees
+    :param dtype: Floating point type for the calculation
+
+    :return: R, A, D, each an array of shape (3, N)
+    """
+
+    dtype = np.dtype(dtype)
+    ra, dec = _prepare([ra, dec], dtype)
+    cosa, sina, cosd, sind = _trig(ra, dec, dtype.type(RADCON_UVW))
+    matrix = UVW_MATRIX.astype(dtype)
+
+    r = np.dot(matrix, np.array([cosa * cosd, sina * cosd, sind]))
+    a = np.dot(matrix, np.array([-sina, cosa, np.zeros_like(cosa)]))
+    d = np.dot(matrix, np.array([-cosa * sind, -sina * sind, cosd]))
+
+    return r, a, d
+
+
+# ===================================================
+def cached_basis(ra, dec, dtype=np.float64):
+    """
+    xyz_basis and uvw_basis of a set of positions, reusing those of the most recently used positions.
+    Recalculating a star after editing its distance, proper motions, or radial velocity, or sweeping them,
+    then only takes the products and sums of xyzuvw_from_basis.
+
+    :param ra: Right Ascension in degrees
+    :param dec: Declination in degrees
+    :param dtype: Floating point type for the calculation
+
+    :return: Tuple of read-only arrays P, R, A, D, each of shape (3, N)
+    """
+
+    dtype = np.dtype(dtype)
+    ra, dec = [np.ascontiguousarray(x, dtype=np.float64).ravel() for x in np.broadcast_arrays(ra, dec)]
+    if ra.size > BASIS_CACHE_MAX_STARS:
+        return (xyz_basis(ra, dec, dtype=dtype),) + uvw_basis(ra, dec, dtype=dtype)
+
+    key = (ra.tobytes(), dec.tobytes(), dtype.str)
+    with _basis_lock:
+        basis = _basis_cache.pop(key, None)
+        if basis is not None:
+            _basis_cache[key] = basis  # mark as most recently used
+            return basis
+
+    basis = (xyz_basis(ra, dec, dtype=dtype),) + uvw_basis(ra, dec, dtype=dtype)
+    for b in basis:
+        b.setflags(write=False)
+    with _basis_lock:
+        _basis_cache[key] = basis
+        while len(_basis_cache) > BASIS_CACHE_SIZE:
+            _basis_cache.popitem(last=False)
+    return basis
+
+
+# ===================================================
+def xyzuvw_from_basis(basis, d, pmra, pmde, rv, dtype=np.float64):
+    """
+    XYZ and UVW as affine functions of the distance, proper motions, and radial velocity of stars with known bases.
+    The parameters may have different shapes, e.g. (N, 1) and (1, M) for a grid of M values for each star,
+    and the terms that do not depend on the largest ones are calculated at their own size.
+
+    :param basis: P, R, A, D of N stars, as returned by cached_basis
+    :param d: Distance in parsecs
+    :param pmra: Proper motion in RA in milli-arcseconds/year
+    :param pmde: Proper motion in Dec in milli-arcseconds/year
+    :param rv: Radial velocity in km/s
+    :param dtype: Floating point type for the results
+
+    :return: Array of shape (6, N, ...) with X, Y, Z, U, V, W
+    """
+
+    dtype = np.dtype(dtype)
+    p, r, a, dd = basis
+    n = p.shape[1]
+    d, pmra, pmde, rv = [np.asarray(x, dtype=dtype) for x in [d, pmra, pmde, rv]]
+    ndim = max([1] + [x.ndim for x in [d, pmra, pmde, rv]])
+    stars = (n,) + (1,) * (ndim - 1)
+    shape = np.broadcast(np.empty(stars, dtype=bool), d, pmra, pmde, rv).shape
+
+    vt = d * dtype.type(k / 1000.)  # converts proper motions to tangential velocities
+    out = np.empty((6,) + shape, dtype=dtype)
+    for c in range(3):
+        np.multiply(p[c].reshape(stars), d, out=out[c])
+        # Tangential part, usually much smaller than the grid since not all parameters are swept
+        tangential = a[c].reshape(stars) * (vt * pmra) + dd[c].reshape(stars) * (vt * pmde)
+        np.multiply(r[c].reshape(stars), rv, out=out[3 + c])
+        out[3 + c] += tangential
+
+    return out
+
+
+# ===================================================
+def xyzuvw(ra, dec, d, pmra, pmde, rv, dtype=np.float64):
+    """
+    XYZ and UVW of stars with the cached bases of their positions.
+    Same results as xyz and uvw, but recalculating stars at known positions with new distances or velocities
+    skips the trigonometry and rotations.
+
+    :return: Array of shape (6, N), or (6,) if all inputs are scalars
+    """
+
+    scalar = all(np.ndim(x) == 0 for x in [ra, dec, d, pmra, pmde, rv])
+    values = np.broadcast_arrays(ra, dec, d, pmra, pmde, rv)
+    out = xyzuvw_from_basis(cached_basis(values[0], values[1], dtype=dtype),
+                            *[np.ravel(x) for x in values[2:]], dtype=dtype)
+    return out[:, 0] if scalar else out
+
+
+# ===================================================
+def _prepare(arrays, dtype):
+    """
+    Broadcast the inputs against each other and flatten them to 1-D arrays of type dtype.
+    Scalars are broadcast as read-only views, so they are not replicated in memory.
+    """
+
+    arrays = [np.asarray(x, dtype=dtype) for x in arrays]
+    shape = np.broadcast(*arrays).shape
+    size = int(np.prod(shape))
+
+    flat = []
+    for x in arrays:
+        if x.size == 1:
+            flat.append(np.broadcast_to(x.reshape(1), (size,)))
+        else:
+            flat.append(np.ascontiguousarray(np.broadcast_to(x, shape)).reshape(size))
+
+    return flat
+
+
+def _check_out(out, n, dtype):
+    # Allocate the output array or check the one provided by the caller
+    if out is None:
+        return np.empty((3, n), dtype=dtype)
+
+    if out.shape != (3, n) or out.dtype != dtype:
+        raise ValueError('out must have shape {0} and dtype {1}'.format((3, n), dtype.name))
+
+    return out
+
+
+def _trig(ra, dec, radcon):
+    # Sines and cosines of RA and Dec given in degrees
+    a = ra * radcon
+    b = dec * radcon
+    return np.cos(a), np.sin(a), np.cos(b), np.sin(b)
+
+
+def _rotate(matrix, vec, res, out, i, j):
+    # Apply the rotation matrix to the vectors in vec and store them in out[:, i:j]
+    m = j - i
+    if m == vec.shape[1]:
+        np.dot(matrix, vec, out=res)
+        out[:, i:j] = res
+    else:  # final, partial chunk
+        out[:, i:j] = np.dot(matrix, vec[:, :m])
+
+
+def _reshape(x, shape):
+    # Return results with the broadcast shape of the inputs, as scalars for scalar inputs
+    if shape == ():
+        return x[0]
+    return x.reshape(shape)
+
+# ===================================================
+
+version = '1.1'
@@ -0,0 +1,132 @@
+"""
+Functions to export result tables in memory as streams of bytes
+"""
+
+import io
+import zlib
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet and Arrow exports are optional
+    pa = None
+
+CHUNK_ROWS = 20000  # number of rows written at a time for text formats
+
+
+def _bytes(s):
+    # Text returned by pandas is already bytes in Python 2
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+# Text formats written row chunk by row chunk
+def _csv(data, sep=','):
+    for i in range(0, max(len(data), 1), CHUNK_ROWS):
+        yield _bytes(data.iloc[i:i + CHUNK_ROWS].to_csv(None, sep=sep, index=False, header=(i == 0)))
+
+
+def _ascii(data):
+    return _csv(data, sep=' ')
+
+
+def _html(data):
+    yield _bytes(data.to_html(None, index=False))
+
+
+# Binary formats
+def _records(data):
+    # Structured array of the table, with text columns stored as fixed width unicode
+    columns = []
+    for col in data.columns:
+        values = np.asarray(data[col].values)
+        if values.dtype.kind == 'O':
+            values = values.astype('U')
+        columns.append((str(col), values))
+    arr = np.empty(len(data), dtype=[(col, values.dtype) for col, values in columns])
+    for col, values in columns:
+        arr[col] = values
+    return arr
+
+
+def _npy(data):
+    buf = io.BytesIO()
+    np.save(buf, _records(data))
+    yield buf.getvalue()
+
+
+def _npz(data):
+    arr = _records(data)
+    buf = io.BytesIO()
+    np.savez_compressed(buf, **dict((col, arr[col]) for col in arr.dtype.names))
+    yield buf.getvalue()
+
+
+def _parquet(data):
+    buf = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(data, preserve_index=False), buf)
+    yield buf.getvalue()
+
+
+def _arrow(data):
+    # Arrow IPC stream, one record batch per chunk of rows
+    sink = io.BytesIO()
+    schema = pa.Schema.from_pandas(data, preserve_index=False)
+    writer = pa.RecordBatchStreamWriter(sink, schema)
+    for i in range(0, len(data), CHUNK_ROWS):
+        writer.write_batch(pa.RecordBatch.from_pandas(data.iloc[i:i + CHUNK_ROWS], schema=schema,
+                                                      preserve_index=False))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+# Format name: (writer, file name, mimetype, needs pyarrow)
+EXPORT_FORMATS = {'csv': (_csv, 'results.txt', 'text/csv', False),
+                  'ascii': (_ascii, 'results.txt', 'text/plain', False),
+                  'html': (_html, 'results.html', 'text/html', False),
+                  'npy': (_npy, 'results.npy', 'application/octet-stream', False),
+                  'npz': (_npz, 'results.npz', 'application/octet-stream', False),
+                  'parquet': (_parquet, 'results.parquet', 'application/octet-stream', True),
+                  'arrow': (_arrow, 'results.arrow', 'application/vnd.apache.arrow.stream', True)}
+
+
+def gzip_stream(chunks):
+    # Compress a stream of bytes into the gzip format, chunk by chunk
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def export_table(data, export_fmt, compress=False):
+    """
+    Write a table to one of the export formats without going through the disk.
+
+    :param data: DataFrame to export
+    :param export_fmt: Name of the format, one of EXPORT_FORMATS
+    :param compress: Compress the output with gzip
+
+    :return: Generator of bytes, file name, mimetype
+    """
+
+    if export_fmt not in EXPORT_FORMATS:
+        raise ValueError('Unknown format: {0}'.format(export_fmt))
+
+    writer, filename, mimetype, needs_arrow = EXPORT_FORMATS[export_fmt]
+    if needs_arrow and pa is None:
+        raise ValueError('The {0} format requires pyarrow, which is not installed'.format(export_fmt))
+
+    stream = writer(data)
+    if compress:
+        stream = gzip_stream(stream)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    return stream, filename, mimetype
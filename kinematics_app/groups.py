@@ -0,0 +1,96 @@
+"""
+Nearby young moving groups: the group table and membership scoring in XYZ-UVW space
+"""
+
+import os
+import pandas as pd
+import numpy as np
+
+NYMG_FILE = os.environ.get('NYMG_FILE') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'nymg.csv')
+COORDINATES = ['X', 'Y', 'Z', 'U', 'V', 'W']
+CHUNK_SIZE = 65536  # number of stars scored at a time
+
+
+# Function to read a table of groups
+def load_groups(path=NYMG_FILE):
+    """
+    Read a table of groups with their mean XYZ-UVW and dispersions.
+
+    :param path: csv file with name, X, eX, Y, eY, Z, eZ, U, eU, V, eV, W, eW, and color columns
+
+    :return: DataFrame indexed by group name
+    """
+
+    groups = pd.read_csv(path).set_index('name', drop=False)
+    if not groups.index.is_unique:
+        raise ValueError('Group names in {0} are not unique'.format(path))
+    return groups
+
+
+# Groups from Malo et al. (2013), unless NYMG_FILE points to another table
+NYMG = load_groups()
+
+
+# Function to calculate the normalized distance of every star to every group
+def group_distances(data, groups=NYMG):
+    """
+    6-D distance of each star to the center of each group in units of the group dispersions,
+    sqrt(sum(((x - mean) / dispersion)**2)) over X, Y, Z, U, V, W.
+    Expanding the square turns the calculation into two matrix products, so many groups are as fast as a few.
+
+    :param data: DataFrame with X, Y, Z, U, V, W columns (or an array of shape (N, 6))
+    :param groups: DataFrame of groups, as returned by load_groups
+
+    :return: Array of shape (N, number of groups)
+    """
+
+    x = np.asarray(data[COORDINATES] if isinstance(data, pd.DataFrame) else data, dtype=float)
+    mean = groups[COORDINATES].values
+    inv_var = 1. / groups[['e' + c for c in COORDINATES]].values ** 2
+
+    d2 = np.dot(x ** 2, inv_var.T)
+    d2 -= 2 * np.dot(x, (mean * inv_var).T)
+    d2 += (mean ** 2 * inv_var).sum(axis=1)
+
+    return np.sqrt(np.maximum(d2, 0))
+
+
+# Function to find the best matching group of every star
+def best_groups(data, groups=NYMG, chunk_size=CHUNK_SIZE):
+    """
+    :param data: DataFrame with X, Y, Z, U, V, W columns
+    :param groups: DataFrame of groups, as returned by load_groups
+    :param chunk_size: Number of stars to process at a time
+
+    :return: Array of best matching group names ('' for stars with missing values),
+        array of their normalized distances (NaN for stars with missing values)
+    """
+
+    x = np.asarray(data[COORDINATES], dtype=float)
+    n = len(x)
+    best = np.zeros(n, dtype=int)
+    score = np.empty(n)
+    for i in range(0, n, chunk_size):
+        dist = group_distances(x[i:i + chunk_size], groups)
+        best[i:i + chunk_size] = np.argmin(dist, axis=1)
+        score[i:i + chunk_size] = dist[np.arange(len(dist)), best[i:i + chunk_size]]
+
+    names = groups['name'].values[best].astype(object)
+    missing = ~np.isfinite(score)
+    names[missing] = ''
+    score[missing] = np.nan
+
+    return names, score
+
+
+# Function to add the best matching group to a table of results
+def add_membership(data, groups=NYMG):
+    """
+    Add the columns Group, the best matching group, and Sigma, the 6-D distance to its center
+    in units of its dispersions, to a table with X, Y, Z, U, V, W columns.
+    """
+
+    if len(groups) == 0:
+        return data
+    data['Group'], data['Sigma'] = best_groups(data, groups)
+    return data
@@ -0,0 +1,253 @@
+"""
+Background jobs for long calculations, run by a bounded number of threads in the web process so that requests
+return immediately. The status of the jobs is kept in memory or in a local SQLite file, so that with several worker
+processes on the same host any of them can report the progress of a job or cancel it.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = [DONE, FAILED, CANCELLED]
+STATUS_FIELDS = ['id', 'state', 'progress', 'message', 'result', 'error', 'cancel', 'created', 'updated']
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUED = 20
+DEFAULT_TTL = 24 * 3600  # seconds to keep the status of finished jobs
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """
+    Raised in a job that was cancelled, at its next call to Job.progress
+    """
+    pass
+
+
+class QueueFull(Exception):
+    """
+    Raised when submitting a job while too many are waiting
+    """
+    pass
+
+
+class Job(object):
+    """
+    Handle passed to the function of a job, to report its progress
+    """
+
+    def __init__(self, status, job_id):
+        self.status = status
+        self.id = job_id
+
+    def progress(self, fraction, message=''):
+        """
+        Report the fraction done (0 to 1) and a short message. Raises JobCancelled if the job was cancelled.
+        """
+
+        job = self.status.get(self.id)
+        if job is None or job['cancel']:
+            raise JobCancelled(self.id)
+        self.status.update(self.id, progress=min(max(float(fraction), 0.), 1.), message=message)
+
+
+class MemoryJobStatus(object):
+    """
+    Status of the jobs of this process
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, job_id):
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            self._jobs[job_id] = dict(id=job_id, state=QUEUED, progress=0., message='', result=None, error=None,
+                                      cancel=False, created=now, updated=now)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields, updated=time.time())
+
+    def _evict(self, now):
+        for job_id, job in list(self._jobs.items()):
+            if job['state'] in FINISHED and now - job['updated'] > self.ttl:
+                del self._jobs[job_id]
+
+
+class SQLiteJobStatus(object):
+    """
+    Status of the jobs in a local SQLite file, shared by several worker processes on the same host
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, state TEXT, progress REAL, '
+                         'message TEXT, result TEXT, error TEXT, cancel INTEGER, created REAL, updated REAL)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create(self, job_id):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('DELETE FROM jobs WHERE state IN (?, ?, ?) AND updated < ?', FINISHED + [now - self.ttl])
+            conn.execute('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, QUEUED, 0., '', None, None, 0, now, now))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute('SELECT ' + ', '.join(STATUS_FIELDS) + ' FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(STATUS_FIELDS, row))
+        job['cancel'] = bool(job['cancel'])
+        return job
+
+    def update(self, job_id, **fields):
+        fields['updated'] = time.time()
+        keys = sorted(fields)
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET ' + ', '.join(key + ' = ?' for key in keys) + ' WHERE id = ?',
+                         [fields[key] for key in keys] + [job_id])
+
+
+class JobQueue(object):
+    """
+    Queue of jobs run by a fixed number of threads, started when the first job is submitted
+    """
+
+    def __init__(self, status, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED):
+        """
+        :param status: MemoryJobStatus or SQLiteJobStatus
+        :param workers: Number of jobs run at the same time
+        :param max_queued: Number of jobs that can wait to be run
+        """
+
+        self.status = status
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func):
+        """
+        :param func: Function called with a Job, which returns the result of the job (e.g. a key in the result store)
+
+        :return: Job id
+        """
+
+        self._start()
+        job_id = uuid.uuid4().hex
+        self.status.create(job_id)
+        try:
+            self._queue.put_nowait((job_id, func))
+        except queue.Full:
+            self.status.update(job_id, state=FAILED, error='Too many jobs are waiting')
+            raise QueueFull('Too many jobs are waiting, try again later')
+        return job_id
+
+    def get(self, job_id):
+        """
+        :return: Dictionary with the STATUS_FIELDS of the job, or None if it does not exist (or expired)
+        """
+
+        return self.status.get(job_id)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Jobs that are waiting are not run, running jobs stop at their next progress report.
+
+        :return: True if the job was cancelled, False if it does not exist or has finished
+        """
+
+        job = self.status.get(job_id)
+        if job is None or job['state'] in FINISHED:
+            return False
+        if job['state'] == QUEUED:
+            self.status.update(job_id, state=CANCELLED, cancel=True)
+        else:
+            self.status.update(job_id, cancel=True)
+        return True
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='job-worker-{0}'.format(len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id, func = self._queue.get()
+            try:
+                self._run(job_id, func)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id, func):
+        job = self.status.get(job_id)
+        if job is None or job['cancel']:
+            return
+        self.status.update(job_id, state=RUNNING)
+        try:
+            result = func(Job(self.status, job_id))
+        except JobCancelled:
+            self.status.update(job_id, state=CANCELLED)
+        except Exception as e:
+            logger.exception('Job %s failed', job_id)
+            self.status.update(job_id, state=FAILED, error=str(e))
+        else:
+            self.status.update(job_id, state=DONE, progress=1., result=result)
+
+
+# Function to create the job queue from the app configuration
+def make_jobs(config):
+    """
+    Create the job queue, with its status kept as selected by config['JOBS_STATUS'] ('memory' or 'sqlite').
+
+    :param config: Flask config (or dict) with JOBS_STATUS, JOBS_STATUS_PATH, JOBS_WORKERS, JOBS_MAX_QUEUED,
+        and JOBS_TTL
+
+    :return: JobQueue
+    """
+
+    ttl = float(config.get('JOBS_TTL', DEFAULT_TTL))
+    kind = config.get('JOBS_STATUS', 'memory')
+    if kind == 'memory':
+        status = MemoryJobStatus(ttl=ttl)
+    elif kind == 'sqlite':
+        status = SQLiteJobStatus(config.get('JOBS_STATUS_PATH', 'jobs.sqlite'), ttl=ttl)
+    else:
+        raise ValueError('Unknown job status store: {0}'.format(kind))
+
+    return JobQueue(status, workers=int(config.get('JOBS_WORKERS', DEFAULT_WORKERS)),
+                    max_queued=int(config.get('JOBS_MAX_QUEUED', DEFAULT_MAX_QUEUED)))
@@ -0,0 +1,203 @@
+"""
+Timing of the stages of each request, reported as Server-Timing headers, optional structured logs,
+and counters in the Prometheus text format at /metrics.
+
+Everything is off unless enabled with configure (METRICS in the app configuration); timer then returns
+a shared object that does nothing and count returns right away, so the instrumented code costs almost nothing.
+Counters are kept per process.
+"""
+
+from flask import g, has_request_context, request, Response
+import json
+import logging
+import threading
+import time
+
+PREFIX = 'kinematics_'
+
+ENABLED = False
+LOG = False
+logger = logging.getLogger(__name__)
+_clock = getattr(time, 'perf_counter', time.time)
+
+_lock = threading.Lock()
+_counters = dict()  # (name, labels): value
+_summaries = dict()  # (name, labels): [count, sum]
+_HELP = {
+    'stage_seconds': 'Time spent in each stage of the requests',
+    'request_seconds': 'Time to answer each request',
+    'requests_total': 'Requests answered',
+    'rows_total': 'Rows processed in each stage',
+    'payload_bytes_total': 'Bytes received and sent',
+    'cache_requests_total': 'Lookups in the caches, by result (hit or miss)',
+    'simbad_query_seconds': 'Time of each query to the Simbad backend',
+}
+
+
+# Function to turn the instrumentation on or off
+def configure(enabled=False, log=False):
+    global ENABLED, LOG
+    ENABLED = bool(enabled)
+    LOG = bool(log) and ENABLED
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Timer(object):
+    __slots__ = ['stage', 'start']
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, _clock() - self.start)
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+# Function to time a stage, used as: with timer('parse'): ...
+def timer(stage):
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(stage)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+# Function to record the time taken by a stage
+def record(stage, seconds):
+    if not ENABLED:
+        return
+    observe('stage_seconds', seconds, stage=stage)
+    if has_request_context():
+        stages = getattr(g, 'metrics_stages', None)  # g has no setdefault in Flask 0.10
+        if stages is None:
+            stages = g.metrics_stages = dict()
+        stages[stage] = stages.get(stage, 0.) + seconds
+
+
+# Function to add to a counter
+def count(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    if name == 'rows_total' and has_request_context():
+        g.metrics_rows = getattr(g, 'metrics_rows', 0) + value
+
+
+# Function to add a value to a summary (count and sum)
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        summary = _summaries.setdefault(key, [0, 0.])
+        summary[0] += 1
+        summary[1] += value
+
+
+# Function to count a lookup in a cache
+def cache_lookup(cache, hit):
+    count('cache_requests_total', cache=cache, result='hit' if hit else 'miss')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+# Function to write all counters in the Prometheus text format
+def prometheus_text():
+    with _lock:
+        counters = sorted(_counters.items())
+        summaries = sorted((key, list(value)) for key, value in _summaries.items())
+
+    lines = []
+    described = set()
+    for (name, labels), value in counters:
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, _HELP.get(name, name)))
+            lines.append('# TYPE {0}{1} counter'.format(PREFIX, name))
+        lines.append('{0}{1}{2} {3}'.format(PREFIX, name, _format_labels(labels), value))
+    for (name, labels), (n, total) in summaries:
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP {0}{1} {2}'.format(PREFIX, name, _HELP.get(name, name)))
+            lines.append('# TYPE {0}{1} summary'.format(PREFIX, name))
+        lines.append('{0}{1}_count{2} {3}'.format(PREFIX, name, _format_labels(labels), n))
+        lines.append('{0}{1}_sum{2} {3!r}'.format(PREFIX, name, _format_labels(labels), total))
+
+    # Hit rates of the caches, for convenience
+    lookups = dict()
+    for (name, labels), value in counters:
+        if name == 'cache_requests_total':
+            labels = dict(labels)
+            hits, total = lookups.get(labels['cache'], (0, 0))
+            lookups[labels['cache']] = (hits + (value if labels['result'] == 'hit' else 0), total + value)
+    if lookups:
+        lines.append('# HELP {0}cache_hit_ratio Fraction of the lookups in each cache that were hits'.format(PREFIX))
+        lines.append('# TYPE {0}cache_hit_ratio gauge'.format(PREFIX))
+        for cache, (hits, total) in sorted(lookups.items()):
+            lines.append('{0}cache_hit_ratio{{cache="{1}"}} {2!r}'.format(PREFIX, cache, float(hits) / total))
+
+    return '\n'.join(lines) + '\n'
+
+
+# Function to add the timing of requests to an app, and the /metrics endpoint
+def init_app(app):
+    @app.before_request
+    def metrics_start():
+        if ENABLED:
+            g.metrics_start = _clock()
+
+    @app.after_request
+    def metrics_finish(response):
+        if not ENABLED or 'metrics_start' not in g:
+            return response
+
+        seconds = _clock() - g.metrics_start
+        endpoint = request.endpoint or 'unknown'
+        observe('request_seconds', seconds, endpoint=endpoint)
+        count('requests_total', endpoint=endpoint, status=response.status_code)
+        size_in = request.content_length or 0
+        size_out = response.content_length
+        count('payload_bytes_total', size_in, direction='in')
+        if size_out:
+            count('payload_bytes_total', size_out, direction='out')
+
+        stages = getattr(g, 'metrics_stages', dict())
+        timing = ['{0};dur={1:.1f}'.format(stage, 1000 * t) for stage, t in stages.items()]
+        timing.append('total;dur={0:.1f}'.format(1000 * seconds))
+        response.headers['Server-Timing'] = ', '.join(timing)
+
+        if LOG:
+            logger.info(json.dumps({'endpoint': endpoint, 'path': request.path, 'status': response.status_code,
+                                    'seconds': round(seconds, 6), 'bytes_in': size_in, 'bytes_out': size_out,
+                                    'rows': getattr(g, 'metrics_rows', 0),
+                                    'stages': dict((s, round(t, 6)) for s, t in stages.items())}))
+        return response
+
+    @app.route('/metrics')
+    def app_metrics():
+        if not ENABLED:
+            return Response('Metrics are disabled\n', status=404, mimetype='text/plain')
+        return Response(prometheus_text(), mimetype='text/plain; version=0.0.4')
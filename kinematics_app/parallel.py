@@ -0,0 +1,129 @@
+"""
+Parallel XYZ/UVW for large inputs with a pool of worker processes.
+
+The input columns and the results are shared with the workers through memory-mapped files (in /dev/shm when
+available, so they stay in memory) instead of being pickled. Each worker calculates whole chunks of rows and writes
+them in place, so the results come out in the order of the inputs.
+"""
+
+from druvw import xyz_array, uvw_array
+import atexit
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import numpy as np
+
+DEFAULT_CHUNK_ROWS = 262144  # rows calculated by a worker at a time
+DEFAULT_MIN_ROWS = 500000  # smaller inputs are calculated in the calling process
+SHM_DIR = '/dev/shm'
+
+
+# Function to calculate a chunk of rows in a worker process
+def _xyzuvw_chunk(task):
+    inputs_path, outputs_path, n, dtype, start, stop = task
+    inputs = np.memmap(inputs_path, dtype=dtype, mode='r', shape=(6, n))
+    outputs = np.memmap(outputs_path, dtype=dtype, mode='r+', shape=(6, n))
+    ra, dec, dist, pmra, pmdec, rv = inputs[:, start:stop]
+    xyz_array(ra, dec, dist, dtype=dtype, out=outputs[:3, start:stop])
+    uvw_array(ra, dec, dist, pmra, pmdec, rv, dtype=dtype, out=outputs[3:, start:stop])
+    outputs.flush()
+    return start
+
+
+class ParallelCompute(object):
+    """
+    Process pool to calculate XYZ/UVW, created when first needed and shared by all requests of a process
+    """
+
+    def __init__(self, workers, chunk_rows=DEFAULT_CHUNK_ROWS, min_rows=DEFAULT_MIN_ROWS, tmpdir=None):
+        """
+        :param workers: Number of worker processes
+        :param chunk_rows: Number of rows calculated by a worker at a time
+        :param min_rows: Inputs with fewer rows are calculated in the calling process
+        :param tmpdir: Directory for the shared buffers, /dev/shm (or the system default) if not given
+        """
+
+        self.workers = workers
+        self.chunk_rows = chunk_rows
+        self.min_rows = min_rows
+        if tmpdir is None and os.path.isdir(SHM_DIR):
+            tmpdir = SHM_DIR
+        self.tmpdir = tmpdir
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        # Workers are started fresh rather than forked from a process that may be running threads
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context('spawn') if hasattr(multiprocessing, 'get_context') \
+                    else multiprocessing
+                self._pool = context.Pool(self.workers)
+                atexit.register(self.close)
+            return self._pool
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+    def xyzuvw(self, ra, dec, dist, pmra, pmdec, rv, dtype=np.float64):
+        """
+        :param ra, dec, dist, pmra, pmdec, rv: 1-D arrays of the same length (see druvw.uvw_array for the units)
+        :param dtype: Floating point type for the calculation
+
+        :return: Array of shape (6, N) with X, Y, Z, U, V, W
+        """
+
+        dtype = np.dtype(dtype)
+        n = len(ra)
+        if self.workers <= 1 or n < self.min_rows:
+            out = np.empty((6, n), dtype=dtype)
+            xyz_array(ra, dec, dist, dtype=dtype, out=out[:3])
+            uvw_array(ra, dec, dist, pmra, pmdec, rv, dtype=dtype, out=out[3:])
+            return out
+
+        folder = tempfile.mkdtemp(prefix='kinematics_', dir=self.tmpdir)
+        inputs = outputs = None
+        try:
+            inputs_path = os.path.join(folder, 'inputs')
+            outputs_path = os.path.join(folder, 'outputs')
+            inputs = np.memmap(inputs_path, dtype=dtype, mode='w+', shape=(6, n))
+            for i, col in enumerate([ra, dec, dist, pmra, pmdec, rv]):
+                inputs[i] = col
+            inputs.flush()
+            outputs = np.memmap(outputs_path, dtype=dtype, mode='w+', shape=(6, n))
+
+            tasks = [(inputs_path, outputs_path, n, dtype.str, start, min(start + self.chunk_rows, n))
+                     for start in range(0, n, self.chunk_rows)]
+            for _ in self.pool.imap_unordered(_xyzuvw_chunk, tasks):
+                pass
+
+            return np.array(outputs)  # copied out of the shared buffer, which is removed
+        finally:
+            inputs = outputs = None  # close the maps before removing the files
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+# Function to create the process pool from the app configuration
+def make_parallel(config):
+    """
+    :param config: Flask config (or dict) with PARALLEL_WORKERS (0 or 1 to calculate in the request, -1 for one
+        worker per core), PARALLEL_CHUNK_ROWS, PARALLEL_MIN_ROWS, and PARALLEL_TMPDIR
+
+    :return: ParallelCompute, or None if disabled
+    """
+
+    workers = int(config.get('PARALLEL_WORKERS', 0))
+    if workers < 0:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        return None
+
+    return ParallelCompute(workers, chunk_rows=int(config.get('PARALLEL_CHUNK_ROWS', DEFAULT_CHUNK_ROWS)),
+                           min_rows=int(config.get('PARALLEL_MIN_ROWS', DEFAULT_MIN_ROWS)),
+                           tmpdir=config.get('PARALLEL_TMPDIR') or None)
@@ -0,0 +1,307 @@
+"""
+Figures and table of the results page. Bokeh is only imported with this module, so that the app starts
+without it and loads it the first time a results page is built.
+
+The figures, table, and moving group overlay of a page only depend on its layout (kind of calculation, columns,
+points or densities), so they are built once per layout and reused, swapping in the data of each request.
+"""
+
+from bokeh.plotting import figure, gridplot
+from bokeh.embed import components
+from bokeh.models import ColumnDataSource, HoverTool, DataTable, TableColumn, NumberFormatter, CheckboxGroup, \
+    CustomJS
+from bokeh.palettes import Blues9
+from collections import OrderedDict
+from groups import NYMG
+from transport import encode_sources
+import metrics
+import threading
+import numpy as np
+
+DENSITY_BINS = 200  # number of bins per axis of the density images
+DENSITY_PALETTE = Blues9[::-1]  # light to dark
+SPARSE_COUNT = 2  # points in bins with at most this many points are drawn individually
+MAX_SPARSE_POINTS = 5000  # maximum number of individual points drawn in a density plot
+DENSITY_THRESHOLD = 20000  # default number of rows above which plots show densities instead of points
+TABLE_MAX_ROWS = 5000  # default number of rows shown in the table when plotting densities
+MAX_TEMPLATES = 32  # number of page layouts kept
+
+# Shows or hides the moving group overlay by emptying or restoring its data sources
+TOGGLE_OVERLAY = """
+var show = cb_obj.get('active').length > 0;
+[groups, labels].forEach(function (source) {
+    if (source._full === undefined) {
+        source._full = source.get('data');
+    }
+    var data = {};
+    for (var col in source._full) {
+        data[col] = show ? source._full[col] : [];
+    }
+    source.set('data', data);
+    source.trigger('change');
+});
+"""
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+# Function to build the figures and table of a results page
+def results_components(data, type_flag, hover_flags=(True, True), density_threshold=DENSITY_THRESHOLD,
+                       table_max_rows=TABLE_MAX_ROWS, inline=True, float32=True):
+    """
+    :param data: DataFrame of results with X, Y, Z, U, V, W columns
+    :param type_flag: Kind of calculation (normal, multi_rv, multi_dist, multi, fit, or upload), selects the tooltips
+    :param hover_flags: Whether to add tooltips to the XYZ and to the UVW plots
+    :param density_threshold: Number of rows above which plots show densities instead of points
+    :param table_max_rows: Number of rows shown in the table when plotting densities
+    :param inline: Whether to embed the data in the script, or to leave the data sources empty and return
+        their data separately, encoded with transport.encode_sources
+    :param float32: Send floating point columns as float32 when the data is not inline
+
+    :return: Script and dictionary of divs (plot, table, and overlay) to embed, number of rows shown in the table,
+        and the encoded data (None if inline)
+    """
+
+    # Large results are drawn as density images and only their first rows are shown in the table
+    density = len(data) > density_threshold
+    key = (type_flag, tuple(hover_flags), tuple(data.columns), density, len(data) > 1)
+
+    # Models can only be in one document at a time, so pages are rendered one after the other
+    with _templates_lock:
+        template = _templates.pop(key, None)
+        metrics.cache_lookup('figures', template is not None)
+        if template is None:
+            with metrics.timer('figures'):
+                template = FigureTemplate(data.columns, type_flag, hover_flags=hover_flags, density=density,
+                                          tabheight=400 if len(data) > 1 else 100)
+        _templates[key] = template
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+
+        return template.render(data, table_max_rows=table_max_rows, inline=inline, float32=float32)
+
+
+class FigureTemplate(object):
+    """
+    Figures, table, and moving group overlay of a results page, without data
+    """
+
+    def __init__(self, columns, type_flag, hover_flags=(True, True), density=False, tabheight=400):
+        """
+        :param columns: Columns of the results
+        :param type_flag: Kind of calculation, selects the tooltips
+        :param hover_flags: Whether to add tooltips to the XYZ and to the UVW plots
+        :param density: Whether the plots show densities instead of points
+        :param tabheight: Height of the table
+        """
+
+        self.source = ColumnDataSource(data=dict((col, []) for col in columns))
+        self.density_sources = [] if density else None
+        tools = "resize, pan, wheel_zoom, box_zoom, lasso_select, box_select, reset, save"
+        plot_size = 350
+        point_size = 10
+        point_color = 'black'
+
+        # Create the main plots
+        # XYZ Plots
+        p1 = my_plot('X', 'Y', self.source, 'X (pc)', 'Y (pc)', x_range=None, y_range=None,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[0],
+                     density_sources=self.density_sources)
+        p2 = my_plot('Y', 'Z', self.source, 'Y (pc)', 'Z (pc)', x_range=p1.y_range, y_range=None,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[0],
+                     density_sources=self.density_sources)
+        p3 = my_plot('X', 'Z', self.source, 'X (pc)', 'Z (pc)', x_range=p1.x_range, y_range=p2.y_range,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[0],
+                     density_sources=self.density_sources)
+
+        # UVW Plots
+        p4 = my_plot('U', 'V', self.source, 'U (km/s)', 'V (km/s)', x_range=None, y_range=None,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[1],
+                     density_sources=self.density_sources)
+        p5 = my_plot('V', 'W', self.source, 'V (km/s)', 'W (km/s)', x_range=p4.y_range, y_range=None,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[1],
+                     density_sources=self.density_sources)
+        p6 = my_plot('U', 'W', self.source, 'U (km/s)', 'W (km/s)', x_range=p4.x_range, y_range=p5.y_range,
+                     point_size=point_size, point_color=point_color, plot_size=plot_size, tools=tools,
+                     type_flag=type_flag, hover_flag=hover_flags[1],
+                     density_sources=self.density_sources)
+
+        # Nearby Young Moving Groups, which can be hidden in the browser
+        groups, labels = nymg_plot(p1, p2, p3, p4, p5, p6)
+        toggle = CheckboxGroup(labels=['Show nearby young moving groups'], active=[0])
+        toggle.callback = CustomJS(args={'groups': groups, 'labels': labels}, code=TOGGLE_OVERLAY)
+
+        columns = []
+        for col in self.source.column_names:
+            if col in ['Dist', 'RV', 'pmRA', 'pmDec', 'Name', 'Group']:
+                columns.append(TableColumn(field=col, title=col))
+            else:
+                columns.append(TableColumn(field=col, title=col, formatter=NumberFormatter(format='0.000')))
+        data_table = DataTable(source=self.source, columns=columns, row_headers=False, width=800, height=tabheight)
+
+        p = gridplot([[p1, p2, p3], [p4, p5, p6]], toolbar_location="left")
+        self.models = {'plot': p, 'table': data_table, 'overlay': toggle}
+
+    def render(self, data, table_max_rows=TABLE_MAX_ROWS, inline=True, float32=True):
+        """
+        :param data: DataFrame of results with the columns of the template
+        :param table_max_rows: Number of rows shown in the table when plotting densities
+        :param inline: Whether to embed the data in the script, or to send it separately
+        :param float32: Send floating point columns as float32 when the data is not inline
+
+        :return: Script and dictionary of divs to embed, number of rows shown in the table,
+            and the encoded data (None if inline)
+        """
+
+        with metrics.timer('plot_data'):
+            if self.density_sources is None:
+                self.source.data = ColumnDataSource.from_df(data)
+                sources = [self.source]
+            else:
+                self.source.data = ColumnDataSource.from_df(data.iloc[:table_max_rows])
+                sources = [self.source]
+                for xvar, yvar, image_source, points_source in self.density_sources:
+                    density_data(data, xvar, yvar, image_source, points_source)
+                    sources += [image_source, points_source]
+        table_rows = len(self.source.data['X'])
+
+        # Sources are emptied for the page and their data is encoded to be loaded by the browser
+        payload = None
+        if not inline:
+            with metrics.timer('encode'):
+                payload = encode_sources(dict((source.ref['id'], source.data) for source in sources),
+                                         float32=float32)
+            for source in sources:
+                source.data = dict((col, []) for col in source.data)
+
+        with metrics.timer('components'):
+            script, div_dict = components(self.models)
+        return script, div_dict, table_rows, payload
+
+
+# Function to plot the NYMG ovals
+def nymg_plot(p1,p2,p3,p4,p5,p6, groups=NYMG):
+    """
+    :return: Data sources of the ovals and of the labels, shared by all plots
+    """
+
+    # TODO: Decide on final colors for groups
+    # g_color = ['blue', 'green', 'red', 'yellow', 'magenta', 'cyan', 'grey']
+    # g_color = ['#7fc97f','#beaed4','#fdc086','#ffff99','#386cb0','#f0027f','#bf5b17'] #Accent
+    # g_color = ['#1b9e77','#d95f02','#7570b3','#e7298a','#66a61e','#e6ab02','#a6761d'] #Dark2
+    g_color = groups['color'].tolist()  # From Faherty paper
+
+    # Widths of the ovals are twice the dispersions
+    ovals = dict((col, groups[col].values) for col in ['X', 'Y', 'Z', 'U', 'V', 'W'])
+    ovals.update(('w' + col, groups['e' + col].values * 2) for col in ['X', 'Y', 'Z', 'U', 'V', 'W'])
+    ovals['color'] = g_color
+    ovals = ColumnDataSource(data=ovals)
+
+    g_name = groups['name'].tolist()
+    labels = ColumnDataSource(data={'name': g_name, 'color': g_color,
+                                    'y_xyz': [40 - y*6 for y in range(len(g_name))],
+                                    'y_uvw': [-20 - y*1.2 for y in range(len(g_name))]})
+
+    # Hover does not work for Oval :(
+    for p, xvar, yvar in [(p1, 'X', 'Y'), (p2, 'Y', 'Z'), (p3, 'X', 'Z'), (p4, 'U', 'V'), (p5, 'V', 'W'),
+                          (p6, 'U', 'W')]:
+        p.oval(x=xvar, y=yvar, width='w' + xvar, height='w' + yvar, color='color', source=ovals,
+               angle=0, height_units='data', width_units='data', fill_alpha=0.5)
+    p1.text(x=-60, y='y_xyz', text='name', text_color='color', source=labels, angle=0, text_font_size='8pt')
+    p4.text(x=-25, y='y_uvw', text='name', text_color='color', source=labels, angle=0, text_font_size='8pt')
+
+    # Update grid alpha
+    for p in [p1, p2, p3, p4, p5, p6]:
+        p.xgrid.grid_line_alpha = 0.2
+        p.ygrid.grid_line_alpha = 0.2
+
+    return ovals, labels
+
+
+# Function to make the basic plots
+def my_plot(xvar, yvar, source, xlabel, ylabel, point_size=10,
+            point_color='black', plot_size=350, tools="resize, pan, wheel_zoom, box_zoom, reset",
+            x_range=None, y_range=None, type_flag='normal', hover_flag=True, density_sources=None):
+    """
+    :param density_sources: List to which the data sources of a density plot are added (see density_glyphs),
+        or None to plot the points of source
+    """
+
+    p = figure(width=plot_size, plot_height=plot_size, title=None, tools=tools, x_range=x_range, y_range=y_range)
+    if density_sources is None:
+        points = p.scatter(xvar, yvar, source=source, size=point_size, color=point_color)
+    else:
+        image_source, points_source, points = density_glyphs(p, source.column_names, xvar, yvar,
+                                                             point_size=point_size, point_color=point_color)
+        density_sources.append((xvar, yvar, image_source, points_source))
+    p.xaxis.axis_label = xlabel
+    p.yaxis.axis_label = ylabel
+
+    if type_flag == "normal":
+        tooltip = {"(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
+    if type_flag == 'multi_rv':
+        tooltip = {"RV": "@RV", "(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
+    if type_flag == 'multi_dist':
+        tooltip = {"Dist": "@Dist", "(X,Y,Z)": "(@X, @Y, @Z)", "(U,V,W)": "(@U, @V, @W)"}
+    if type_flag in ['multi', 'fit']:
+        tooltip = [(col, "@" + col) for col in ['Dist', 'RV', 'pmRA', 'pmDec'] if col in source.column_names]
+        tooltip += [("(X,Y,Z)", "(@X, @Y, @Z)"), ("(U,V,W)", "(@U, @V, @W)")]
+    if type_flag == 'upload':
+        # this format preserves order
+        tooltip = [("Name", "@Name"), ("(X,Y,Z)", "(@X, @Y, @Z)"), ("(U,V,W)", "(@U, @V, @W)")]
+
+    if hover_flag:
+        p.add_tools(HoverTool(tooltips=tooltip, renderers=[points]))
+
+    return p
+
+
+# Function to draw a large number of points as a density image
+def density_glyphs(p, columns, xvar, yvar, point_size=10, point_color='black'):
+    """
+    Draw the 2D histogram of two columns as an image, with individual points only in sparse bins.
+    The amount of data sent to the browser depends on the number of bins, not the number of rows.
+    The glyphs are drawn without data, which is filled in by density_data.
+
+    :param columns: Columns of the data, all of which are kept for the individual points
+
+    :return: Data source of the image, data source and renderer of the individual points
+    """
+
+    image_source = ColumnDataSource(data={'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []})
+    p.image(image='image', x='x', y='y', dw='dw', dh='dh', source=image_source, palette=DENSITY_PALETTE)
+
+    points_source = ColumnDataSource(data=dict((col, []) for col in columns))
+    points = p.scatter(xvar, yvar, source=points_source, size=point_size, color=point_color)
+
+    return image_source, points_source, points
+
+
+# Function to fill the data sources of a density plot
+def density_data(data, xvar, yvar, image_source, points_source, bins=DENSITY_BINS, sparse_count=SPARSE_COUNT):
+    x = data[xvar].values
+    y = data[yvar].values
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    x, y = x[finite], y[finite]
+    if len(x) == 0:
+        image_source.data = {'image': [], 'x': [], 'y': [], 'dw': [], 'dh': []}
+        points_source.data = ColumnDataSource.from_df(data.iloc[:0])
+        return
+
+    counts, xedges, yedges = np.histogram2d(x, y, bins=bins)
+
+    # Log of the counts, transposed since images are indexed as [y, x]
+    image_source.data = {'image': [np.log10(counts.T + 1)], 'x': [xedges[0]], 'y': [yedges[0]],
+                         'dw': [xedges[-1] - xedges[0]], 'dh': [yedges[-1] - yedges[0]]}
+
+    # Individual points in the sparse bins
+    ix = np.clip(np.searchsorted(xedges, x, side='right') - 1, 0, bins - 1)
+    iy = np.clip(np.searchsorted(yedges, y, side='right') - 1, 0, bins - 1)
+    sparse = finite[counts[ix, iy] <= sparse_count][:MAX_SPARSE_POINTS]
+    points_source.data = ColumnDataSource.from_df(data.iloc[sparse])
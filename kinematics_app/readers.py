@@ -0,0 +1,181 @@
+"""
+Readers for binary columnar catalogs (FITS tables, HDF5, NumPy .npy/.npz, and Parquet), read in chunks of rows.
+
+Files given as paths are memory-mapped where the format allows it (FITS, .npy, Parquet), so only the rows of the
+chunk being processed are read from the disk. Uploaded files are read from their file-like objects.
+
+Reading is not zero-copy: the rows of each chunk are copied once, into native byte order (FITS is big-endian)
+and into the DataFrame that catalog.process_chunk works on. Memory use is bounded by the chunk size, not the file.
+"""
+
+import importlib
+import numpy as np
+
+# pandas and the libraries of each format (all optional) are imported when a table is read,
+# so that the app starts without them
+
+
+def _require(module, fmt):
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise TableError('{0} files need {1}'.format(fmt, module.split('.')[0]))
+
+
+# Error reading a binary table, shown to the user
+class TableError(ValueError):
+    pass
+
+
+def _is_path(source):
+    return not hasattr(source, 'read')
+
+
+def _native(values):
+    # Numeric columns in the native byte order (FITS is big-endian), text columns decoded; this copies the rows
+    # of a chunk out of the memory-mapped file
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return np.char.decode(values, 'utf-8').astype(object)
+    if values.dtype.byteorder not in '=|':
+        return values.astype(values.dtype.newbyteorder('='))
+    return values
+
+
+def _columns(names, shapes):
+    # Only one-dimensional columns can be used
+    return [name for name, shape in zip(names, shapes) if len(shape) == 0]
+
+
+class BinaryTable(object):
+    """
+    A table in a binary file, read in chunks of rows.
+    Each format opens the file and sets nrows, columns, and either a function read(start, stop) that returns
+    the values of the columns for those rows or a function batches(chunksize) that yields them chunk by chunk.
+    """
+
+    def __init__(self, source, fmt):
+        if fmt not in BINARY_FORMATS:
+            raise TableError('Unknown format: {0}'.format(fmt))
+        self.handle = None
+        BINARY_FORMATS[fmt](self, source)
+
+    def chunks(self, chunksize):
+        """
+        :return: Generator of DataFrames with chunksize rows and the original column names
+        """
+
+        import pandas as pd
+
+        if hasattr(self, 'batches'):
+            batches = self.batches(chunksize)
+        else:
+            batches = (self.read(start, min(start + chunksize, self.nrows))
+                       for start in range(0, self.nrows, chunksize))
+        try:
+            for values in batches:
+                yield pd.DataFrame(dict((col, _native(values[col])) for col in self.columns), columns=self.columns)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+def _open_fits(table, source):
+    fits = _require('astropy.io.fits', 'FITS')
+    table.handle = fits.open(source, memmap=_is_path(source))
+    hdus = [hdu for hdu in table.handle if isinstance(hdu, (fits.BinTableHDU, fits.TableHDU))]
+    if not hdus:
+        table.close()
+        raise TableError('The FITS file has no table')
+    data = hdus[0].data
+    if data is None:  # table without rows
+        table.nrows, table.columns = 0, []
+        return
+    names = hdus[0].columns.names
+    fields = dict((col, data.field(col)) for col in names)  # views of the memory-mapped file
+    table.nrows = len(data)
+    table.columns = _columns(names, [fields[col].shape[1:] for col in names])
+    table.read = lambda start, stop: dict((col, fields[col][start:stop]) for col in table.columns)
+
+
+def _open_npy(table, source):
+    arr = np.load(source, mmap_mode='r' if _is_path(source) else None)
+    if arr.dtype.names is None or arr.ndim != 1:
+        raise TableError('.npy files must have a structured array with named columns')
+    table.nrows = len(arr)
+    table.columns = _columns(arr.dtype.names, [arr.dtype[c].shape for c in arr.dtype.names])
+    table.read = lambda start, stop: dict((col, arr[col][start:stop]) for col in table.columns)
+
+
+def _open_npz(table, source):
+    # Members of the archive are compressed, so each column is loaded once when the file is opened
+    archive = np.load(source)
+    arrays = dict((key, archive[key]) for key in archive.files)
+    archive.close()
+    table.columns = _columns(arrays.keys(), [arrays[key].shape[1:] for key in arrays])
+    lengths = set(len(arrays[col]) for col in table.columns)
+    if len(lengths) != 1:
+        raise TableError('.npz files must have one-dimensional arrays of the same length')
+    table.nrows = lengths.pop()
+    table.read = lambda start, stop: dict((col, arrays[col][start:stop]) for col in table.columns)
+
+
+def _open_hdf5(table, source):
+    h5py = _require('h5py', 'HDF5')
+    table.handle = h5py.File(source, 'r')
+
+    # Either a dataset with a compound type or a group of one-dimensional datasets
+    datasets = [table.handle[key] for key in table.handle]
+    compound = [d for d in datasets if isinstance(d, h5py.Dataset) and d.dtype.names is not None]
+    if compound:
+        dataset = compound[0]
+        table.nrows = len(dataset)
+        table.columns = _columns(dataset.dtype.names, [dataset.dtype[c].shape for c in dataset.dtype.names])
+        table.read = lambda start, stop: dataset[start:stop]
+        return
+
+    groups = [table.handle] + [d for d in datasets if isinstance(d, h5py.Group)]
+    for group in groups:
+        columns = dict((key, group[key]) for key in group if isinstance(group[key], h5py.Dataset) and
+                       group[key].ndim == 1)
+        if columns and len(set(len(d) for d in columns.values())) == 1:
+            table.columns = sorted(columns)
+            table.nrows = len(columns[table.columns[0]])
+            table.read = lambda start, stop: dict((col, columns[col][start:stop]) for col in table.columns)
+            return
+    table.close()
+    raise TableError('The HDF5 file has no table')
+
+
+def _open_parquet(table, source):
+    pq = _require('pyarrow.parquet', 'Parquet')
+    table.handle = pq.ParquetFile(source, memory_map=_is_path(source))
+    table.nrows = table.handle.metadata.num_rows
+    table.columns = table.handle.schema_arrow.names
+    table.batches = lambda chunksize: (dict((col, batch.column(i).to_numpy(zero_copy_only=False))
+                                            for i, col in enumerate(batch.schema.names))
+                                       for batch in table.handle.iter_batches(batch_size=chunksize))
+
+
+# Extension: function to open a binary table of that format
+BINARY_FORMATS = {'fits': _open_fits, 'fit': _open_fits,
+                  'h5': _open_hdf5, 'hdf5': _open_hdf5,
+                  'npy': _open_npy, 'npz': _open_npz,
+                  'parquet': _open_parquet, 'pq': _open_parquet}
+
+
+# Function to get the binary format of a file from its name, None for text files
+def binary_format(filename):
+    fmt = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return fmt if fmt in BINARY_FORMATS else None
+
+
+# Function to count the rows of a binary table without reading them
+def count_rows(source, fmt):
+    table = BinaryTable(source, fmt)
+    table.close()
+    return table.nrows
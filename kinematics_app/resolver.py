@@ -0,0 +1,246 @@
+"""
+Name resolution with Simbad, with a persistent cache of the results
+"""
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import tempfile
+import time
+import numpy as np
+import metrics
+
+PARAMETERS = ['ra', 'dec', 'pmra', 'pmdec', 'rv', 'plx']
+DEFAULT_TTL = 30 * 24 * 3600  # seconds to keep resolved names
+DEFAULT_NEGATIVE_TTL = 24 * 3600  # seconds to remember names that could not be resolved
+BATCH_SIZE = 1000  # maximum number of names sent in one query
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'simbad_cache.sqlite')
+
+
+def _missing(value):
+    # None or NaN, like pandas.isnull for single values
+    try:
+        return value is None or bool(np.isnan(value))
+    except TypeError:
+        return False
+
+
+# Function to normalize object names so that equivalent spellings share a cache entry
+def normalize_name(name):
+    return ' '.join(str(name).split()).upper()
+
+
+class SimbadBackend(object):
+    """
+    Backend that queries Simbad with astroquery
+    """
+
+    def __init__(self):
+        from astroquery.simbad import Simbad
+
+        self.simbad = Simbad()
+        self.simbad.remove_votable_fields('coordinates')
+        self.simbad.add_votable_fields('typed_id', 'ra(d)', 'dec(d)', 'pmra', 'pmdec', 'rv_value', 'plx')
+
+    def query(self, names):
+        """
+        Query Simbad for several names at once.
+
+        :param names: List of object names
+
+        :return: Dictionary of name: dictionary of PARAMETERS, for the names that were found
+        """
+
+        table = self.simbad.query_objects(names)
+        if table is None:  # nothing found
+            return dict()
+
+        df = table.to_pandas()
+        results = dict()
+        for _, row in df.iterrows():
+            name = row['TYPED_ID']
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            if _missing(row['RA_d']):  # unresolved names can come back as empty rows
+                continue
+            results[name] = {'ra': row['RA_d'], 'dec': row['DEC_d'], 'pmra': row['PMRA'], 'pmdec': row['PMDEC'],
+                             'rv': row['RV_VALUE'], 'plx': row['PLX_VALUE']}
+        return results
+
+
+class LocalBackend(object):
+    """
+    Backend that looks up names in a local table, used in place of Simbad for offline work and testing
+    """
+
+    def __init__(self, table, latency=0):
+        """
+        :param table: DataFrame or csv file with a name column and the PARAMETERS columns
+        :param latency: Seconds to wait in each query, to mimic a remote service
+        """
+
+        if not hasattr(table, 'iterrows'):  # a file name rather than a DataFrame
+            import pandas as pd
+            table = pd.read_csv(table)
+        self.table = dict((normalize_name(row['name']), dict((p, row[p]) for p in PARAMETERS))
+                          for _, row in table.iterrows())
+        self.latency = latency
+        self.nqueries = 0
+
+    def query(self, names):
+        self.nqueries += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return dict((name, self.table[normalize_name(name)]) for name in names
+                    if normalize_name(name) in self.table)
+
+
+class ResolverCache(object):
+    """
+    Cache of resolved names in a local SQLite file.
+    Names that could not be resolved are also stored, for a shorter time.
+    The file is only created when the cache is first used.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._created = False
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                if not self._created:
+                    conn.execute('CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, found INTEGER, '
+                                 'stored REAL, ' + ', '.join(p + ' REAL' for p in PARAMETERS) + ')')
+                    self._created = True
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, names):
+        """
+        :param names: List of normalized names
+
+        :return: Dictionary of name: dictionary of PARAMETERS (or None if known to be unresolvable)
+        """
+
+        now = time.time()
+        results = dict()
+        with self._connect() as conn:
+            for i in range(0, len(names), 500):  # keep under the SQLite limit of query parameters
+                batch = names[i:i + 500]
+                rows = conn.execute('SELECT name, found, stored, ' + ', '.join(PARAMETERS) +
+                                    ' FROM names WHERE name IN (' + ', '.join(['?'] * len(batch)) + ')', batch)
+                for row in rows:
+                    name, found, stored = row[:3]
+                    if now - stored > (self.ttl if found else self.negative_ttl):
+                        continue
+                    if found:
+                        results[name] = dict((p, np.nan if v is None else v) for p, v in zip(PARAMETERS, row[3:]))
+                    else:
+                        results[name] = None
+        return results
+
+    def set(self, results):
+        """
+        :param results: Dictionary of normalized name: dictionary of PARAMETERS, or None if not found
+        """
+
+        now = time.time()
+        rows = []
+        for name, values in results.items():
+            if values is None:
+                rows.append([name, 0, now] + [None] * len(PARAMETERS))
+            else:
+                rows.append([name, 1, now] + [None if _missing(values[p]) else float(values[p]) for p in PARAMETERS])
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO names VALUES (' + ', '.join(['?'] * (3 + len(PARAMETERS))) + ')',
+                             rows)
+
+
+class Resolver(object):
+    """
+    Resolve object names with a backend, going through the cache first
+    """
+
+    def __init__(self, backend=None, cache=None):
+        """
+        :param backend: Object with a query(names) method, SimbadBackend if not given
+        :param cache: ResolverCache, or None to not cache results
+        """
+
+        self._backend = backend
+        self.cache = cache
+
+    @property
+    def backend(self):
+        # Created when first needed, so astroquery is only imported if Simbad is actually queried
+        if self._backend is None:
+            self._backend = SimbadBackend()
+        return self._backend
+
+    def resolve(self, name):
+        """
+        :return: Dictionary of PARAMETERS for name, or None if it could not be resolved
+        """
+
+        return self.resolve_many([name]).get(name)
+
+    def resolve_many(self, names):
+        """
+        Resolve several names, querying the backend only once per BATCH_SIZE names missing from the cache.
+
+        :param names: List of object names
+
+        :return: Dictionary of name: dictionary of PARAMETERS, for the names that were resolved
+        """
+
+        keys = dict((name, normalize_name(name)) for name in names)
+        unique = sorted(set(keys.values()))
+
+        found = self.cache.get(unique) if self.cache is not None else dict()
+        missing = [name for name in unique if name not in found]
+        metrics.count('cache_requests_total', len(unique) - len(missing), cache='simbad', result='hit')
+        metrics.count('cache_requests_total', len(missing), cache='simbad', result='miss')
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            with metrics.timer('simbad'):
+                start = time.time()
+                results = self.backend.query(batch)
+                metrics.observe('simbad_query_seconds', time.time() - start)
+            results = dict((normalize_name(name), values) for name, values in results.items())
+            results = dict((name, results.get(name)) for name in batch)
+            if self.cache is not None:
+                self.cache.set(results)
+            found.update(results)
+
+        return dict((name, found[key]) for name, key in keys.items() if found.get(key) is not None)
+
+
+# Function to create the resolver from the app configuration
+def make_resolver(config):
+    """
+    Create a Resolver from the configuration.
+
+    :param config: Flask config (or dict) with SIMBAD_CACHE_PATH (empty to disable the cache), SIMBAD_CACHE_TTL,
+        SIMBAD_NEGATIVE_TTL, SIMBAD_LOCAL_TABLE (csv file to use instead of Simbad), and SIMBAD_LATENCY
+        (seconds added to each query of the local table, to mimic Simbad in load tests)
+
+    :return: Resolver
+    """
+
+    cache = None
+    path = config.get('SIMBAD_CACHE_PATH', DEFAULT_CACHE_PATH)
+    if path:
+        cache = ResolverCache(path, ttl=float(config.get('SIMBAD_CACHE_TTL', DEFAULT_TTL)),
+                              negative_ttl=float(config.get('SIMBAD_NEGATIVE_TTL', DEFAULT_NEGATIVE_TTL)))
+
+    backend = None
+    if config.get('SIMBAD_LOCAL_TABLE'):
+        backend = LocalBackend(config['SIMBAD_LOCAL_TABLE'], latency=float(config.get('SIMBAD_LATENCY', 0)))
+
+    return Resolver(backend=backend, cache=cache)
@@ -0,0 +1,222 @@
+"""
+Spatial index of the results, to find the stars near a position or velocity without scanning all of them.
+
+A KD-tree is built over XYZ, UVW, or the 6-D XYZ-UVW coordinates of a result set the first time it is queried.
+Its arrays are saved in the result store next to the results, so other workers and later requests load it instead
+of building it again, and the last trees used are also kept in a small in-process cache. Queries then only visit
+the nodes near the point.
+In 6-D, velocities are scaled by VELOCITY_SCALE (pc per km/s) so that both halves are in comparable units.
+"""
+
+from collections import OrderedDict
+import heapq
+import threading
+import numpy as np
+from store import input_key
+import metrics
+
+SPACES = {'xyz': ['X', 'Y', 'Z'], 'uvw': ['U', 'V', 'W'], 'xyzuvw': ['X', 'Y', 'Z', 'U', 'V', 'W']}
+VELOCITY_SCALE = 1.0227121650537077  # pc per km/s: the distance travelled in 1 Myr
+LEAF_SIZE = 64  # number of points in the leaves of the tree
+MAX_INDEXES = 8  # number of indexes kept in each process
+TREE_ARRAYS = ['idx', 'start', 'end', 'children', 'lo', 'hi']  # what is saved of a tree, the points are not
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+class KDTree(object):
+    """
+    KD-tree over an array of points, stored as arrays of nodes: each node covers the points idx[start:end]
+    and has the bounding box of those points. Nodes are split at the median of their widest dimension.
+    """
+
+    def __init__(self, points, leaf_size=LEAF_SIZE, arrays=None):
+        """
+        :param points: Array of shape (N, D), rows with missing values are left out of the tree
+        :param arrays: Dictionary of the TREE_ARRAYS of a tree built earlier over the same points, to use instead
+            of building it
+        """
+
+        self.points = np.asarray(points, dtype=float)
+        if arrays is not None:
+            for name in TREE_ARRAYS:
+                setattr(self, name, arrays[name])
+            return
+
+        self.idx = np.flatnonzero(np.isfinite(self.points).all(axis=1))
+        starts, ends, children, lo, hi = [], [], [], [], []
+
+        stack = [(0, len(self.idx), None, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(starts)
+            if parent is not None:
+                children[parent][side] = node
+            sub = self.points[self.idx[start:end]]
+            starts.append(start)
+            ends.append(end)
+            children.append([-1, -1])
+            lo.append(sub.min(axis=0) if end > start else np.full(self.points.shape[1], np.inf))
+            hi.append(sub.max(axis=0) if end > start else np.full(self.points.shape[1], -np.inf))
+
+            if end - start > leaf_size:
+                dim = np.argmax(hi[-1] - lo[-1])
+                mid = (end - start) // 2
+                order = np.argpartition(sub[:, dim], mid)
+                self.idx[start:end] = self.idx[start:end][order]
+                stack.append((start + mid, end, node, 1))
+                stack.append((start, start + mid, node, 0))
+
+        self.start = np.array(starts)
+        self.end = np.array(ends)
+        self.children = np.array(children)
+        self.lo = np.array(lo)
+        self.hi = np.array(hi)
+
+    def arrays(self):
+        """
+        :return: Dictionary of the TREE_ARRAYS, to save the tree without its points
+        """
+
+        return dict((name, getattr(self, name)) for name in TREE_ARRAYS)
+
+    def _min_dist2(self, node, point):
+        # Squared distance from a point to the bounding box of a node
+        d = np.maximum(self.lo[node] - point, 0) + np.maximum(point - self.hi[node], 0)
+        return np.dot(d, d)
+
+    def _max_dist2(self, node, point):
+        # Squared distance from a point to the farthest corner of the bounding box of a node
+        d = np.maximum(np.abs(point - self.lo[node]), np.abs(self.hi[node] - point))
+        return np.dot(d, d)
+
+    def _rows(self, node):
+        return self.idx[self.start[node]:self.end[node]]
+
+    def knn(self, point, k=10):
+        """
+        :return: Row numbers of the k nearest points, sorted by distance, and their distances
+        """
+
+        point = np.asarray(point, dtype=float)
+        best_rows, best_d2 = np.empty(0, dtype=int), np.empty(0)
+        if k < 1:
+            return best_rows, best_d2
+        heap = [(self._min_dist2(0, point), 0)]
+        while heap:
+            d2, node = heapq.heappop(heap)
+            if len(best_d2) == k and d2 > best_d2[-1]:
+                break
+            left, right = self.children[node]
+            if left < 0:
+                rows = self._rows(node)
+                diff = self.points[rows] - point
+                rows_d2 = np.einsum('ij,ij->i', diff, diff)
+                best_rows = np.concatenate([best_rows, rows])
+                best_d2 = np.concatenate([best_d2, rows_d2])
+                order = np.argsort(best_d2, kind='mergesort')[:k]
+                best_rows, best_d2 = best_rows[order], best_d2[order]
+            else:
+                for child in [left, right]:
+                    heapq.heappush(heap, (self._min_dist2(child, point), child))
+        return best_rows, np.sqrt(best_d2)
+
+    def radius(self, point, r):
+        """
+        :return: Row numbers of the points within a distance r, sorted by distance, and their distances
+        """
+
+        point = np.asarray(point, dtype=float)
+        r2 = r ** 2
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self._min_dist2(node, point) > r2:
+                continue
+            left, right = self.children[node]
+            if left < 0 or self._max_dist2(node, point) <= r2:
+                rows = self._rows(node)
+                if left < 0:
+                    diff = self.points[rows] - point
+                    rows = rows[np.einsum('ij,ij->i', diff, diff) <= r2]
+                found.append(rows)
+            else:
+                stack.extend([left, right])
+
+        rows = np.concatenate(found) if found else np.empty(0, dtype=int)
+        distance = np.sqrt(((self.points[rows] - point) ** 2).sum(axis=1))
+        order = np.argsort(distance, kind='mergesort')
+        return rows[order], distance[order]
+
+    def box(self, lower, upper):
+        """
+        :return: Row numbers of the points with lower <= coordinates <= upper, in increasing order
+        """
+
+        lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if (self.hi[node] < lower).any() or (self.lo[node] > upper).any():
+                continue
+            left, right = self.children[node]
+            inside = (self.lo[node] >= lower).all() and (self.hi[node] <= upper).all()
+            if left < 0 or inside:
+                rows = self._rows(node)
+                if not inside:
+                    values = self.points[rows]
+                    rows = rows[((values >= lower) & (values <= upper)).all(axis=1)]
+                found.append(rows)
+            else:
+                stack.extend([left, right])
+
+        return np.sort(np.concatenate(found)) if found else np.empty(0, dtype=int)
+
+
+# Function to get the coordinates of a table in a space, with velocities scaled in 6-D
+def coordinates(data, space):
+    if space not in SPACES:
+        raise ValueError('Unknown space: {0}, use one of {1}'.format(space, ', '.join(sorted(SPACES))))
+    values = np.column_stack([np.asarray(data[col], dtype=float) for col in SPACES[space]])
+    if space == 'xyzuvw':
+        values[:, 3:] *= VELOCITY_SCALE
+    return values
+
+
+# Function to get the index of a result set, built the first time it is needed
+def get_index(key, data, space, store=None):
+    """
+    :param key: Key of the results in the result store
+    :param data: DataFrame of the results, with X, Y, Z, U, V, W columns
+    :param space: xyz, uvw, or xyzuvw
+    :param store: Result store (see store.py) where the tree is saved and looked for, None to only keep it here
+
+    :return: KDTree over the coordinates of the results
+    """
+
+    cache_key = (key, space, len(data))
+    with _indexes_lock:
+        index = _indexes.pop(cache_key, None)
+        if index is not None:
+            _indexes[cache_key] = index
+    metrics.cache_lookup('spatial', index is not None)
+    if index is not None:
+        return index
+
+    store_key = input_key('spatial', key, space)
+    saved = store.get(store_key) if store is not None else None
+    with metrics.timer('index'):
+        if saved is not None and saved['rows'] == len(data):
+            index = KDTree(coordinates(data, space), arrays=saved['arrays'])
+        else:
+            index = KDTree(coordinates(data, space))
+            if store is not None:
+                store.set(store_key, {'rows': len(data), 'arrays': index.arrays()})
+    with _indexes_lock:
+        _indexes[cache_key] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
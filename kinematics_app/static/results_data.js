@@ -0,0 +1,77 @@
+// Loads the data of a results page, encoded by transport.encode_sources, into its Bokeh data sources
+var ARRAY_TYPES = {
+    'float32': Float32Array, 'float64': Float64Array, 'int32': Int32Array,
+    'uint8': Uint8Array, 'uint16': Uint16Array, 'uint32': Uint32Array
+};
+
+function decode_text(bytes) {
+    if (window.TextDecoder !== undefined) {
+        return new TextDecoder('utf-8').decode(bytes);
+    }
+    var text = '';
+    for (var i = 0; i < bytes.length; i += 8192) {
+        text += String.fromCharCode.apply(null, bytes.subarray(i, i + 8192));
+    }
+    return decodeURIComponent(escape(text));
+}
+
+// Function to turn a column of the payload into an array, nested for images
+function decode_column(buffer, start, description) {
+    var shape = description.shape;
+    var size = shape.reduce(function (a, b) { return a * b; }, 1);
+    var values = new ARRAY_TYPES[description.dtype](buffer, start + description.offset, size);
+
+    if (description.categories !== undefined) {
+        var text = new Array(size);
+        for (var i = 0; i < size; i++) {
+            text[i] = description.categories[values[i]];
+        }
+        values = text;
+    }
+
+    function nest(values, shape) {
+        if (shape.length === 1) {
+            return values;
+        }
+        var step = values.length / shape[0], rows = [];
+        for (var i = 0; i < shape[0]; i++) {
+            rows.push(nest(values.slice(i * step, (i + 1) * step), shape.slice(1)));
+        }
+        return rows;
+    }
+    return nest(values, shape);
+}
+
+function load_results_data(url) {
+    Bokeh.$(function () {
+        var request = new XMLHttpRequest();
+        request.open('GET', url);
+        request.responseType = 'arraybuffer';
+        request.onload = function () {
+            if (request.status !== 200) {
+                return;
+            }
+            var buffer = request.response;
+            var length = new DataView(buffer).getUint32(0, true);
+            var header = JSON.parse(decode_text(new Uint8Array(buffer, 4, length)));
+            var start = 4 + length;
+
+            // Any view gives the document with the data sources
+            var doc = null;
+            for (var id in Bokeh.index) {
+                doc = Bokeh.index[id].model.document;
+                break;
+            }
+            for (var source_id in header) {
+                var source = doc.get_model_by_id(source_id);
+                var data = {};
+                for (var col in header[source_id]) {
+                    data[col] = decode_column(buffer, start, header[source_id][col]);
+                }
+                source.set('data', data);
+                source.trigger('change');
+            }
+        };
+        request.send();
+    });
+}
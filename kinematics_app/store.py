@@ -0,0 +1,189 @@
+"""
+Bounded stores for computed results, shared by all sessions.
+Entries are keyed by a hash of the inputs and evicted by age (TTL), count and total size (LRU).
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+import metrics
+
+DEFAULT_TTL = 3600  # seconds
+DEFAULT_MAX_ITEMS = 100
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+# Function to create a key from the inputs of a calculation
+def input_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode('utf-8'))
+    return h.hexdigest()
+
+
+# Function to create a key from the contents of a file-like object, which is rewound afterwards
+def stream_key(stream, blocksize=1024 * 1024):
+    h = hashlib.sha1()
+    for block in iter(lambda: stream.read(blocksize), b''):
+        h.update(block)
+    stream.seek(0)
+    return h.hexdigest()
+
+
+# Function to estimate the memory used by a stored value
+def value_size(value):
+    if isinstance(value, dict):
+        return sum(value_size(v) for v in value.values())
+    if hasattr(value, 'memory_usage'):  # DataFrame, checked without importing pandas
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class MemoryStore(object):
+    """
+    In-process LRU store. Safe to use from several threads, but not shared between worker processes.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()  # key: (value, size, time stored), oldest access first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and time.time() - item[2] > self.ttl:
+                self.nbytes -= item[1]
+                item = None
+            metrics.cache_lookup('results', item is not None)
+            if item is None:
+                return None
+            self._items[key] = item  # mark as most recently used
+            return item[0]
+
+    def set(self, key, value):
+        size = value_size(value)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size, time.time())
+            self.nbytes += size
+            self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None:
+                self.nbytes -= item[1]
+
+    def _evict(self):
+        now = time.time()
+        for key in [k for k, item in self._items.items() if now - item[2] > self.ttl]:
+            self.nbytes -= self._items.pop(key)[1]
+        while len(self._items) > self.max_items or self.nbytes > self.max_bytes:
+            self.nbytes -= self._items.popitem(last=False)[1][1]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteStore(object):
+    """
+    Store kept in a local SQLite file, so it can be shared by several worker processes on the same host.
+    Values are pickled.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                         'created REAL, accessed REAL)')
+
+    @contextmanager
+    def _connect(self):
+        # Connection per operation, committed on success and always closed
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT value FROM results WHERE key = ? AND created > ?',
+                               (key, now - self.ttl)).fetchone()
+            metrics.cache_lookup('results', row is not None)
+            if row is None:
+                return None
+            conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value):
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                         (key, sqlite3.Binary(blob), len(blob), now, now))
+            self._evict(conn, now)
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM results WHERE created <= ?', (now - self.ttl,))
+        count, nbytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        rows = conn.execute('SELECT key, size FROM results ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if count <= self.max_items and nbytes <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            count -= 1
+            nbytes -= size
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+# Function to create the result store from the app configuration
+def make_store(config):
+    """
+    Create the result store selected by config['RESULT_STORE'] ('memory' or 'sqlite').
+
+    :param config: Flask config (or dict) with RESULT_STORE, RESULT_STORE_PATH, RESULT_STORE_TTL,
+        RESULT_STORE_MAX_ITEMS, and RESULT_STORE_MAX_BYTES
+
+    :return: MemoryStore or SQLiteStore
+    """
+
+    kwargs = dict(ttl=float(config.get('RESULT_STORE_TTL', DEFAULT_TTL)),
+                  max_items=int(config.get('RESULT_STORE_MAX_ITEMS', DEFAULT_MAX_ITEMS)),
+                  max_bytes=int(config.get('RESULT_STORE_MAX_BYTES', DEFAULT_MAX_BYTES)))
+
+    kind = config.get('RESULT_STORE', 'memory')
+    if kind == 'memory':
+        return MemoryStore(**kwargs)
+    if kind == 'sqlite':
+        return SQLiteStore(config.get('RESULT_STORE_PATH', 'results.sqlite'), **kwargs)
+
+    raise ValueError('Unknown result store: {0}'.format(kind))
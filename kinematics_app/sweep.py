@@ -0,0 +1,91 @@
+"""
+Parameter sweeps: XYZ/UVW over grids of distances, radial velocities, and proper motions
+"""
+
+from druvw import cached_basis, xyzuvw_from_basis
+import numpy as np
+
+SWEEP_PARAMETERS = ['dist', 'rv', 'pmra', 'pmdec']
+SWEEP_COLUMNS = {'dist': 'Dist', 'rv': 'RV', 'pmra': 'pmRA', 'pmdec': 'pmDec'}  # names in the result tables
+MAX_GRID_SIZE = 1000000  # default maximum number of points in a sweep
+
+
+# Function to build the values of a range, including the final value
+def sweep_range(ini, fin, step, max_size=MAX_GRID_SIZE):
+    if step <= 0 or fin < ini:
+        raise ValueError('The step must be positive and the final value larger than the initial one')
+    if (fin - ini) / step >= max_size:
+        raise ValueError('The range from {0} to {1} in steps of {2} has too many values'.format(ini, fin, step))
+
+    values = np.arange(ini, fin, step)
+    if len(values) == 0 or values[-1] != fin:
+        values = np.append(values, fin)
+    return values
+
+
+def _axis(values, i, ndim):
+    # Reshape a 1-D array to lie along axis i of an ndim-dimensional grid
+    shape = [1] * ndim
+    shape[i] = len(values)
+    return np.asarray(values, dtype=float).reshape(shape)
+
+
+# Function to calculate XYZ/UVW over a grid of parameters
+def sweep_grid(stars, ranges, max_size=MAX_GRID_SIZE):
+    """
+    Calculate XYZ and UVW for every star and every combination of the swept parameters.
+    The grid is evaluated by broadcasting, so inputs are never replicated, as an affine function of the swept
+    values: each output is one product and one sum over the grid.
+
+    :param stars: DataFrame or dictionary of 1-D arrays with ra, dec, and the parameters that are not swept,
+        one value per star
+    :param ranges: Dictionary of parameter (one of SWEEP_PARAMETERS): 1-D array of values to sweep
+    :param max_size: Maximum number of points in the grid
+
+    :return: Array of shape (6, N, len(range 1), len(range 2), ...) with X, Y, Z, U, V, W,
+        with the ranges in the order of SWEEP_PARAMETERS
+    """
+
+    params = [p for p in SWEEP_PARAMETERS if p in ranges]
+    n = len(stars['ra'])
+    shape = (n,) + tuple(len(ranges[p]) for p in params)
+    size = int(np.prod(shape))
+    if size > max_size:
+        raise ValueError('The sweep has {0} points, more than the maximum of {1}'.format(size, max_size))
+
+    ndim = len(shape)
+    values = dict()
+    for p in SWEEP_PARAMETERS:
+        if p in ranges:
+            values[p] = _axis(ranges[p], 1 + params.index(p), ndim)
+        else:
+            values[p] = _axis(stars[p], 0, ndim)
+
+    # The bases of the positions are reused from earlier sweeps of the same stars
+    basis = cached_basis(stars['ra'], stars['dec'])
+    return xyzuvw_from_basis(basis, values['dist'], values['pmra'], values['pmdec'], values['rv'])
+
+
+# Function to calculate a sweep as a long table
+def sweep_table(stars, ranges, max_size=MAX_GRID_SIZE):
+    """
+    Same as sweep_grid, but returns a table with one row per point of the grid.
+
+    :return: DataFrame with a Name column (if stars has one), a column for each swept parameter, and X, Y, Z, U, V, W
+    """
+
+    import pandas as pd  # only imported when needed, see the note in app.py
+
+    params = [p for p in SWEEP_PARAMETERS if p in ranges]
+    grid = sweep_grid(stars, ranges, max_size=max_size)
+    shape = grid.shape[1:]
+
+    data = pd.DataFrame()
+    if 'name' in stars:  # the star is the first axis, so each name is repeated for its part of the grid
+        data['Name'] = np.repeat(np.asarray(stars['name']), int(np.prod(shape[1:])))
+    for i, p in enumerate(params):
+        data[SWEEP_COLUMNS[p]] = np.broadcast_to(_axis(ranges[p], 1 + i, len(shape)), shape).ravel()
+    for i, col in enumerate(['X', 'Y', 'Z', 'U', 'V', 'W']):
+        data[col] = grid[i].ravel()
+
+    return data
@@ -0,0 +1,67 @@
+"""
+Compact binary encoding of the data of the results page, sent separately from the page and decoded in the browser
+(see static/results_data.js) into typed arrays for the Bokeh data sources.
+
+The payload is a little-endian uint32 with the length of a JSON header, the header, and the column buffers,
+each aligned to 8 bytes so that the browser can view them as typed arrays without copying. The header lists, for
+each data source, its columns with their type, shape, and position in the payload. Floating point columns can be
+sent as float32, and text columns are sent as the indices of their values in a list of categories.
+"""
+
+import json
+import struct
+import numpy as np
+
+ALIGNMENT = 8
+
+
+def _codes(values):
+    # Categories of a text column and the index of each value, in the smallest integer type that fits
+    values = np.asarray(values, dtype=object)
+    missing = np.array([v is None or (isinstance(v, float) and v != v) for v in values], dtype=bool)
+    values = np.where(missing, '', values).astype(str)
+    categories, codes = np.unique(values, return_inverse=True)
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if len(categories) <= np.iinfo(dtype).max + 1:
+            return categories.tolist(), codes.astype(dtype)
+
+
+# Function to encode the columns of several data sources as a single payload
+def encode_sources(sources, float32=True):
+    """
+    :param sources: Dictionary of source id: dictionary of column: list or array
+    :param float32: Send floating point columns as float32
+
+    :return: Payload as bytes
+    """
+
+    header = dict()
+    buffers = []
+    offset = 0
+    for source_id, columns in sources.items():
+        header[source_id] = dict()
+        for col, values in columns.items():
+            values = np.asarray(values)
+            description = {'shape': list(values.shape)}
+            if values.dtype.kind in 'OUS':
+                description['categories'], values = _codes(values.ravel())
+            elif values.dtype.kind == 'f':
+                values = values.astype('<f4' if float32 else '<f8')
+            elif values.dtype.kind in 'iub':
+                largest = np.abs(values).max() if values.size else 0  # max(initial=...) needs numpy 1.15
+                values = values.astype('<f8') if largest >= 2 ** 31 else values.astype('<i4')
+            else:
+                raise ValueError('Cannot encode column {0} of type {1}'.format(col, values.dtype))
+
+            description['dtype'] = str(values.dtype.newbyteorder('=').name)
+            description['offset'] = offset
+            header[source_id][str(col)] = description
+            data = np.ascontiguousarray(values).tobytes()
+            buffers.append(data + b'\0' * (-len(data) % ALIGNMENT))
+            offset += len(buffers[-1])
+
+    text = json.dumps(header).encode('utf-8')
+    start = 4 + len(text)
+    text += b' ' * (-start % ALIGNMENT)  # the buffers start aligned
+    return struct.pack('<I', len(text)) + text + b''.join(buffers)
+
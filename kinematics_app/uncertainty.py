@@ -0,0 +1,253 @@
+"""
+Propagation of the uncertainties of the inputs (and their correlations) to XYZ/UVW, either analytically with the
+Jacobian of the transformation or by Monte Carlo sampling, for many stars at a time.
+"""
+
+from druvw import xyz_array, uvw_array, GAL_MATRIX, UVW_MATRIX, RADCON_XYZ, RADCON_UVW, k
+import numpy as np
+
+PARAMETERS = ['ra', 'dec', 'dist', 'pmra', 'pmdec', 'rv']
+OUTPUTS = ['X', 'Y', 'Z', 'U', 'V', 'W']
+
+# Uncertainties: ra and dec in mas, dist in pc (or plx in mas), pmra and pmdec in mas/yr, rv in km/s.
+# As in Gaia (ra_error), e_ra is the uncertainty of ra * cos(dec), an angle on the sky
+ERROR_COLUMNS = ['e_ra', 'e_dec', 'e_dist', 'e_plx', 'e_pmra', 'e_pmdec', 'e_rv']
+OUTPUT_ERROR_COLUMNS = ['e_' + col for col in OUTPUTS]
+OUTPUT_CORR_PAIRS = [(i, j) for i in range(6) for j in range(i + 1, 6)]
+OUTPUT_CORR_COLUMNS = ['{0}_{1}_corr'.format(OUTPUTS[i], OUTPUTS[j]) for i, j in OUTPUT_CORR_PAIRS]
+MAS = np.pi / 180 / 3600000.  # radians per milli-arcsecond
+
+MODES = ['analytic', 'montecarlo']
+DEFAULT_SAMPLES = 1000  # Monte Carlo samples per star
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024  # memory used by the samples of a chunk of stars
+
+
+# Function to name the column with the correlation of two parameters, as in Gaia (e.g. ra_dec_corr, plx_pmra_corr)
+def corr_column(a, b):
+    order = ['ra', 'dec', 'plx', 'dist', 'pmra', 'pmdec', 'rv']
+    a, b = sorted([a, b], key=order.index)
+    return '{0}_{1}_corr'.format(a, b)
+
+
+# Function to check whether a table has any uncertainty columns
+def has_errors(columns):
+    return any(col in columns for col in ERROR_COLUMNS)
+
+
+def _column(errors, col, n):
+    # Values of a column as a float array, zeros (or NaN for correlations) if missing
+    if col not in errors:
+        return np.zeros(n)
+    values = np.asarray(errors[col], dtype=float).ravel()
+    return np.broadcast_to(values, (n,)) if values.size == 1 else values
+
+
+def _correlation(errors, a, b, n):
+    # Correlations of two parameters, zero where missing
+    rho = _column(errors, corr_column(a, b), n)
+    return np.where(np.isfinite(rho), rho, 0)
+
+
+# Function to build the covariance matrices of the inputs
+def input_covariance(values, errors):
+    """
+    :param values: Dictionary of the PARAMETERS, arrays of N values
+    :param errors: Dictionary with any of the ERROR_COLUMNS and correlation columns (see corr_column);
+        missing uncertainties are taken as zero, and missing or empty correlations as zero
+
+    :return: Array of shape (N, 6, 6) in units of rad (of ra, not ra * cos(dec)), rad, pc, mas/yr, mas/yr, km/s,
+        and boolean array of the stars whose distance uncertainty is given as a parallax uncertainty
+    """
+
+    n = len(np.atleast_1d(values['ra']))
+    sigma = np.zeros((n, 6))
+    cosd = np.cos(np.asarray(values['dec'], dtype=float).ravel() * RADCON_XYZ)
+    sigma[:, 0] = _column(errors, 'e_ra', n) * MAS / np.maximum(np.abs(cosd), 1e-12)  # e_ra is along ra * cos(dec)
+    sigma[:, 1] = _column(errors, 'e_dec', n) * MAS
+    sigma[:, 2] = _column(errors, 'e_dist', n)
+    sigma[:, 3] = _column(errors, 'e_pmra', n)
+    sigma[:, 4] = _column(errors, 'e_pmdec', n)
+    sigma[:, 5] = _column(errors, 'e_rv', n)
+    sigma = np.where(np.isfinite(sigma), sigma, 0)
+
+    # Parallax uncertainties, for the stars without a distance uncertainty: d = 1000 / plx
+    dist = np.asarray(values['dist'], dtype=float).ravel()
+    e_plx = _column(errors, 'e_plx', n)
+    from_plx = (sigma[:, 2] == 0) & np.isfinite(e_plx) & (e_plx > 0)
+    sigma[from_plx, 2] = dist[from_plx] ** 2 * e_plx[from_plx] / 1000.
+
+    corr = np.zeros((n, 6, 6))
+    corr[:, np.arange(6), np.arange(6)] = 1
+    for i, a in enumerate(PARAMETERS):
+        for j, b in enumerate(PARAMETERS[i + 1:], i + 1):
+            rho = _correlation(errors, a, b, n)
+            if 'dist' in (a, b):  # the distance decreases with the parallax
+                rho_plx = _correlation(errors, 'plx', b if a == 'dist' else a, n)
+                rho = np.where(from_plx, -rho_plx, rho)
+            corr[:, i, j] = corr[:, j, i] = rho
+
+    return sigma[:, :, None] * corr * sigma[:, None, :], from_plx
+
+
+# Function to calculate the Jacobian of XYZ/UVW with respect to the inputs
+def jacobian(ra, dec, dist, pmra, pmdec, rv):
+    """
+    :return: Array of shape (N, 6, 6), the derivatives of X, Y, Z, U, V, W (rows) with respect to
+        ra and dec in radians, dist, pmra, pmdec, and rv (columns)
+    """
+
+    ra, dec, dist, pmra, pmdec, rv = [np.asarray(x, dtype=float).ravel() for x in
+                                      np.broadcast_arrays(ra, dec, dist, pmra, pmdec, rv)]
+    n = len(ra)
+    jac = np.zeros((n, 6, 6))
+
+    # XYZ = G . d (cos(dec) cos(ra), cos(dec) sin(ra), sin(dec))
+    a, d = ra * RADCON_XYZ, dec * RADCON_XYZ
+    cosa, sina, cosd, sind = np.cos(a), np.sin(a), np.cos(d), np.sin(d)
+    zero = np.zeros(n)
+    p = np.dot(GAL_MATRIX, [cosd * cosa, cosd * sina, sind])
+    dp_da = np.dot(GAL_MATRIX, [-cosd * sina, cosd * cosa, zero])
+    dp_dd = np.dot(GAL_MATRIX, [-sind * cosa, -sind * sina, cosd])
+    jac[:, :3, 0] = (dp_da * dist).T
+    jac[:, :3, 1] = (dp_dd * dist).T
+    jac[:, :3, 2] = p.T
+
+    # UVW = rv R + vt (pmra A + pmdec D), with vt = k dist / 1000 and R, A, D as in druvw.uvw_basis
+    a, d = ra * RADCON_UVW, dec * RADCON_UVW
+    cosa, sina, cosd, sind = np.cos(a), np.sin(a), np.cos(d), np.sin(d)
+    r = np.dot(UVW_MATRIX, [cosa * cosd, sina * cosd, sind])
+    ra_dir = np.dot(UVW_MATRIX, [-sina, cosa, zero])
+    de_dir = np.dot(UVW_MATRIX, [-cosa * sind, -sina * sind, cosd])
+    dra_da = np.dot(UVW_MATRIX, [-cosa, -sina, zero])
+    vt = k * dist / 1000.
+
+    jac[:, 3:, 0] = (rv * cosd * ra_dir + vt * (pmra * dra_da - pmdec * sind * ra_dir)).T
+    jac[:, 3:, 1] = (rv * de_dir - vt * pmdec * r).T
+    jac[:, 3:, 2] = (k / 1000. * (pmra * ra_dir + pmdec * de_dir)).T
+    jac[:, 3:, 3] = (vt * ra_dir).T
+    jac[:, 3:, 4] = (vt * de_dir).T
+    jac[:, 3:, 5] = r.T
+
+    return jac
+
+
+# Function to propagate the uncertainties with the Jacobian
+def propagate_analytic(values, errors):
+    """
+    Linear propagation, cov(XYZUVW) = J cov(inputs) J^T, exact for UVW in the velocities and good
+    while the relative uncertainty of the distance is small.
+
+    :param values: Dictionary of the PARAMETERS, arrays of N values
+    :param errors: Dictionary of uncertainties and correlations, see input_covariance
+
+    :return: Array of shape (6, N) with the values of X, Y, Z, U, V, W, array of shape (N, 6, 6) of their covariances
+    """
+
+    cov_in, _ = input_covariance(values, errors)
+    args = [values[p] for p in PARAMETERS]
+    jac = jacobian(*args)
+    cov = np.einsum('nij,njk,nlk->nil', jac, cov_in, jac)
+    mean = np.vstack([xyz_array(*args[:3]), uvw_array(*args)])
+    return mean, cov
+
+
+# Function to propagate the uncertainties by sampling the inputs
+def propagate_monte_carlo(values, errors, samples=DEFAULT_SAMPLES, max_bytes=DEFAULT_MAX_BYTES, seed=0):
+    """
+    Draw samples of the inputs from a multivariate normal distribution for each star and calculate XYZ/UVW for all
+    of them at once, in chunks of stars so that the samples of a chunk use about max_bytes of memory.
+    Parallaxes are sampled for the stars with parallax uncertainties, and samples with non-positive parallaxes
+    are left out.
+
+    :param values: Dictionary of the PARAMETERS, arrays of N values
+    :param errors: Dictionary of uncertainties and correlations, see input_covariance
+    :param samples: Number of samples per star
+    :param max_bytes: Memory for the samples of a chunk of stars
+    :param seed: Seed of the random numbers, so that the same inputs give the same results
+
+    :return: Array of shape (6, N) with the means of X, Y, Z, U, V, W, array of shape (N, 6, 6) of their covariances
+    """
+
+    cov_in, from_plx = input_covariance(values, errors)
+    center = np.vstack([np.asarray(values[p], dtype=float).ravel() for p in PARAMETERS]).T  # (N, 6)
+    n = len(center)
+
+    # Sample the parallax instead of the distance where its uncertainty was given
+    scale = np.ones((n, 6))
+    scale[from_plx, 2] = -1000. / center[from_plx, 2] ** 2  # d(plx)/d(dist)
+    cov_in = scale[:, :, None] * cov_in * scale[:, None, :]
+    center[from_plx, 2] = 1000. / center[from_plx, 2]
+    cov_in[:, :2, :] *= 180 / np.pi  # ra and dec are sampled in degrees
+    cov_in[:, :, :2] *= 180 / np.pi
+
+    # Factor each covariance as L L^T, through the correlation matrix so that zero uncertainties are allowed
+    sigma = np.sqrt(np.maximum(cov_in[:, np.arange(6), np.arange(6)], 0))
+    safe = np.where(sigma > 0, sigma, 1)
+    corr = cov_in / safe[:, :, None] / safe[:, None, :]
+    corr[:, np.arange(6), np.arange(6)] = 1
+    try:
+        chol = sigma[:, :, None] * np.linalg.cholesky(corr)
+    except np.linalg.LinAlgError:
+        raise ValueError('The correlations of some stars do not form a valid correlation matrix')
+
+    rng = np.random.RandomState(seed)
+    chunk = max(1, int(max_bytes // (samples * 8 * 6 * 4)))  # inputs, outputs, and temporaries
+    mean = np.empty((6, n))
+    cov = np.empty((n, 6, 6))
+    for i in range(0, n, chunk):
+        j = min(i + chunk, n)
+        m = j - i
+        draws = center[i:j, None, :] + np.einsum('nij,nsj->nsi', chol[i:j], rng.standard_normal((m, samples, 6)))
+
+        dist = draws[:, :, 2]
+        plx_rows = from_plx[i:j]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dist[plx_rows] = np.where(dist[plx_rows] > 0, 1000. / dist[plx_rows], np.nan)
+
+        flat = [draws[:, :, c].ravel() for c in range(6)]
+        out = np.vstack([xyz_array(*flat[:3]), uvw_array(*flat)]).reshape(6, m, samples)
+
+        valid = np.isfinite(out).all(axis=0)  # (m, samples)
+        count = valid.sum(axis=1)
+        out = np.where(valid, out, 0)
+        mean[:, i:j] = out.sum(axis=2) / np.maximum(count, 1)
+        dev = np.where(valid, out - mean[:, i:j, None], 0)
+        cov[i:j] = np.einsum('ans,bns->nab', dev, dev) / np.maximum(count - 1, 1)[:, None, None]
+        mean[:, i:j][:, count == 0] = np.nan
+        cov[i:j][count == 0] = np.nan
+
+    return mean, cov
+
+
+# Function to propagate the uncertainties with either method
+def propagate(values, errors, mode='analytic', samples=DEFAULT_SAMPLES, max_bytes=DEFAULT_MAX_BYTES, seed=0):
+    """
+    :param mode: analytic or montecarlo
+
+    :return: Array of shape (6, N) with X, Y, Z, U, V, W, array of shape (N, 6, 6) of their covariances
+    """
+
+    if mode == 'analytic':
+        return propagate_analytic(values, errors)
+    if mode == 'montecarlo':
+        return propagate_monte_carlo(values, errors, samples=samples, max_bytes=max_bytes, seed=seed)
+    raise ValueError('Unknown uncertainty mode: {0}'.format(mode))
+
+
+# Function to add the uncertainties of XYZ/UVW to a table of results
+def add_uncertainties(data, mean, cov):
+    """
+    Set X, Y, Z, U, V, W to the propagated values (the means in Monte Carlo mode), add their uncertainties as
+    e_X, e_Y, e_Z, e_U, e_V, e_W and their correlations as X_Y_corr, X_Z_corr, ... (NaN where an uncertainty is zero).
+    """
+
+    for i, col in enumerate(OUTPUTS):
+        data[col] = mean[i]
+    sigma = np.sqrt(np.maximum(cov[:, np.arange(6), np.arange(6)], 0))
+    for i, col in enumerate(OUTPUT_ERROR_COLUMNS):
+        data[col] = sigma[:, i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for (i, j), col in zip(OUTPUT_CORR_PAIRS, OUTPUT_CORR_COLUMNS):
+            data[col] = np.where((sigma[:, i] > 0) & (sigma[:, j] > 0),
+                                 cov[:, i, j] / (sigma[:, i] * sigma[:, j]), np.nan)
+    return data
@@ -2,5 +2,6 @@ from kinematics_app import app
 import os
 
 if __name__ == '__main__':
+    print('App loaded in {0:.2f} s'.format(app.startup_time))
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=False)
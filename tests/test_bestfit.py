@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from bestfit import best_fit, fit_table, COORDINATES
+from druvw import xyz_array, uvw_array
+from groups import NYMG
+
+STARS = dict(ra=np.array([165.466, 60.2, 300.2, 15.]), dec=np.array([-34.704, 20.1, 45.1, -60.]),
+             pmra=np.array([-66.19, 40.5, 12.5, 90.]), pmdec=np.array([-13.9, -30.3, -40.3, -20.]),
+             dist=np.array([53., 40., 120., 35.]), rv=np.array([9.2, 15., -21.7, 5.]))
+
+
+def _sweep(param, grid, space):
+    # Distance to every group, in units of its dispersions, for every star and value of the grid
+    used = [c for c in COORDINATES if c in space]
+    n, m = len(STARS['ra']), len(grid)
+    inputs = [np.repeat(STARS[col], m) for col in ['ra', 'dec', 'dist', 'pmra', 'pmdec', 'rv']]
+    inputs[2 if param == 'dist' else 5] = np.tile(grid, n)
+    values = dict(zip(COORDINATES, np.vstack([xyz_array(*inputs[:3]), uvw_array(*inputs)])))
+    d2 = sum(((values[c][:, None] - NYMG[c].values) / NYMG['e' + c].values) ** 2 for c in used)
+    return np.sqrt(d2).reshape(n, m, len(NYMG))
+
+
+def _check(param, grid, space):
+    value, residual, predicted = best_fit(STARS, param, NYMG, space=space.lower())
+    sigma = _sweep(param, grid, space)
+    best = np.argmin(sigma, axis=1)
+    interior = (best > 0) & (best < len(grid) - 1)
+    step = grid[1] - grid[0]
+    assert interior.sum() > 10
+    assert np.all(np.abs(value - grid[best])[interior] <= step)
+    assert np.allclose(residual[interior], sigma.min(axis=1)[interior], rtol=1e-3, atol=1e-3)
+    assert not np.any(residual > sigma.min(axis=1) + 1e-9)  # NaN where the best distance would be negative
+    assert predicted.shape == (6, len(STARS['ra']), len(NYMG))
+
+
+def test_rv_matches_a_sweep():
+    _check('rv', np.arange(-100, 100, 0.01), 'XYZUVW')
+    _check('rv', np.arange(-100, 100, 0.01), 'UVW')
+
+
+def test_dist_matches_a_sweep():
+    _check('dist', np.arange(0.05, 400, 0.05), 'XYZUVW')
+
+
+def test_chunks_give_the_same_fit():
+    whole = best_fit(STARS, 'rv', NYMG)
+    chunked = best_fit(STARS, 'rv', NYMG, chunk_size=3)
+    for a, b in zip(whole, chunked):
+        assert np.allclose(a, b)
+    table = fit_table(STARS, 'rv', NYMG, chunk_size=3)
+    assert np.allclose(table['RV_TWA'], whole[0][:, list(NYMG['name']).index('TWA')])
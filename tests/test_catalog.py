@@ -0,0 +1,37 @@
+import io
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from catalog import process_catalog
+
+
+def _catalog(n):
+    rows = ['name,ra,dec,pmra,pmdec,rv,dist'] + ['Star {0},{1},10,5,5,10,50'.format(i, i % 360) for i in range(n)]
+    return io.BytesIO(('\n'.join(rows) + '\n').encode('utf-8'))
+
+
+def test_swept_chunks_stay_around_chunksize():
+    # Each row is expanded over the sweep, so fewer rows are read at a time
+    ranges = {'rv': np.linspace(-50, 50, 101)}
+    chunks = [data for data, _ in process_catalog(_catalog(3000), chunksize=1000, ranges=ranges)]
+    assert max(len(data) for data in chunks) <= 1000
+    assert sum(len(data) for data in chunks) == 3000 * 101
+
+
+def test_skipped_rows_keep_their_line_numbers_after_blank_lines():
+    text = ('name,ra,dec,pmra,pmdec,rv,dist\n'
+            'A,10,10,5,5,10,50\n'
+            '\n'
+            'B,x,10,5,5,10,50\n'
+            '\n'
+            '\n'
+            'C,10,10,5,5,10,50\n'
+            'D,10,10,y,5,10,50\n')
+    chunks = list(process_catalog(io.BytesIO(text.encode('utf-8')), chunksize=3))
+    skipped = [line for _, rows in chunks for line, _ in rows]
+    assert skipped == [4, 8]
+    assert sum(len(data) for data, _ in chunks) == 2
@@ -0,0 +1,92 @@
+import os
+import sys
+from math import cos, sin
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from druvw import uvw, xyz, uvw_array, xyz_array
+
+# ra, dec, dist, pmra, pmdec, rv
+STARS = [(0., 0., 10., 0., 0., 0.),
+         (165.466, -34.704, 53., -66.19, -13.9, 9.2),
+         (300.2, 45.1, 120., 12.5, -40.3, -21.7)]
+
+# XYZ of STARS from astropy's SkyCoord(...).galactic, as calculated by the original version of xyz
+XYZ = [(-0.5487565771259179, 4.941094371927274, -8.676661375596588),
+       (7.363584137601868, -48.24420528738366, 20.6706140411271),
+       (20.47810960771209, 117.11224445489913, 16.29015732368712)]
+
+
+def _uvw_reference(ra, dec, d, pmra, pmde, rv):
+    # Original scalar version of uvw, adapted from gal_uvw.pro
+    k = 4.74047
+    a = [[0.0548755604, 0.8734370902, 0.4838350155],
+         [0.4941094279, -0.4448296300, 0.7469822445],
+         [-0.8676661490, -0.1980763734, 0.4559837762]]
+    radcon = 3.1415926/180
+    cosd, sind = cos(dec * radcon), sin(dec * radcon)
+    cosa, sina = cos(ra * radcon), sin(ra * radcon)
+    vec1, vec2, vec3 = rv, k * pmra * d / 1000., k * pmde * d / 1000.
+    u, v, w = [(r[0]*cosa*cosd + r[1]*sina*cosd + r[2]*sind) * vec1 + (-r[0]*sina + r[1]*cosa) * vec2 +
+               (-r[0]*cosa*sind - r[1]*sina*sind + r[2]*cosd) * vec3 for r in a]
+    return -u, v, w
+
+
+def _columns(rows):
+    return [np.array(col) for col in zip(*rows)]
+
+
+def test_scalar_inputs():
+    for star, expected in zip(STARS, XYZ):
+        assert np.allclose(xyz(*star[:3]), expected, rtol=1e-12, atol=1e-12)
+        assert np.allclose(uvw(*star), _uvw_reference(*star), rtol=1e-12, atol=1e-12)
+        assert np.ndim(uvw(*star)[0]) == 0
+
+
+def test_list_and_array_inputs():
+    expected_uvw = _columns([_uvw_reference(*star) for star in STARS])
+    for inputs in [[list(col) for col in _columns(STARS)], _columns(STARS)]:
+        assert np.allclose(xyz(*inputs[:3]), _columns(XYZ), rtol=1e-12, atol=1e-12)
+        assert np.allclose(uvw(*inputs), expected_uvw, rtol=1e-12, atol=1e-12)
+
+
+def test_broadcast_inputs():
+    ra, dec, d, pmra, pmde, rv = _columns(STARS)
+    u, v, w = uvw(ra[1], dec[1], d[1], pmra[1], pmde[1], np.array([-10., 0., 10.]))
+    assert u.shape == (3,)
+    assert np.allclose(u[1], _uvw_reference(ra[1], dec[1], d[1], pmra[1], pmde[1], 0.)[0])
+
+
+def test_float32():
+    inputs = _columns(STARS)
+    u = uvw_array(*inputs, dtype=np.float32)
+    x = xyz_array(*inputs[:3], dtype=np.float32)
+    assert u.dtype == np.float32 and x.dtype == np.float32
+    assert np.allclose(u, uvw_array(*inputs), rtol=1e-5, atol=1e-4)
+    assert np.allclose(x, _columns(XYZ), rtol=1e-5, atol=1e-4)
+
+
+def test_out_and_chunks():
+    rng = np.random.RandomState(0)
+    n = 1001
+    inputs = [rng.uniform(0, 360, n), rng.uniform(-90, 90, n), rng.uniform(1, 500, n),
+              rng.normal(0, 50, n), rng.normal(0, 50, n), rng.normal(0, 20, n)]
+    expected_uvw = uvw_array(*inputs)
+    expected_xyz = xyz_array(*inputs[:3])
+
+    out = np.empty((3, n))
+    assert uvw_array(*inputs, out=out, chunk_size=64) is out
+    assert np.allclose(out, expected_uvw, rtol=1e-12, atol=1e-12)
+    assert np.allclose(out[:, 10], _uvw_reference(*[col[10] for col in inputs]), rtol=1e-12, atol=1e-12)
+
+    out = np.empty((3, n))
+    assert xyz_array(*inputs[:3], out=out, chunk_size=100) is out
+    assert np.allclose(out, expected_xyz, rtol=1e-12, atol=1e-12)
+
+
+def test_out_of_the_wrong_shape():
+    with pytest.raises(ValueError):
+        uvw_array(*_columns(STARS), out=np.empty((3, 2)))
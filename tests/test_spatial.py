@@ -0,0 +1,61 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from spatial import KDTree
+
+
+def _points(n=2000, d=3, seed=0):
+    rng = np.random.RandomState(seed)
+    points = rng.normal(0, 50, (n, d))
+    points[::97, 1] = np.nan  # rows with missing values are never found
+    points[5::211] = points[2]  # duplicates
+    return points
+
+
+def _distances(points, point):
+    distance = np.sqrt(((points - point) ** 2).sum(axis=1))
+    return np.where(np.isnan(distance), np.inf, distance)
+
+
+def test_knn_matches_brute_force():
+    for d in [3, 6]:
+        points = _points(d=d)
+        tree = KDTree(points, leaf_size=16)
+        for point in [np.zeros(d), points[2], np.full(d, 200.)]:
+            expected = np.sort(_distances(points, point))
+            for k in [1, 7, 100]:
+                rows, distance = tree.knn(point, k)
+                assert len(rows) == k
+                assert np.allclose(distance, expected[:k])
+                assert np.allclose(_distances(points[rows], point), distance)
+        assert len(tree.knn(np.zeros(d), 0)[0]) == 0
+
+
+def test_radius_matches_brute_force():
+    points = _points()
+    tree = KDTree(points, leaf_size=16)
+    for point, r in [(np.zeros(3), 30.), (points[2], 0.), (np.full(3, 500.), 10.), (np.zeros(3), 1e4)]:
+        distance = _distances(points, point)
+        rows, found = tree.radius(point, r)
+        assert np.array_equal(np.sort(rows), np.flatnonzero(distance <= r))
+        assert np.all(np.diff(found) >= 0)
+
+
+def test_box_matches_brute_force():
+    points = _points()
+    tree = KDTree(points, leaf_size=16)
+    for lower, upper in [([-20, -30, -10], [20, 10, 40]), ([-1e4] * 3, [1e4] * 3), ([100, 100, 100], [90, 90, 90])]:
+        inside = ((points >= lower) & (points <= upper)).all(axis=1)
+        assert np.array_equal(tree.box(lower, upper), np.flatnonzero(inside))
+
+
+def test_saved_arrays_give_the_same_tree():
+    points = _points()
+    tree = KDTree(points, leaf_size=16)
+    copy = KDTree(points, arrays=tree.arrays())
+    rows, distance = tree.knn(np.zeros(3), 20)
+    assert np.array_equal(copy.knn(np.zeros(3), 20)[0], rows)
@@ -0,0 +1,53 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from transport import encode_sources, ALIGNMENT
+
+
+def _decode(payload):
+    # Same steps as static/results_data.js
+    length, = struct.unpack('<I', payload[:4])
+    header = json.loads(payload[4:4 + length].decode('utf-8'))
+    start = 4 + length
+    assert start % ALIGNMENT == 0
+    sources = dict()
+    for source_id, columns in header.items():
+        sources[source_id] = dict()
+        for col, description in columns.items():
+            assert description['offset'] % ALIGNMENT == 0
+            size = int(np.prod(description['shape']))
+            values = np.frombuffer(payload, dtype='<' + np.dtype(description['dtype']).str[1:], count=size,
+                                   offset=start + description['offset'])
+            if 'categories' in description:
+                values = np.array(description['categories'])[values]
+            sources[source_id][col] = values.reshape(description['shape'])
+    return sources
+
+
+def test_round_trip():
+    rng = np.random.RandomState(0)
+    names = np.array(['Star {0}'.format(i % 300) for i in range(1000)], dtype=object)
+    names[5] = None
+    sources = {'table': {'Name': names, 'X': rng.normal(0, 50, 1000), 'count': np.arange(1000)},
+               'ovals': {'xs': rng.normal(0, 1, (4, 50)), 'flag': np.array([True, False, True]),
+                         'big': np.array([2 ** 40, 1])},
+               'empty': {'X': np.empty(0)}}
+
+    for float32 in [True, False]:
+        decoded = _decode(encode_sources(sources, float32=float32))
+        assert decoded['table']['X'].dtype == (np.float32 if float32 else np.float64)
+        assert np.allclose(decoded['table']['X'], sources['table']['X'], rtol=1e-6 if float32 else 0)
+        assert decoded['ovals']['xs'].shape == (4, 50)
+        assert np.allclose(decoded['ovals']['xs'], sources['ovals']['xs'], rtol=1e-6 if float32 else 0)
+        assert np.array_equal(decoded['table']['count'], np.arange(1000))
+        assert np.array_equal(decoded['ovals']['flag'], [1, 0, 1])
+        assert np.array_equal(decoded['ovals']['big'], [2 ** 40, 1])
+        assert decoded['table']['Name'][5] == ''
+        assert list(decoded['table']['Name'][:5]) == ['Star {0}'.format(i) for i in range(5)]
+        assert decoded['empty']['X'].shape == (0,)
@@ -0,0 +1,56 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'kinematics_app'))
+
+from druvw import xyz_array, uvw_array
+from uncertainty import jacobian, propagate, add_uncertainties, input_covariance, PARAMETERS, MAS
+
+VALUES = dict(ra=np.array([10., 165.466, 300.2]), dec=np.array([-30., -34.704, 60.]), dist=np.array([50., 53., 120.]),
+              pmra=np.array([10., -66.19, 12.5]), pmdec=np.array([-20., -13.9, -40.3]), rv=np.array([5., 9.2, -21.7]))
+
+# Small uncertainties, so that the linear propagation is accurate
+ERRORS = {'e_ra': 0.5, 'e_dec': 0.4, 'e_dist': np.array([0.5, 0.2, 1.]), 'e_pmra': 0.1, 'e_pmdec': 0.2,
+          'e_rv': np.array([0.5, 0.3, 1.]), 'ra_dec_corr': 0.3, 'pmra_pmdec_corr': -0.4, 'dist_pmra_corr': 0.2}
+
+
+def test_jacobian_matches_finite_differences():
+    args = [VALUES[p] for p in PARAMETERS]
+    jac = jacobian(*args)
+    steps = [1e-7, 1e-7, 1e-4, 1e-4, 1e-4, 1e-4]
+    for c, step in enumerate(steps):
+        plus, minus = list(args), list(args)
+        # ra and dec derivatives are per radian
+        delta = step * 180 / np.pi if c < 2 else step
+        plus[c], minus[c] = args[c] + delta, args[c] - delta
+        f = [np.vstack([xyz_array(*a[:3]), uvw_array(*a)]) for a in [plus, minus]]
+        numeric = (f[0] - f[1]) / (2 * step)
+        assert np.allclose(jac[:, :, c], numeric.T, rtol=1e-5, atol=1e-6)
+
+
+def test_analytic_matches_monte_carlo():
+    mean_a, cov_a = propagate(VALUES, ERRORS, 'analytic')
+    mean_m, cov_m = propagate(VALUES, ERRORS, 'montecarlo', samples=20000, seed=1)
+    sigma_a = np.sqrt(cov_a[:, np.arange(6), np.arange(6)])
+    sigma_m = np.sqrt(cov_m[:, np.arange(6), np.arange(6)])
+    assert np.all(np.abs(mean_m - mean_a) < 0.05 * sigma_a.T + 1e-9)
+    assert np.allclose(sigma_m, sigma_a, rtol=0.05)
+    corr_a = cov_a / sigma_a[:, :, None] / sigma_a[:, None, :]
+    corr_m = cov_m / sigma_m[:, :, None] / sigma_m[:, None, :]
+    assert np.allclose(corr_m, corr_a, atol=0.05)
+
+
+def test_ra_error_is_on_the_sky():
+    # As in Gaia, e_ra is the uncertainty of ra * cos(dec)
+    cov, _ = input_covariance(VALUES, {'e_ra': 1.})
+    assert np.allclose(np.sqrt(cov[:, 0, 0]), MAS / np.cos(np.radians(VALUES['dec'])))
+
+
+def test_add_uncertainties_keeps_the_correlations():
+    mean, cov = propagate(VALUES, ERRORS, 'analytic')
+    data = add_uncertainties(pd.DataFrame(), mean, cov)
+    assert np.allclose(data['e_U'], np.sqrt(cov[:, 3, 3]))
+    assert np.allclose(data['X_W_corr'], cov[:, 0, 5] / np.sqrt(cov[:, 0, 0] * cov[:, 5, 5]))